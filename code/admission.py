@@ -0,0 +1,95 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import random, socket, threading, time
+from collections import deque
+
+# TCP keepalive on client connections: a peer that vanished without closing is found after ~90 s
+KEEPALIVE_OPTIONS = (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3))
+
+
+def enable_keepalive(_socket:socket.socket) -> None:
+    _socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in KEEPALIVE_OPTIONS:
+        if hasattr(socket, name): _socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+
+
+class Admission_Control:
+    # Decides right after accept() whether a connection is served. Over the limits the server answers
+    # <busy> with a retry delay and closes, which costs the client one round trip instead of minutes of
+    # SYN retries. The delay is spread between retry_after and twice that, so the clients refused in a
+    # reconnect storm do not come back together. Data connections announced by a ticket are let in over
+    # the limits: they belong to clients that were already admitted.
+    __slots__ = ('_lock', '_connections', '_per_address', '_expected', 'max_clients', 'max_per_address',
+                 'retry_after', 'accepted', 'refused_full', 'refused_address', 'reaped', 'peak')
+
+    def __init__(self, _max_clients:int=0, _max_per_address:int=0, _retry_after:float=5.0) -> None:
+        self._lock            = threading.Lock()
+        self._connections     = 0
+        self._per_address     = dict()
+        self._expected        = dict()
+        self.max_clients      = _max_clients
+        self.max_per_address  = _max_per_address
+        self.retry_after      = _retry_after
+        self.accepted         = 0
+        self.refused_full     = 0
+        self.refused_address  = 0
+        self.reaped           = 0
+        self.peak             = 0
+
+
+    def admit(self, _address:str) -> str | None:
+        # None when the connection is admitted, otherwise the reason it is not
+        with self._lock:
+            _reason = None
+            if self.max_clients and self._connections >= self.max_clients:
+                _reason = 'server full'
+            elif self.max_per_address and self._per_address.get(_address, 0) >= self.max_per_address:
+                _reason = f'too many connections from {_address}'
+            if _reason and not self.take_expected_locked(_address):
+                if _reason == 'server full': self.refused_full += 1
+                else:                        self.refused_address += 1
+                return _reason
+            self._connections += 1
+            self._per_address[_address] = self._per_address.get(_address, 0) + 1
+            self.accepted += 1
+            self.peak      = max(self.peak, self._connections)
+            return None
+
+
+    def release(self, _address:str) -> None:
+        with self._lock:
+            self._connections -= 1
+            if self._per_address.get(_address, 0) > 1: self._per_address[_address] -= 1
+            else: self._per_address.pop(_address, None)
+
+
+    def expect(self, _address:str, _seconds:float) -> None:
+        # A ticket was issued: one data connection from _address may come in over the limits
+        with self._lock:
+            _now = time.monotonic()
+            for address in [address for address, expires in self._expected.items() if expires[-1] < _now]: del self._expected[address]
+            self._expected.setdefault(_address, deque()).append(_now + _seconds)
+
+
+    def take_expected_locked(self, _address:str) -> bool:
+        _expires, _now = self._expected.get(_address), time.monotonic()
+        while _expires and _expires[0] < _now: _expires.popleft()
+        if not _expires: return False
+        _expires.popleft()
+        return True
+
+
+    def get_retry_after(self) -> float:
+        return round(self.retry_after * (1 + random.random()), 1)
+
+
+    def describe(self) -> dict:
+        with self._lock:
+            return {'connections': self._connections, 'peak': self.peak, 'max_clients': self.max_clients,
+                    'max_per_address': self.max_per_address, 'accepted': self.accepted,
+                    'refused_full': self.refused_full, 'refused_address': self.refused_address, 'reaped': self.reaped}
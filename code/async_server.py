@@ -0,0 +1,357 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import asyncio, inspect
+from server import Server
+from admission import enable_keepalive
+from metrics import log
+from chunked_transfer import Chunk_Manifest
+from fanout import DISCONNECT, BACKPRESSURE
+from compression import NONE, Transfer_Report, Decompressing_Writer, negotiate_compression, iterate_compressed
+from protocol import Frame_Decoder, HEADER, COMMAND, RECV_SIZE, encode_data, encode_data_header
+
+
+class Stream_Socket:
+    # Gives the synchronous handlers of Server a socket-like object backed by asyncio streams.
+    # send_data can not sleep, so the bandwidth it used is paid back by the next drain().
+    __slots__ = ('_reader', '_writer', '_decoder', '_held_frames', '_bandwidth_delay', 'bytes_sent', 'bytes_received', 'limiter')
+
+    def __init__(self, _reader:asyncio.StreamReader, _writer:asyncio.StreamWriter) -> None:
+        self._reader        = _reader
+        self._writer        = _writer
+        self._decoder       = Frame_Decoder()
+        self._held_frames     = None
+        self._bandwidth_delay = 0.0
+        self.bytes_sent       = 0
+        self.bytes_received   = 0
+        self.limiter          = None
+
+
+    async def wait_for_bandwidth(self, _size:int) -> None:
+        if self.limiter and (_delay := self.limiter.reserve(_size)): await asyncio.sleep(_delay)
+
+
+    def sendall(self, _data:bytes) -> None:
+        self.bytes_sent += len(_data)
+        self.send_queued_frame(_data)
+
+
+    def send_queued_frame(self, _data:bytes) -> None:
+        # The transport refuses writes while loop.sendfile owns it: frames wait for the end of the chunk
+        if self._held_frames is not None: return self._held_frames.append(_data)
+        self._writer.write(_data)
+
+
+    def send_data(self, _data:bytes) -> None:
+        if self.limiter: self._bandwidth_delay = max(self._bandwidth_delay, self.limiter.reserve(len(_data)))
+        self.sendall(encode_data(_data))
+
+
+    def release_held_frames(self) -> None:
+        _frames, self._held_frames = self._held_frames, None
+        for frame in _frames: self._writer.write(frame)
+
+
+    async def send_file(self, _file:object, _offset:int, _count:int, _chunk_size:int) -> int:
+        # loop.sendfile uses os.sendfile when the transport allows it and falls back to read/write otherwise
+        _loop, _sent_data = asyncio.get_running_loop(), 0
+        if self.limiter: _chunk_size = self.limiter.get_slice_size(_chunk_size)
+        while _sent_data < _count:
+            _size = min(_chunk_size, _count - _sent_data)
+            await self.wait_for_bandwidth(_size)
+            self._writer.write(encode_data_header(_size))
+            await self._writer.drain()
+            self._held_frames = list()
+            try:     _written = await _loop.sendfile(self._writer.transport, _file, _offset + _sent_data, _size)
+            finally: self.release_held_frames()
+            if _written != _size: raise ConnectionResetError('file changed size during the transfer')
+            self.bytes_sent += HEADER.size + _size
+            _sent_data      += _size
+        return _sent_data
+
+
+    async def fill_buffer(self) -> bool:
+        _data = await self._reader.read(RECV_SIZE)
+        if not _data: return False
+        self._decoder.feed(_data)
+        return True
+
+
+    async def receive_frame(self) -> tuple[int, str, bytes] | None:
+        while (_frame := self._decoder.next_frame()) is None:
+            if not await self.fill_buffer(): return None
+        return _frame
+
+
+    async def receive_data(self) -> bytes:
+        while (_data := self._decoder.next_data()) is None:
+            if not await self.fill_buffer(): raise ConnectionResetError('connection closed during the transfer')
+        self.bytes_received += len(_data)
+        await self.wait_for_bandwidth(len(_data))
+        return _data
+
+
+    async def drain(self) -> None:
+        await self._writer.drain()
+        if self._bandwidth_delay:
+            _delay, self._bandwidth_delay = self._bandwidth_delay, 0.0
+            await asyncio.sleep(_delay)
+
+
+    def get_buffered_bytes(self) -> int:
+        _held_bytes = sum(map(len, self._held_frames)) if self._held_frames else 0
+        return self._writer.transport.get_write_buffer_size() + _held_bytes
+
+
+    def is_closing(self) -> bool:
+        return self._writer.is_closing()
+
+
+    def abort(self) -> None:
+        self._writer.transport.abort()
+
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+
+class Stream_Outbound_Queue:
+    # The transport write buffer is the per-client queue on the event loop: write() never blocks,
+    # so the policy is applied when the buffer already holds max_bytes.
+    __slots__ = ('_stream_socket', 'max_bytes', 'policy', 'high_water', 'sent', 'sent_bytes', 'dropped')
+
+    def __init__(self, _stream_socket:Stream_Socket, _max_bytes:int, _policy:str) -> None:
+        self._stream_socket = _stream_socket
+        self.max_bytes      = _max_bytes
+        self.policy         = _policy
+        self.high_water     = 0
+        self.sent           = 0
+        self.sent_bytes     = 0
+        self.dropped        = 0
+
+
+    @property
+    def depth(self) -> int:
+        return self._stream_socket.get_buffered_bytes()
+
+
+    @property
+    def congested(self) -> bool:
+        return self.depth >= self.max_bytes
+
+
+    def put(self, _frame:bytes, _always:bool=False) -> bool:
+        if self._stream_socket.is_closing(): return False
+        if not _always and self.depth and self.depth + len(_frame) > self.max_bytes and self.policy != BACKPRESSURE:
+            self.dropped += 1
+            if self.policy == DISCONNECT: self._stream_socket.abort()
+            return False
+        self._stream_socket.send_queued_frame(_frame)
+        self.high_water  = max(self.high_water, self.depth)
+        self.sent       += 1
+        self.sent_bytes += len(_frame)
+        return True
+
+
+    async def drain(self) -> None:
+        await self._stream_socket.drain()
+
+
+    def close(self) -> None:
+        pass
+
+
+
+class Async_Server(Server):
+    def __init__(self, _server_socket:object=None) -> None:
+        self._loop = asyncio.new_event_loop()
+        super().__init__(_server_socket)
+
+
+    def receive_client(self) -> None:
+        try:    self._loop.run_until_complete(self.serve_forever())
+        except KeyboardInterrupt: log.info('Server stopped')
+
+
+    def deliver_from_cluster(self, _client_id:int | None, _frame:bytes) -> None:
+        # Called from the cluster thread: the streams may only be touched from the loop
+        self._loop.call_soon_threadsafe(super().deliver_from_cluster, _client_id, _frame)
+
+
+    def deliver_to_watchers(self, _deliveries:list) -> None:
+        # Called from the watcher thread
+        self._loop.call_soon_threadsafe(super().deliver_to_watchers, _deliveries)
+
+
+    def abort_connection(self, _client_socket:Stream_Socket) -> None:
+        # Called from the reaper thread
+        self._loop.call_soon_threadsafe(_client_socket.abort)
+
+
+    def create_send_queue(self, _client_socket:Stream_Socket) -> Stream_Outbound_Queue:
+        return Stream_Outbound_Queue(_client_socket, self.SEND_QUEUE_BYTES, self.SLOW_CONSUMER_POLICY)
+
+
+    def wait_for_slow_consumers(self, _queues:list) -> object:
+        if self.SLOW_CONSUMER_POLICY != BACKPRESSURE: return None
+        _congested = [queue for queue in _queues if queue.congested]
+        return self.drain_slow_consumers(_congested) if _congested else None
+
+
+    async def wait_for_batch(self, _pending:list) -> None:
+        for wait in _pending: await wait
+
+
+    async def drain_slow_consumers(self, _queues:list) -> None:
+        _drains = [asyncio.ensure_future(queue.drain()) for queue in _queues]
+        _, _pending = await asyncio.wait(_drains, timeout=self.BACKPRESSURE_TIMEOUT)
+        for drain in _pending: drain.cancel()
+
+
+    async def serve_forever(self) -> None:
+        _server = await asyncio.start_server(self.handle_client_async, sock=self._server_socket, backlog=self.LISTEN_BACKLOG)
+        async with _server:
+            await _server.serve_forever()
+
+
+    async def handle_client_async(self, _reader:asyncio.StreamReader, _writer:asyncio.StreamWriter) -> None:
+        _client_address = _writer.get_extra_info('peername')
+        if (_reason := self._admission.admit(_client_address[0])):
+            _writer.write(self.get_refusal(_reason))
+            return _writer.close()
+        enable_keepalive(_writer.get_extra_info('socket'))
+        _client_socket  = Stream_Socket(_reader, _writer)
+        if not self.add_client_to_the_list(_client_socket, _client_address):
+            _writer.write(self.get_refusal(f'client id {_client_address[1]} is in use'))
+            self._admission.release(_client_address[0])
+            return _writer.close()
+        log.info(f'New log in: {_client_address}')
+        try:
+            await self.loop_to_receive_data_from_clients_async(_client_address, _client_socket)
+        except (ConnectionResetError, OSError):
+            log.info(f'Client {_client_address[1]} disconnected abruptly.')
+        except Exception as error:
+            log.warning(f'Error with client {_client_address}: {error}')
+            self.send_message(_client_socket, '<single>:SERVER: There is something wrong in your request')
+        finally:
+            self.remove_client_from_the_list(_client_address)
+            self._admission.release(_client_address[0])
+            _client_socket.close()
+
+
+    async def loop_to_receive_data_from_clients_async(self, _client_address:tuple[str, int], _client_socket:Stream_Socket) -> None:
+        while (_frame := await _client_socket.receive_frame()) is not None:
+            _frame_type, _method_key, _payload = _frame
+            if _frame_type != COMMAND: continue
+            _start = self._metrics.start_request(_client_socket)
+            try:
+                _forward_flag, _result = self.dispatch_request(_client_address, _client_socket, _method_key, Frame_Decoder.get_arguments(_payload))
+                if inspect.isawaitable(_result): await _result
+            except Exception:
+                self.record_request(_method_key, _payload, _start, _client_socket, False)
+                raise
+            self.record_request(_method_key, _payload, _start, _client_socket)
+            if _forward_flag in ('/exit', 'dch'): break
+            await _client_socket.drain()
+            await asyncio.sleep(0)
+
+
+    async def send_file_to_client(self, _client_socket:Stream_Socket, _file_information:tuple | str) -> None:
+        if isinstance(_file_information, str): return self.send_message(_client_socket, _file_information)
+        _file_name, _file_size, *_options = _file_information
+        _codec, _level = negotiate_compression(_file_name, *_options[:2])
+        with self.get_open_file_cache().open_file(_file_name) as cached:
+            if _codec == NONE: return await _client_socket.send_file(cached.file, 0, _file_size, self.SEND_CHUNK_SIZE)
+            # The compressor runs in a thread, one output piece at a time: lzma may read the whole file
+            # before it returns anything, and the loop must keep serving the other clients meanwhile
+            _pieces = iterate_compressed(cached.get_reader(), _file_size, _codec, _level, Transfer_Report(_codec, _level))
+            while (_data := await asyncio.to_thread(next, _pieces, None)) is not None:
+                _client_socket.send_data(_data)
+                await _client_socket.drain()
+
+
+    async def receive_file_from_client(self, _client_socket:Stream_Socket, _file_information:tuple) -> None:
+        _file_name, _file_size, *_ = _file_information
+        _report = self.prepare_to_receive_file(_file_information)
+        try:    await self.write_file(_client_socket, _file_name, _file_size, _report)
+        except: _result = '<single>:SERVER: error while receiving the file'
+        else:   _result = f'<single>:SERVER: file received ({_report.describe()})'
+        self.send_message(_client_socket, _result)
+
+
+    async def write_file(self, _client_socket:Stream_Socket, _file_name:str, _file_size:int, _report:Transfer_Report) -> None:
+        # Disk writes and syncs happen on the writer thread of the upload; the loop only waits when
+        # the disk is behind by more than the queue of the writer
+        _upload = self.open_upload(_file_name, False)
+        try:
+            if _report.codec != NONE:
+                _writer = Decompressing_Writer(_upload, _report.codec, _report, _file_size)
+                while _writer.feed(await _client_socket.receive_data()):
+                    await asyncio.to_thread(self.write_decompressed, _writer, _upload)
+                _writer.finish()
+            else:
+                while _report.raw_bytes < _file_size:
+                    _data = await _client_socket.receive_data()
+                    _upload.write(_data)
+                    _report.raw_bytes += len(_data)
+                    if _upload.is_full(): await asyncio.to_thread(_upload.wait_for_room)
+                _report.wire_bytes = _report.raw_bytes
+            _temporary_path = await asyncio.to_thread(_upload.finish)
+        except:
+            _upload.abort()
+            raise
+        await asyncio.to_thread(self.install_file, _temporary_path, _file_name, _upload.checksum)
+
+
+    @staticmethod
+    def write_decompressed(_writer:Decompressing_Writer, _upload:object) -> None:
+        # Runs in a thread: decompresses the frame fed to _writer, waiting for the disk between chunks
+        while _writer.write_chunk():
+            if _upload.is_full(): _upload.wait_for_room()
+
+
+    async def send_blocking_reply(self, _client_socket:Stream_Socket, _job:callable) -> None:
+        self.send_message(_client_socket, await asyncio.to_thread(_job))
+
+
+    async def send_file_range(self, _client_socket:Stream_Socket, _file_name_and_index:tuple[str, int]) -> None:
+        # A file changed since its manifest was cached is hashed again, in a thread
+        try:   _path, _offset, _length = await asyncio.to_thread(self.get_file_range, *_file_name_and_index)
+        except Exception as error: return self.send_message(_client_socket, f'<range_error>:{_file_name_and_index[0]}||{error}')
+        with self.get_open_file_cache().open_file(_file_name_and_index[0]) as cached:
+            await _client_socket.send_file(cached.file, _offset, _length, self.SEND_CHUNK_SIZE)
+
+
+    async def send_byte_range(self, _client_socket:Stream_Socket, _byte_range:tuple[str, int, int | None] | str) -> None:
+        if isinstance(_byte_range, str): return self.send_message(_client_socket, _byte_range)
+        with self.get_open_file_cache().open_file(_byte_range[0]) as cached:
+            if (_length := self.announce_byte_range(_client_socket, cached, *_byte_range)) is None: return
+            await _client_socket.send_file(cached.file, _byte_range[1], _length, self.SEND_CHUNK_SIZE)
+
+
+    async def receive_file_range(self, _client_socket:Stream_Socket, _range_information:tuple[str, int, int]) -> None:
+        _file_name, _index, _size = _range_information
+        try:   _file, _checksum = self.open_upload_range(_file_name, _index, _size)
+        except Exception as error:
+            await self.discard_range(_client_socket, _size)
+            return self.send_message(_client_socket, f'<range_error>:{_file_name}||{_index}||{error}')
+        _hash, _received_data, _valid = Chunk_Manifest.new_hash(), 0, True
+        with _file:
+            while _received_data < _size:
+                _data, _valid = self.bound_range_data(await _client_socket.receive_data(), _size - _received_data, _valid)
+                _hash.update(_data)
+                _file.write(_data)
+                _received_data += len(_data)
+        # The last range installs the file, which hashes it for the content store with --dedup
+        self.send_message(_client_socket, await asyncio.to_thread(self.complete_upload_range, _file_name, _index, _valid and _hash.hexdigest() == _checksum))
+
+
+    @staticmethod
+    async def discard_range(_client_socket:Stream_Socket, _size:int) -> None:
+        _received_data = 0
+        while _received_data < _size:
+            _received_data += min(len(await _client_socket.receive_data()), _size - _received_data)
@@ -0,0 +1,147 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import threading, time
+
+UNITS         = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+BURST_SECONDS = 0.25
+SLICE_SECONDS = 0.05
+MIN_SLICE     = 16 * 1024
+
+
+def parse_rate(_rate:str) -> int:
+    # Bytes per second, with an optional K, M or G suffix; 0 or "off" removes the limit
+    _rate = str(_rate).strip().upper().removesuffix('B')
+    if _rate in ('OFF', ''): return 0
+    _unit = _rate[-1] if _rate[-1] in UNITS else ''
+    _value = float(_rate[:len(_rate) - len(_unit)])
+    if _value < 0: raise ValueError('the rate can not be negative')
+    return int(_value * UNITS[_unit])
+
+
+def format_rate(_rate:int) -> str:
+    if not _rate: return 'unlimited'
+    for unit in ('G', 'M', 'K'):
+        if _rate >= UNITS[unit]: return f'{_rate / UNITS[unit]:.1f} {unit}B/s'
+    return f'{_rate} B/s'
+
+
+
+class Token_Bucket:
+    # Reservations may take the bucket below zero: the caller waits until the debt is paid back,
+    # so transfers that reserve one after the other are served in turn
+    __slots__ = ('rate', 'capacity', '_tokens', '_updated_at')
+
+    def __init__(self, _rate:int=0) -> None:
+        self.set_rate(_rate)
+
+
+    def set_rate(self, _rate:int) -> None:
+        self.rate        = _rate
+        self.capacity    = _rate * BURST_SECONDS
+        self._tokens     = self.capacity
+        self._updated_at = time.monotonic()
+
+
+    def reserve(self, _size:int, _now:float) -> float:
+        if not self.rate: return 0.0
+        self._tokens     = min(self.capacity, self._tokens + (_now - self._updated_at) * self.rate)
+        self._updated_at = _now
+        self._tokens    -= _size
+        return max(0.0, -self._tokens / self.rate)
+
+
+
+class Client_Limiter:
+    # Handed to the socket of a client: file bytes (DATA frames) wait for it, commands and messages do not
+    __slots__ = ('_scheduler', 'client_id')
+
+    def __init__(self, _scheduler:'Bandwidth_Scheduler', _client_id:int) -> None:
+        self._scheduler = _scheduler
+        self.client_id  = _client_id
+
+
+    def reserve(self, _size:int) -> float:
+        return self._scheduler.reserve(self.client_id, _size)
+
+
+    def get_slice_size(self, _chunk_size:int) -> int:
+        return self._scheduler.get_slice_size(self.client_id, _chunk_size)
+
+
+
+class Bandwidth_Scheduler:
+    # A global token bucket shared by every transfer plus one bucket per client. While a limit is set,
+    # file bytes move in slices of ~50 ms of the rate, so concurrent transfers interleave and a message
+    # never waits behind more than one slice. Rates can be changed at any time with /bandwidth.
+    __slots__ = ('_lock', '_global', '_clients', '_overrides', 'client_rate', 'throttled_seconds')
+
+    def __init__(self, _global_rate:int=0, _client_rate:int=0) -> None:
+        self._lock             = threading.Lock()
+        self._global           = Token_Bucket(_global_rate)
+        self._clients          = dict()
+        self._overrides        = set()
+        self.client_rate       = _client_rate
+        self.throttled_seconds = 0.0
+
+
+    def get_limiter(self, _client_id:int) -> Client_Limiter:
+        with self._lock:
+            self._clients[_client_id] = Token_Bucket(self.client_rate)
+        return Client_Limiter(self, _client_id)
+
+
+    def share_limiter(self, _client_id:int) -> Client_Limiter:
+        # For the data connections of a client: its bucket while it is connected here, the global one otherwise
+        return Client_Limiter(self, _client_id)
+
+
+    def discard(self, _client_id:int) -> None:
+        with self._lock:
+            self._clients.pop(_client_id, None)
+            self._overrides.discard(_client_id)
+
+
+    def reserve(self, _client_id:int, _size:int) -> float:
+        with self._lock:
+            _now    = time.monotonic()
+            _bucket = self._clients.get(_client_id)
+            _delay  = max(self._global.reserve(_size, _now), _bucket.reserve(_size, _now) if _bucket else 0.0)
+            self.throttled_seconds += _delay
+            return _delay
+
+
+    def get_slice_size(self, _client_id:int, _chunk_size:int) -> int:
+        _bucket = self._clients.get(_client_id)
+        _rates  = [rate for rate in (self._global.rate, _bucket.rate if _bucket else 0) if rate]
+        if not _rates: return _chunk_size
+        return min(_chunk_size, max(MIN_SLICE, int(min(_rates) * SLICE_SECONDS)))
+
+
+    def set_global_rate(self, _rate:int) -> None:
+        with self._lock:
+            self._global.set_rate(_rate)
+
+
+    def set_client_rate(self, _rate:int, _client_id:int=None) -> bool:
+        # Without a client id the rate becomes the default of every client that has no rate of its own
+        with self._lock:
+            if _client_id is not None:
+                if _client_id not in self._clients: return False
+                self._clients[_client_id].set_rate(_rate)
+                self._overrides.add(_client_id)
+                return True
+            self.client_rate = _rate
+            for client_id, bucket in self._clients.items():
+                if client_id not in self._overrides: bucket.set_rate(_rate)
+            return True
+
+
+    def describe(self) -> dict:
+        with self._lock:
+            return {'global_rate': self._global.rate, 'client_rate': self.client_rate,
+                    'overrides': {client_id: self._clients[client_id].rate for client_id in self._overrides},
+                    'throttled_seconds': round(self.throttled_seconds, 3)}
@@ -0,0 +1,98 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import json
+from protocol import Frame_Decoder
+
+
+class Batch_Replies:
+    # Stands in for the client socket while a batched command runs, so its replies are collected and
+    # counted for the metrics of the command
+    __slots__ = ('_decoder', 'bytes_sent', 'bytes_received')
+
+    def __init__(self) -> None:
+        self._decoder       = Frame_Decoder()
+        self.bytes_sent     = 0
+        self.bytes_received = 0
+
+
+    def sendall(self, _frame:bytes) -> None:
+        self._decoder.feed(_frame)
+        self.bytes_sent += len(_frame)
+
+
+    def collect(self) -> str | None:
+        _messages = list()
+        while (_frame := self._decoder.next_frame()) is not None:
+            _, _key, _payload = _frame
+            _messages.append(f'{_key}:{_payload.decode()}' if _payload else _key)
+        return '\n'.join(_messages) if _messages else None
+
+
+
+class Batch_MixIn:
+    # <batch>:[["id", "/command:arguments"], ...] runs the commands in order through the usual strategies
+    # and answers once with <batch_reply>:[["id", "reply"], ...]. The reply is null when a command has
+    # nothing to tell the sender (a delivered /msg). Commands that stream file bytes need their own
+    # exchange with the client and are refused inside a batch. Each command is recorded in the metrics
+    # under its own key, like one sent alone; refused and failed commands count as errors.
+    MAX_BATCH_SIZE = 1000
+    BATCH_FLAGS    = ('svc', 'pvt', 'bdc')
+
+    @classmethod
+    def separate_batch(cls, _arguments:str) -> list | None:
+        try:
+            _requests = json.loads(_arguments or '')
+            if not isinstance(_requests, list) or len(_requests) > cls.MAX_BATCH_SIZE: return None
+            return [(str(request_id), str(request)) for request_id, request in _requests]
+        except (ValueError, TypeError):
+            return None
+
+
+    def prepare_batch(self, _client_port:int, _arguments:str) -> tuple[int, list | None]:
+        return (_client_port, self.separate_batch(_arguments))
+
+
+    def execute_batch(self, _client_socket:object, _batch:tuple[int, list | None]) -> object:
+        _client_port, _requests = _batch
+        if _requests is None:
+            return self.send_message(_client_socket, f'<single>:SERVER: Invalid batch, expected up to {self.MAX_BATCH_SIZE} ["id", "/command:arguments"] pairs')
+        _replies, _pending = list(), list()
+        for request_id, request in _requests:
+            _reply, _wait = self.execute_batched_request(_client_port, request)
+            _replies.append((request_id, _reply))
+            if _wait is not None: _pending.append(_wait)
+        self.send_message(_client_socket, f'<batch_reply>:{json.dumps(_replies)}')
+        return self.wait_for_batch(_pending) if _pending else None
+
+
+    def execute_batched_request(self, _client_port:int, _request:str) -> tuple[str | None, object]:
+        _method_key, _, _arguments = _request.partition(':')
+        _replies = Batch_Replies()
+        _start   = self._metrics.start_request(_replies)
+        _reply, _wait, _ok = self.run_batched_request(_client_port, _method_key, _arguments, _replies)
+        if _reply is not None and not _replies.bytes_sent: _replies.bytes_sent = len(_reply.encode())
+        self.record_request(_method_key, _arguments.encode(), _start, _replies, _ok)
+        return (_reply, _wait)
+
+
+    def run_batched_request(self, _client_port:int, _method_key:str, _arguments:str, _replies:Batch_Replies) -> tuple[str | None, object, bool]:
+        # Refused before it runs: an unbatchable command may already act on the session (a <data> ticket, /exit)
+        _flag = self._routes.get(_method_key, self.UNKNOWN_COMMAND).strategy.FLAG
+        if _flag != 'svc' and _flag not in self.BATCH_FLAGS: return (f'<single>:SERVER: {_method_key} can not be batched', None, False)
+        try:
+            _forward_flag, _data = self.check_if_the_method_exists(_client_port, _method_key, _arguments or None)
+            if _forward_flag == 'svc': return (_data, None, True)
+            if _forward_flag not in self.BATCH_FLAGS: return (f'<single>:SERVER: {_method_key} can not be batched', None, False)
+            _wait = self.get_forward_dictionary()[_forward_flag](self, _replies, _data)
+            return (_replies.collect(), _wait, True)
+        except Exception:
+            return ('<single>:SERVER: There is something wrong in your request', None, False)
+
+
+    def wait_for_batch(self, _pending:list) -> None:
+        # Only the event loop hands back waits (backpressure drains); threads already waited inside put()
+        return None
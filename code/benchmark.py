@@ -0,0 +1,94 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import socket, threading, tempfile, time, os, argparse
+from protocol import Framed_Socket
+
+
+class Download_Benchmark:
+    # Measures the download path of the server over loopback TCP: the old 1 KiB read()/send() loop,
+    # the buffered framed path used for non-regular files and the sendfile(2) path.
+
+    def __init__(self, _file_size:int, _chunk_size:int) -> None:
+        self._file_size  = _file_size
+        self._chunk_size = _chunk_size
+
+
+    @staticmethod
+    def create_test_file(_file_size:int) -> str:
+        _file = tempfile.NamedTemporaryFile(delete=False)
+        _block = os.urandom(1024 * 1024)
+        for _ in range(_file_size // len(_block)):
+            _file.write(_block)
+        _file.write(_block[:_file_size % len(_block)])
+        _file.close()
+        return _file.name
+
+
+    @staticmethod
+    def drain_connection(_server_socket:object, _result:dict) -> None:
+        _connection, _ = _server_socket.accept()
+        _buffer = bytearray(1024 * 1024)
+        _start, _received_data = time.perf_counter(), 0
+        while (_size := _connection.recv_into(_buffer)):
+            _received_data += _size
+        _result['seconds']  = time.perf_counter() - _start
+        _result['received'] = _received_data
+        _connection.close()
+
+
+    @staticmethod
+    def send_legacy(_socket:object, _file:object, _file_size:int, _chunk_size:int) -> None:
+        _sent_data = 0
+        while _sent_data < _file_size:
+            _data = _file.read(1024)
+            _socket.send(_data)
+            _sent_data += len(_data)
+
+
+    @staticmethod
+    def send_buffered(_socket:object, _file:object, _file_size:int, _chunk_size:int) -> None:
+        Framed_Socket(_socket).send_file_buffered(_file, 0, _file_size, _chunk_size)
+
+
+    @staticmethod
+    def send_zero_copy(_socket:object, _file:object, _file_size:int, _chunk_size:int) -> None:
+        Framed_Socket(_socket).send_file(_file, 0, _file_size, _chunk_size)
+
+
+    def measure(self, _path:str, _sender:callable) -> float:
+        _server_socket = socket.create_server(('localhost', 0))
+        _result        = dict()
+        _receiver      = threading.Thread(target=self.drain_connection, args=(_server_socket, _result))
+        _receiver.start()
+        with socket.create_connection(_server_socket.getsockname()) as _socket, open(_path, 'rb') as file:
+            _sender(_socket, file, self._file_size, self._chunk_size)
+        _receiver.join()
+        _server_socket.close()
+        return self._file_size / _result['seconds'] / (1024 * 1024)
+
+
+    def run(self) -> dict:
+        _path    = self.create_test_file(self._file_size)
+        _senders = {
+            'legacy 1 KiB send()': self.send_legacy,
+            'buffered frames':     self.send_buffered,
+            'sendfile frames':     self.send_zero_copy
+        }
+        try:     _results = {name: self.measure(_path, sender) for name, sender in _senders.items()}
+        finally: os.remove(_path)
+        return _results
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download throughput benchmark')
+    parser.add_argument('--size-mb', type=int, default=512, help='size of the test file')
+    parser.add_argument('--chunk-size', type=int, default=4 * 1024 * 1024, help='bytes per DATA frame')
+    arguments = parser.parse_args()
+    benchmark = Download_Benchmark(arguments.size_mb * 1024 * 1024, arguments.chunk_size)
+    for name, throughput in benchmark.run().items():
+        print(f'{name:.<25} {throughput:10.1f} MB/s')
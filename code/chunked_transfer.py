@@ -0,0 +1,292 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import hashlib, os, shutil, threading
+
+
+class Chunk_Manifest:
+    # A file split in fixed-size ranges, each one with its own checksum.
+    # Encoded as name||size||chunk_size||checksum,checksum,...
+    __slots__ = ('name', 'size', 'chunk_size', 'checksums')
+    CHUNK_SIZE     = 4 * 1024 * 1024
+    MIN_CHUNK_SIZE = 64 * 1024
+    MAX_CHUNK_SIZE = 64 * 1024 * 1024
+    MAX_CHUNKS     = 65536
+
+    def __init__(self, _name:str, _size:int, _chunk_size:int, _checksums:list) -> None:
+        self.name       = _name
+        self.size       = _size
+        self.chunk_size = _chunk_size
+        self.checksums  = _checksums
+
+
+    @staticmethod
+    def new_hash() -> object:
+        return hashlib.blake2b(digest_size=16)
+
+
+    @classmethod
+    def from_file(cls, _name:str, _path:str, _chunk_size:int=None) -> 'Chunk_Manifest':
+        _chunk_size = _chunk_size or cls.CHUNK_SIZE
+        _size       = os.path.getsize(_path)
+        _manifest   = cls(_name, _size, _chunk_size, [])
+        _manifest.checksums = _manifest.compute_checksums(_path)
+        return _manifest
+
+
+    @classmethod
+    def decode(cls, _string:str) -> 'Chunk_Manifest':
+        # Manifests come from clients: ValueError unless every field is consistent with the others
+        try:
+            _name, _size, _chunk_size, _checksums = str(_string).split('||')
+            _manifest = cls(_name, int(_size), int(_chunk_size), _checksums.split(',') if _checksums else [])
+        except ValueError:
+            raise ValueError('expected name||size||chunk_size||checksum,checksum,...')
+        _manifest.validate()
+        return _manifest
+
+
+    def validate(self) -> None:
+        if not self.name or os.path.basename(self.name) != self.name: raise ValueError('invalid file name')
+        if self.size < 0: raise ValueError('invalid size')
+        if not self.MIN_CHUNK_SIZE <= self.chunk_size <= self.MAX_CHUNK_SIZE:
+            raise ValueError(f'chunk size must be between {self.MIN_CHUNK_SIZE} and {self.MAX_CHUNK_SIZE}')
+        if self.get_chunk_count() > self.MAX_CHUNKS: raise ValueError(f'more than {self.MAX_CHUNKS} chunks')
+        if len(self.checksums) != self.get_chunk_count(): raise ValueError(f'expected {self.get_chunk_count()} checksums')
+        for checksum in self.checksums:
+            if len(checksum) != 32 or checksum.strip('0123456789abcdef'): raise ValueError('invalid checksum')
+
+
+    def encode(self) -> str:
+        return f'{self.name}||{self.size}||{self.chunk_size}||{",".join(self.checksums)}'
+
+
+    def get_chunk_count(self) -> int:
+        return len(range(0, self.size, self.chunk_size))
+
+
+    def get_range(self, _index:int) -> tuple[int, int]:
+        if not 0 <= _index < self.get_chunk_count(): raise IndexError(f'Chunk {_index} out of range')
+        _offset = _index * self.chunk_size
+        return (_offset, min(self.chunk_size, self.size - _offset))
+
+
+    def compute_checksums(self, _path:str, _indexes:range=None) -> list:
+        _checksums = list()
+        with open(_path, 'rb') as file:
+            for index in (_indexes if _indexes is not None else range(self.get_chunk_count())):
+                _offset, _length = self.get_range(index)
+                file.seek(_offset)
+                _checksums.append(self.hash_chunk(file.read(_length), _length))
+        return _checksums
+
+
+    def hash_chunk(self, _data:bytes, _length:int) -> str:
+        _hash = self.new_hash()
+        _hash.update(_data)
+        return _hash.hexdigest() if len(_data) == _length else ''
+
+
+    def get_verified_chunks(self, _path:str) -> set:
+        if not os.path.isfile(_path): return set()
+        _indexes = range(self.get_chunk_count())
+        return {index for index, checksum in zip(_indexes, self.compute_checksums(_path, _indexes)) if checksum == self.checksums[index]}
+
+
+    @staticmethod
+    def allocate_partial_file(_path:str, _size:int) -> None:
+        with open(_path, 'ab') as file:
+            file.truncate(_size)
+
+
+
+class Chunked_Transfer_MixIn:
+    # Resumable, range based transfers. Downloads: /pdownl returns a manifest and the client pulls
+    # each range with <get_range>, possibly over several connections. Uploads: the client announces
+    # a manifest with <upl_chunks>, the server answers with the ranges it still lacks (<upl_need>)
+    # and every <put_range> is verified before it counts. Partial uploads live in name.part.
+    PARTIAL_SUFFIX     = '.part'
+    MAX_CHUNKED_SIZE   = 64 * 1024 * 1024 * 1024
+    CHUNKED_UPLOADS    = dict()
+    MANIFEST_CACHE     = dict()
+    CHUNKED_LOCK       = threading.Lock()
+
+
+    @classmethod
+    def get_file_manifest(cls, _file_name:str) -> str:
+        # Like /downl, only names in the file index exist: no paths out of the directory, no hidden files
+        if not cls.get_file_index().get(str(_file_name)): return '<single>:SERVER: file not found'
+        _manifest = cls.get_cached_manifest(_file_name, cls.get_directory() + _file_name)
+        return f'<manifest>:{_manifest.encode()}'
+
+
+    @classmethod
+    def get_cached_manifest(cls, _file_name:str, _path:str) -> Chunk_Manifest:
+        _status = os.stat(_path)
+        _key    = (_file_name, _status.st_size, _status.st_mtime_ns)
+        with cls.CHUNKED_LOCK:
+            _manifest = cls.MANIFEST_CACHE.get(_file_name)
+        if _manifest is None or _manifest[0] != _key:
+            _manifest = (_key, Chunk_Manifest.from_file(_file_name, _path))
+            with cls.CHUNKED_LOCK:
+                cls.MANIFEST_CACHE[_file_name] = _manifest
+        return _manifest[1]
+
+
+    @staticmethod
+    def separate_range_request(_arguments:str) -> tuple:
+        _file_name, *_numbers = _arguments.split('||')
+        return (_file_name, *map(int, _numbers))
+
+
+    def get_file_range(self, _file_name:str, _index:int) -> tuple[str, int, int]:
+        if not self.get_file_index().get(_file_name): raise FileNotFoundError('file not found')
+        _path = self.get_directory() + _file_name
+        _offset, _length = self.get_cached_manifest(_file_name, _path).get_range(_index)
+        return (_path, _offset, _length)
+
+
+    def send_file_range(self, _client_socket:object, _file_name_and_index:tuple[str, int]) -> None:
+        try:   _path, _offset, _length = self.get_file_range(*_file_name_and_index)
+        except Exception as error: return self.send_message(_client_socket, f'<range_error>:{_file_name_and_index[0]}||{error}')
+        with self.get_open_file_cache().open_file(_file_name_and_index[0]) as cached:
+            _client_socket.send_file(cached.file, _offset, _length, self.SEND_CHUNK_SIZE)
+
+
+    def separate_byte_range(self, _arguments:str) -> tuple[str, int, int | None] | str:
+        # /rdownl:name||offset||length, the offset defaults to 0 and the length to the rest of the file
+        _file_name, _offset, _length = (str(_arguments).split('||') + ['', ''])[:3]
+        if not self.get_file_index().get(_file_name): return f'<range_error>:{_file_name}||file not found'
+        try:    return (_file_name, int(_offset or 0), int(_length) if _length else None)
+        except ValueError: return f'<range_error>:{_file_name}||offset and length must be integers'
+
+
+    def announce_byte_range(self, _client_socket:object, _cached:object, _file_name:str, _offset:int, _length:int | None) -> int | None:
+        if _length is None: _length = _cached.size - _offset
+        if _offset < 0 or _length < 0 or _offset + _length > _cached.size:
+            return self.send_message(_client_socket, f'<range_error>:{_file_name}||bytes {_offset}+{_length} out of {_cached.size}')
+        self.send_message(_client_socket, f'<range>:{_file_name}||{_offset}||{_length}||{_cached.size}')
+        return _length
+
+
+    def send_byte_range(self, _client_socket:object, _byte_range:tuple[str, int, int | None] | str) -> None:
+        if isinstance(_byte_range, str): return self.send_message(_client_socket, _byte_range)
+        with self.get_open_file_cache().open_file(_byte_range[0]) as cached:
+            if (_length := self.announce_byte_range(_client_socket, cached, *_byte_range)) is None: return
+            _client_socket.send_file(cached.file, _byte_range[1], _length, self.SEND_CHUNK_SIZE)
+
+
+    def get_upload_path(self, _file_name:str, _kind:str='') -> str:
+        # name.part holds the data; name.manifest.part and name.verified.part let any worker process
+        # (and a restarted server) pick the upload up where it stopped
+        return self.get_directory() + _file_name + (f'.{_kind}' if _kind else '') + self.PARTIAL_SUFFIX
+
+
+    def plan_chunked_upload(self, _arguments:str) -> str:
+        # Hashes what a resumed upload already has, so the event loop runs it in a thread
+        try:    _manifest = Chunk_Manifest.decode(_arguments)
+        except ValueError as error: return f'<single>:SERVER: Invalid manifest: {error}'
+        if _manifest.size > self.MAX_CHUNKED_SIZE: return f'<single>:SERVER: Files over {self.MAX_CHUNKED_SIZE} bytes are not accepted'
+        _path      = self.get_upload_path(_manifest.name)
+        _resuming  = os.path.isfile(_path)
+        _available = shutil.disk_usage(self.get_directory()).free + (os.path.getsize(_path) if _resuming else 0)
+        if _manifest.size > _available: return '<single>:SERVER: Not enough space for the file'
+        Chunk_Manifest.allocate_partial_file(_path, _manifest.size)
+        _verified = _manifest.get_verified_chunks(_path) if _resuming else set()
+        with open(self.get_upload_path(_manifest.name, 'manifest'), 'w') as file: file.write(_manifest.encode())
+        with open(self.get_upload_path(_manifest.name, 'verified'), 'w') as file: file.writelines(f'{index}\n' for index in _verified)
+        with self.CHUNKED_LOCK:
+            self.CHUNKED_UPLOADS[_manifest.name] = (_manifest, _verified)
+        if self.finish_chunked_upload(_manifest.name): return '<single>:SERVER: file received'
+        _missing = [str(index) for index in range(_manifest.get_chunk_count()) if index not in _verified]
+        return f'<upl_need>:{_manifest.name}||{",".join(_missing)}'
+
+
+    def get_upload_state(self, _file_name:str) -> tuple[Chunk_Manifest, set]:
+        with self.CHUNKED_LOCK:
+            _upload = self.CHUNKED_UPLOADS.get(_file_name)
+        if _upload: return _upload
+        with open(self.get_upload_path(_file_name, 'manifest')) as file:
+            _upload = (Chunk_Manifest.decode(file.read()), self.read_verified_chunks(_file_name))
+        with self.CHUNKED_LOCK:
+            return self.CHUNKED_UPLOADS.setdefault(_file_name, _upload)
+
+
+    def read_verified_chunks(self, _file_name:str) -> set:
+        try:
+            with open(self.get_upload_path(_file_name, 'verified')) as file:
+                return {int(line) for line in file if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+
+    def open_upload_range(self, _file_name:str, _index:int, _size:int) -> tuple[object, str]:
+        # A verified range is never written again, so a bad copy sent later can not replace it
+        _manifest, _verified = self.get_upload_state(_file_name)
+        _offset, _length = _manifest.get_range(_index)
+        if _size != _length: raise ValueError(f'expected {_length} bytes')
+        if _index in _verified or _index in self.read_verified_chunks(_file_name): raise ValueError('range already verified')
+        _file = open(self.get_upload_path(_file_name), 'r+b')
+        _file.seek(_offset)
+        return (_file, _manifest.checksums[_index])
+
+
+    def complete_upload_range(self, _file_name:str, _index:int, _valid:bool) -> str:
+        if not _valid: return f'<range_error>:{_file_name}||{_index}||checksum mismatch'
+        with self.CHUNKED_LOCK:
+            _upload = self.CHUNKED_UPLOADS.get(_file_name)
+            if _upload: _upload[1].add(_index)
+        with open(self.get_upload_path(_file_name, 'verified'), 'a') as file: file.write(f'{_index}\n')
+        self.finish_chunked_upload(_file_name)
+        return f'<range_ok>:{_file_name}||{_index}'
+
+
+    def finish_chunked_upload(self, _file_name:str) -> bool:
+        # Ranges may have been verified by other worker processes, so the verified log on disk decides
+        with self.CHUNKED_LOCK:
+            _manifest, _verified = self.CHUNKED_UPLOADS.get(_file_name, (None, set()))
+        if _manifest is None: return False
+        _verified = _verified | self.read_verified_chunks(_file_name)
+        if len(_verified) < _manifest.get_chunk_count(): return False
+        with self.CHUNKED_LOCK:
+            self.CHUNKED_UPLOADS.pop(_file_name, None)
+        if not os.path.exists(self.get_upload_path(_file_name)): return True
+        try:    self.install_file(self.get_upload_path(_file_name), _file_name)
+        except FileNotFoundError: return True
+        for kind in ('manifest', 'verified'):
+            try:    os.remove(self.get_upload_path(_file_name, kind))
+            except FileNotFoundError: pass
+        return True
+
+
+    def receive_file_range(self, _client_socket:object, _range_information:tuple[str, int, int]) -> None:
+        _file_name, _index, _size = _range_information
+        try:   _file, _checksum = self.open_upload_range(_file_name, _index, _size)
+        except Exception as error:
+            self.discard_range(_client_socket, _size)
+            return self.send_message(_client_socket, f'<range_error>:{_file_name}||{_index}||{error}')
+        _hash, _received_data, _valid = Chunk_Manifest.new_hash(), 0, True
+        with _file:
+            while _received_data < _size:
+                _data, _valid = self.bound_range_data(_client_socket.receive_data(), _size - _received_data, _valid)
+                _hash.update(_data)
+                _file.write(_data)
+                _received_data += len(_data)
+        self.send_message(_client_socket, self.complete_upload_range(_file_name, _index, _valid and _hash.hexdigest() == _checksum))
+
+
+    @staticmethod
+    def bound_range_data(_data:bytes, _remaining:int, _valid:bool) -> tuple[bytes, bool]:
+        # A frame longer than the rest of the range would write into the next one: it is cut and the range rejected
+        if len(_data) > _remaining: return (_data[:_remaining], False)
+        return (_data, _valid)
+
+
+    @staticmethod
+    def discard_range(_client_socket:object, _size:int) -> None:
+        _received_data = 0
+        while _received_data < _size:
+            _received_data += min(len(_client_socket.receive_data()), _size - _received_data)
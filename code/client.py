@@ -3,7 +3,10 @@
 # Repository: https://github.com/olivercalazans/simple_server
 # Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
 
-import socket, threading, os, platform, time, sys
+import socket, threading, os, platform, time, sys, queue, hashlib, json, argparse
+from protocol import Framed_Socket, Frame_Decoder, COMMAND, DATA, DATA_CHUNK
+from chunked_transfer import Chunk_Manifest
+from compression import NONE, Transfer_Report, Decompressing_Writer, iterate_compressed
 
 class Client:
     DIRECTORY = os.path.dirname(os.path.abspath(__file__))
@@ -12,19 +15,73 @@ class Client:
 
     METHOD_DICTIONARY = {
         "<close>":     lambda self, arguments=None: self.logout(),
+        "<busy>":      lambda self, arguments=None: self.reconnect_later(arguments) if arguments else '',
+        "<login>":     lambda self, arguments=None: self.save_login(arguments) if arguments else '',
         "<mult>":      lambda self, arguments=None: self.display_multiple_lines(arguments) if arguments else ' ',
         "<single>":    lambda self, arguments=None: self.display_single_line(arguments) if arguments else ' ',
         "<confirm>":   lambda self, arguments=None: self.confirm_receiving_file(arguments) if arguments else '',
-        "<send_file>": lambda self, arguments=None: self.prepare_information_to_send_file(arguments) if arguments else ''
+        "<send_file>": lambda self, arguments=None: self.prepare_information_to_send_file(arguments) if arguments else '',
+        "<manifest>":  lambda self, arguments=None: self.start_chunked_download(arguments) if arguments else '',
+        "<upl_need>":  lambda self, arguments=None: self.start_chunked_upload(arguments) if arguments else '',
+        "<range>":       lambda self, arguments=None: self.receive_byte_range(arguments) if arguments else '',
+        "<range_error>": lambda self, arguments=None: self.display_single_line(arguments) if arguments else '',
+        "<batch_reply>": lambda self, arguments=None: self.display_batch_replies(arguments) if arguments else '',
+        "<watch>":       lambda self, arguments=None: self.display_file_events(arguments) if arguments else ''
         }
 
+    PARALLEL_CONNECTIONS = 4
 
-    def __init__(self, ip='localhost', port=10000) -> None:
-        self._connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._connection.connect((ip, port))
-        self._stop_flag = False
+
+    def __init__(self, ip='localhost', port=10000, client_id=None) -> None:
+        # The client id is the local port: connecting from the same port again gets the same id back
+        self._server_address  = (ip, port)
+        self._client_id       = client_id
+        self._connection      = Framed_Socket(self.connect_as(client_id))
+        self._stop_flag       = False
+        self._chunked_uploads = dict()
         self.create_directory(self.get_directory())
         threading.Thread(target=self.receive_from_server).start()
+        self.log_in()
+
+
+    def log_in(self) -> None:
+        # Only a fixed id has a mailbox: the first run claims it and keeps the secret in the client
+        # folder, later runs open the mailbox with it
+        if self._client_id is None: return
+        try:
+            with open(self.get_login_path()) as file: self._connection.send_command(f'/login:{file.read().strip()}')
+        except FileNotFoundError:
+            self._connection.send_command('/login')
+
+
+    def get_login_path(self) -> str:
+        return self.get_directory() + f'.login_{self._client_id}'
+
+
+    def save_login(self, _arguments:str) -> None:
+        _client_id, _secret = _arguments.split('||')
+        _descriptor = os.open(self.get_directory() + f'.login_{_client_id}', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(_descriptor, 'w') as file: file.write(_secret)
+        self.display_single_line(f'SERVER: Mailbox of client {_client_id} created, its secret is kept in the client folder')
+
+
+    def connect_as(self, _client_id:int | None) -> socket.socket:
+        if _client_id is None: return socket.create_connection(self._server_address)
+        _socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        _socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        _socket.bind(('', _client_id))
+        _socket.connect(self._server_address)
+        return _socket
+
+
+    def reconnect_later(self, _arguments:str) -> None:
+        # The server refused the connection: wait as long as it asked and connect again
+        _retry_after, _message = _arguments.split('||', 1)
+        self.display_single_line(_message)
+        time.sleep(float(_retry_after))
+        self._connection.close()
+        self._connection = Framed_Socket(self.connect_as(self._client_id))
+        self.log_in()
 
 
     @staticmethod
@@ -51,8 +108,10 @@ class Client:
     def send_request(self, _request:str) -> None:
         _key_method, _argument = self.separating_function_from_arguments(_request)
         match _key_method:
-            case '/upl': self.get_file_information(_argument)
-            case _:      self._connection.sendall(_request.encode())
+            case '/upl':  self.get_file_information(_argument)
+            case '/pupl': self.announce_chunked_upload(_argument)
+            case '/batch': self.send_batch_file(_argument)
+            case _:       self._connection.send_command(_request)
 
 
     def stop_thread(self) -> None:
@@ -66,9 +125,10 @@ class Client:
 
     def receive_from_server(self) -> None:
         try:
-            while not self._stop_flag:
-                _key_method, _arguments = self.separating_function_from_arguments(self._connection.recv(1024).decode())
-                self.METHOD_DICTIONARY[_key_method](self, _arguments)
+            while not self._stop_flag and (_frame := self._connection.receive_frame()) is not None:
+                _frame_type, _key_method, _payload = _frame
+                if _frame_type != COMMAND: continue
+                self.METHOD_DICTIONARY[_key_method](self, Frame_Decoder.get_arguments(_payload))
         except Exception as error:
             print(f'ERROR: {error}')
 
@@ -86,46 +146,97 @@ class Client:
             print(line)
     
 
+    @staticmethod
+    def display_file_events(_events:str) -> None:
+        for event in _events.split('<<SEP>>'):
+            _kind, _name, *_size = event.split('||')
+            if _kind == 'rescan': print(f'FILES: {_name} changes, list the files again'); continue
+            print(f'FILES: {_kind} {_name}' + (f' ({_size[0]} bytes)' if _size else ''))
+
+
     @staticmethod
     def display_single_line(_message:str) -> None:
         print(f'\n{_message}')
 
 
+    def display_batch_replies(self, _replies:str) -> None:
+        for request_id, reply in json.loads(_replies):
+            _key_method, _argument = self.separating_function_from_arguments(reply or '<single>:done')
+            match _key_method:
+                case '<single>': print(f'[{request_id}] {_argument}')
+                case '<mult>':   print(f'[{request_id}]'); self.display_multiple_lines(_argument)
+                case _:          self.METHOD_DICTIONARY.get(_key_method, self.METHOD_DICTIONARY['<single>'])(self, _argument)
+
+
     @staticmethod
     def display_progress(_message:str, _amount_of_data:int, _total_size:int) -> None:
         sys.stdout.write(f'\r{_message}: {_amount_of_data}/{_total_size}')
         sys.stdout.flush()
 
 
-    def confirm_receiving_file(self, _file_name_and_size:str) -> str:
-        _file_name, _file_size = (_file_name_and_size.split('||', 1))
-        _file_size             = int(_file_size)
-        self._connection.sendall(f'<conf>:{_file_name_and_size}'.encode())
-        self.receive_file(_file_name, _file_size)
+    @staticmethod
+    def separate_transfer_information(_file_information:str) -> tuple[str, int, str, int, str]:
+        _file_name, _file_size, _codec, _level, _ticket = (_file_information.split('||') + [NONE, '0', ''])[:5]
+        return (_file_name, int(_file_size), _codec, int(_level), _ticket)
+
+
+    def open_data_channel(self, _ticket:str) -> Framed_Socket:
+        # File bytes go through a connection of their own, so this one keeps receiving messages
+        _connection = self.open_parallel_connection()
+        _connection.send_command(f'<data>:{_ticket}')
+        return _connection
+
 
+    def confirm_receiving_file(self, _file_information:str) -> None:
+        _file_name, _file_size, _codec, _level, _ticket = self.separate_transfer_information(_file_information)
+        threading.Thread(target=self.receive_file, args=(_ticket, _file_name, _file_size, Transfer_Report(_codec, _level))).start()
 
-    def receive_file(self, _file_name:str, _file_size:int) -> None:
-        try:   self.write_file(_file_name, _file_size)
+
+    def receive_file(self, _ticket:str, _file_name:str, _file_size:int, _report:Transfer_Report) -> None:
+        _connection = self.open_data_channel(_ticket)
+        try:   self.write_file(_connection, _file_name, _file_size, _report)
         except Exception as error: print(f'ERROR: {error}')
-        else:  print(f'\nFile received ({_file_name})')
+        else:  print(f'\nFile received ({_file_name}, {_report.describe()})')
+        finally: _connection.close()
 
 
-    def write_file(self, _file_name:str, _file_size:int) -> None:
-        _received_data = 0
+    def write_file(self, _connection:Framed_Socket, _file_name:str, _file_size:int, _report:Transfer_Report) -> None:
         with open(self.get_directory() + _file_name, 'wb') as file:
-            while _received_data < _file_size:
-                _data = self._connection.recv(1024)
+            if _report.codec != NONE:
+                _writer = Decompressing_Writer(file, _report.codec, _report, _file_size)
+                while _writer.write(_connection.receive_data()):
+                    self.display_progress('Received data', _report.raw_bytes, _file_size)
+                return _writer.finish()
+            while _report.raw_bytes < _file_size:
+                _data = _connection.receive_data()
+                file.write(_data)
+                _report.raw_bytes += len(_data)
+                self.display_progress('Received data', _report.raw_bytes, _file_size)
+            _report.wire_bytes = _report.raw_bytes
+
+
+    def receive_byte_range(self, _range_information:str) -> None:
+        # The bytes are written at their offset, so ranges can be fetched in any order into one file
+        _file_name, _offset, _length, _total_size = _range_information.split('||')
+        _offset, _length, _received_data = int(_offset), int(_length), 0
+        _path = self.get_directory() + _file_name
+        with open(_path, 'r+b' if os.path.exists(_path) else 'wb') as file:
+            file.seek(_offset)
+            while _received_data < _length:
+                _data = self._connection.receive_data()
                 file.write(_data)
                 _received_data += len(_data)
-                self.display_progress('Received data', _received_data, _file_size)
+                self.display_progress('Received data', _received_data, _length)
+        print(f'\nBytes {_offset}-{_offset + _length} of {_file_name} received ({_total_size} bytes in total)')
 
 
-    def get_file_information(self, _file_name:str):
+    def get_file_information(self, _arguments:str):
+        _file_name, *_compression = str(_arguments).split('||')
         _file_existence = self.check_if_the_file_exists(self.get_directory() + _file_name)
         if not _file_existence:
             print(f'File not found: {_file_name}')
         else: 
-            self.send_file_name_and_size(_file_name)
+            self.send_file_name_and_size(_file_name, _compression[:2])
 
 
     @staticmethod
@@ -136,28 +247,191 @@ class Client:
             return False
 
 
-    def send_file_name_and_size(self, _file_name:str) -> None:
+    def send_file_name_and_size(self, _file_name:str, _compression:list) -> None:
         _file_size = os.path.getsize(self.get_directory() + _file_name)
-        self._connection.sendall(f'<file_inf>:{_file_name}||{_file_size}'.encode())
+        _checksum  = self.get_file_checksum(self.get_directory() + _file_name)
+        _options   = ''.join(f'||{option}' for option in _compression)
+        self._connection.send_command(f'<file_inf>:{_file_name}||{_file_size}||{_checksum}{_options}')
 
 
-    def prepare_information_to_send_file(self, _file_name_and_size:str):
-        _file_name, _file_size = _file_name_and_size.split('||', 1)
-        _file_size = int(_file_size)
-        self.send_file(_file_name, _file_size)
+    @staticmethod
+    def get_file_checksum(_path:str) -> str:
+        # Sent with /upl so that a server with content-addressed storage can skip content it already has
+        _hash = hashlib.sha256()
+        with open(_path, 'rb') as file:
+            while (_data := file.read(1024 * 1024)): _hash.update(_data)
+        return _hash.hexdigest()
+
+
+    def prepare_information_to_send_file(self, _file_information:str):
+        _file_name, _file_size, _codec, _level, _ticket = self.separate_transfer_information(_file_information)
+        threading.Thread(target=self.upload_file, args=(_ticket, _file_name, _file_size, _codec, _level)).start()
+
+
+    def upload_file(self, _ticket:str, _file_name:str, _file_size:int, _codec:str, _level:int) -> None:
+        _connection = self.open_data_channel(_ticket)
+        try:
+            self.send_file(_connection, _file_name, _file_size, _codec, _level)
+            # Broadcasts sent before the server saw <data> may come first
+            while (_frame := _connection.receive_frame()) is not None:
+                if _frame[2].startswith(b'SERVER:'): return self.display_single_line(_frame[2].decode())
+        except Exception as error: print(f'ERROR: {error}')
+        finally: _connection.close()
 
 
-    def send_file(self, _file_name:str, _file_size:int) -> None:
+    def send_file(self, _connection:Framed_Socket, _file_name:str, _file_size:int, _codec:str=NONE, _level:int=0) -> None:
         with open(self.get_directory() + _file_name , 'rb') as file:
+            if _codec != NONE:
+                _report = Transfer_Report(_codec, _level)
+                for data in iterate_compressed(file, _file_size, _codec, _level, _report):
+                    _connection.send_data(data)
+                    self.display_progress('Sent data', _report.raw_bytes, _file_size)
+                return
             _sent_data = 0
             while _sent_data < _file_size:
-                _data = file.read(1024)
-                self._connection.send(_data)
+                _data = file.read(min(DATA_CHUNK, _file_size - _sent_data))
+                if not _data: break
+                _connection.send_data(_data)
                 _sent_data += len(_data)
                 self.display_progress('Sent data', _sent_data, _file_size)
 
 
+    def send_batch(self, _requests:list) -> None:
+        # Every request gets its position as id; the server answers all of them in one <batch_reply>
+        _batch = [(str(index), request) for index, request in enumerate(_requests, 1)]
+        self._connection.send_command(f'<batch>:{json.dumps(_batch)}')
+
+
+    def send_batch_file(self, _file_name:str) -> None:
+        _path = self.get_directory() + str(_file_name)
+        if not self.check_if_the_file_exists(_path): return print(f'File not found: {_file_name}')
+        with open(_path) as file:
+            self.send_batch([line.strip() for line in file if line.strip()])
+
+
+    def open_parallel_connection(self) -> Framed_Socket:
+        return Framed_Socket(socket.create_connection(self._server_address))
+
+
+    def run_in_parallel(self, _target:callable, _manifest:Chunk_Manifest, _path:str, _indexes:list) -> list:
+        _pending, _failed = queue.Queue(), list()
+        for index in _indexes: _pending.put(index)
+        _threads = [threading.Thread(target=_target, args=(_manifest, _path, _pending, _failed))
+                    for _ in range(min(self.PARALLEL_CONNECTIONS, len(_indexes)))]
+        for thread in _threads: thread.start()
+        for thread in _threads: thread.join()
+        return _failed
+
+
+    @staticmethod
+    def take_next_index(_pending:queue.Queue) -> int | None:
+        try:    return _pending.get_nowait()
+        except queue.Empty: return None
+
+
+    def start_chunked_download(self, _manifest:str) -> None:
+        threading.Thread(target=self.download_in_chunks, args=(Chunk_Manifest.decode(_manifest),)).start()
+
+
+    def download_in_chunks(self, _manifest:Chunk_Manifest) -> None:
+        _path = self.get_directory() + _manifest.name + '.part'
+        Chunk_Manifest.allocate_partial_file(_path, _manifest.size)
+        _verified = _manifest.get_verified_chunks(_path)
+        _missing  = [index for index in range(_manifest.get_chunk_count()) if index not in _verified]
+        _failed   = self.run_in_parallel(self.pull_ranges, _manifest, _path, _missing)
+        if _failed:
+            print(f'\n{len(_failed)} ranges failed ({_manifest.name}), run /pdownl again to resume')
+        else:
+            os.replace(_path, self.get_directory() + _manifest.name)
+            print(f'\nFile received ({_manifest.name}), {len(_verified)} ranges were already here')
+
+
+    def pull_ranges(self, _manifest:Chunk_Manifest, _path:str, _pending:queue.Queue, _failed:list) -> None:
+        _connection = self.open_parallel_connection()
+        try:
+            with open(_path, 'r+b') as file:
+                while (_index := self.take_next_index(_pending)) is not None:
+                    if not self.pull_range(_connection, file, _manifest, _index): _failed.append(_index)
+        except Exception as error:
+            print(f'ERROR: {error}')
+            while (_index := self.take_next_index(_pending)) is not None: _failed.append(_index)
+        finally:
+            _connection.close()
+
+
+    @staticmethod
+    def pull_range(_connection:Framed_Socket, _file:object, _manifest:Chunk_Manifest, _index:int) -> bool:
+        _offset, _length = _manifest.get_range(_index)
+        _connection.send_command(f'<get_range>:{_manifest.name}||{_index}')
+        _hash, _received_data = Chunk_Manifest.new_hash(), 0
+        _file.seek(_offset)
+        while _received_data < _length:
+            _frame = _connection.receive_frame()
+            if _frame is None: raise ConnectionResetError('connection closed during the transfer')
+            _frame_type, _key, _payload = _frame
+            if _frame_type == DATA:
+                _hash.update(_payload)
+                _file.write(_payload)
+                _received_data += len(_payload)
+            elif _key == '<range_error>':
+                print(f'\n{_payload.decode()}')
+                return False
+        return _hash.hexdigest() == _manifest.checksums[_index]
+
+
+    def announce_chunked_upload(self, _file_name:str) -> None:
+        _path = self.get_directory() + str(_file_name)
+        if not self.check_if_the_file_exists(_path): return print(f'File not found: {_file_name}')
+        _manifest = Chunk_Manifest.from_file(_file_name, _path)
+        self._chunked_uploads[_file_name] = _manifest
+        self._connection.send_command(f'<upl_chunks>:{_manifest.encode()}')
+
+
+    def start_chunked_upload(self, _file_name_and_indexes:str) -> None:
+        _file_name, _indexes = _file_name_and_indexes.split('||', 1)
+        _manifest = self._chunked_uploads.pop(_file_name, None)
+        if _manifest is None: return
+        _indexes  = [int(index) for index in _indexes.split(',') if index]
+        threading.Thread(target=self.upload_in_chunks, args=(_manifest, _indexes)).start()
+
+
+    def upload_in_chunks(self, _manifest:Chunk_Manifest, _indexes:list) -> None:
+        _failed = self.run_in_parallel(self.push_ranges, _manifest, self.get_directory() + _manifest.name, _indexes)
+        if _failed: print(f'\n{len(_failed)} ranges failed ({_manifest.name}), run /pupl again to resume')
+        else:       print(f'\nFile sent ({_manifest.name}), {len(_indexes)} ranges transferred')
+
+
+    def push_ranges(self, _manifest:Chunk_Manifest, _path:str, _pending:queue.Queue, _failed:list) -> None:
+        _connection = self.open_parallel_connection()
+        try:
+            with open(_path, 'rb') as file:
+                while (_index := self.take_next_index(_pending)) is not None:
+                    if not self.push_range(_connection, file, _manifest, _index): _failed.append(_index)
+        except Exception as error:
+            print(f'ERROR: {error}')
+            while (_index := self.take_next_index(_pending)) is not None: _failed.append(_index)
+        finally:
+            _connection.close()
+
+
+    @staticmethod
+    def push_range(_connection:Framed_Socket, _file:object, _manifest:Chunk_Manifest, _index:int) -> bool:
+        _offset, _length = _manifest.get_range(_index)
+        _connection.send_command(f'<put_range>:{_manifest.name}||{_index}||{_length}')
+        _connection.send_file(_file, _offset, _length, DATA_CHUNK)
+        while (_frame := _connection.receive_frame()) is not None:
+            _frame_type, _key, _payload = _frame
+            if _key == '<range_ok>': return True
+            if _key == '<range_error>':
+                print(f'\n{_payload.decode()}')
+                return False
+        raise ConnectionResetError('connection closed during the transfer')
+
+
 
 if __name__ == '__main__':
-    client = Client()
+    parser = argparse.ArgumentParser(description='simple_server client')
+    parser.add_argument('--id', type=int, default=None, help='fixed client id with a mailbox: the first run claims it, later runs get its offline messages')
+    arguments = parser.parse_args()
+    client = Client(client_id=arguments.id)
     client.get_request()
@@ -0,0 +1,418 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import asyncio, hashlib, itertools, json, os, threading
+from protocol import Frame_Decoder, COMMAND, DATA, DATA_CHUNK, RECV_SIZE, encode_command, encode_data
+from compression import NONE, Transfer_Report, Decompressing_Writer, iterate_compressed
+
+# Programmatic client: no terminal, no prints. Replies are returned, messages from other clients go to
+# on_message(key, text) and transfers report progress(done_bytes, total_bytes). Both callbacks run on
+# the event loop of the client.
+#
+#   async with Async_Client('localhost', 10000, 4) as client:
+#       await asyncio.gather(client.upload('a.bin'), client.upload('b.bin'), client.list_files())
+#
+#   with Sync_Client('localhost', 10000) as client:
+#       client.download('a.bin', '/tmp/a.bin', progress=print)
+
+
+class Request_Error(Exception):
+    # The server answered, but not with what the call expects; the message is its reply
+    pass
+
+
+
+class Server_Busy(ConnectionRefusedError):
+    def __init__(self, _retry_after:float) -> None:
+        super().__init__(f'server busy, retry after {_retry_after} s')
+        self.retry_after = _retry_after
+
+
+
+def split_reply(_reply:str | None) -> tuple[str | None, str]:
+    _key, _, _text = (_reply or '').partition(':')
+    return (_key or None, _text)
+
+
+def parse_watch_events(_text:str) -> list[tuple[str, str, int | None]]:
+    # Text of a <watch> message -> (event, name, size) tuples; a rescan event carries the count as name
+    _events = list()
+    for line in _text.split('<<SEP>>'):
+        _event, _name, *_size = line.split('||')
+        _events.append((_event, _name, int(_size[0]) if _size else None))
+    return _events
+
+
+async def receive_frame(_reader:asyncio.StreamReader, _decoder:Frame_Decoder) -> tuple[int, str, bytes] | None:
+    while (_frame := _decoder.next_frame()) is None:
+        if not (_data := await _reader.read(RECV_SIZE)): return None
+        _decoder.feed(_data)
+    return _frame
+
+
+
+class Pooled_Connection:
+    # One control connection. Each request goes out as a <batch> of one command, so the id of the
+    # <batch_reply> tells which future it answers and many requests can be in flight at once.
+    # Every other frame is a message for on_message; broadcasts reach every connection of the pool and
+    # are passed on only by the one that takes them.
+    __slots__ = ('_reader', '_writer', '_decoder', '_pending', '_ids', '_task', 'on_message', 'broadcasts', 'client_id')
+
+    def __init__(self, _reader:asyncio.StreamReader, _writer:asyncio.StreamWriter, _on_message:callable=None, _broadcasts:bool=True) -> None:
+        self._reader    = _reader
+        self._writer    = _writer
+        self._decoder   = Frame_Decoder()
+        self._pending   = dict()
+        self._ids       = itertools.count(1)
+        self._task      = None
+        self.on_message = _on_message
+        self.broadcasts = _broadcasts
+        self.client_id  = _writer.get_extra_info('sockname')[1]
+
+
+    @classmethod
+    async def open(cls, _address:tuple[str, int], _on_message:callable=None, _broadcasts:bool=True) -> 'Pooled_Connection':
+        # The reply to an empty batch shows that the server admitted the connection
+        _connection = cls(*await asyncio.open_connection(*_address), _on_message, _broadcasts)
+        try:
+            _connection._writer.write(encode_command('<batch>:[]'))
+            while True:
+                if (_frame := await receive_frame(_connection._reader, _connection._decoder)) is None:
+                    raise ConnectionResetError('connection closed by the server')
+                if _connection.dispatch(*_frame) == 'reply': break
+        except:
+            _connection._writer.close()
+            raise
+        _connection._task = asyncio.ensure_future(_connection.read_frames())
+        return _connection
+
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+
+    async def request(self, _command:str) -> str | None:
+        _id     = str(next(self._ids))
+        _future = self._pending[_id] = asyncio.get_running_loop().create_future()
+        self._writer.write(encode_command(f'<batch>:{json.dumps([[_id, _command]])}'))
+        await self._writer.drain()
+        return await _future
+
+
+    def dispatch(self, _frame_type:int, _key:str, _payload:bytes) -> str | None:
+        if _frame_type != COMMAND: return None
+        _text = _payload.decode(errors='replace')
+        if _key == '<busy>': raise Server_Busy(float(_text.split('||')[0]))
+        if _key == '<batch_reply>':
+            for request_id, reply in json.loads(_text):
+                if (_future := self._pending.pop(request_id, None)) and not _future.done(): _future.set_result(reply)
+            return 'reply'
+        if self.on_message and (self.broadcasts or not _text.partition(' ')[0].endswith('BROAD>')): self.on_message(_key, _text)
+        return None
+
+
+    async def read_frames(self) -> None:
+        _error = ConnectionResetError('connection closed by the server')
+        try:
+            while (_frame := await receive_frame(self._reader, self._decoder)) is not None:
+                if _frame[1] == '<close>': break
+                self.dispatch(*_frame)
+        except Exception as error:
+            _error = error
+        finally:
+            for future in self._pending.values():
+                if not future.done(): future.set_exception(_error)
+            self._pending.clear()
+            self._writer.close()
+
+
+    async def close(self) -> None:
+        try:
+            self._writer.write(encode_command('/exit'))
+            await self._writer.drain()
+        except ConnectionError: pass
+        self._writer.close()
+        if self._task: await asyncio.gather(self._task, return_exceptions=True)
+
+
+
+class Async_Client:
+    # A pool of persistent control connections; each call goes to the one with the fewest requests in
+    # flight. File bytes use a data connection per transfer, opened with the ticket the server issued.
+    # Each pooled connection is a client of its own on the server; client_id is the first one's.
+    __slots__ = ('_address', '_size', '_connections', 'on_message')
+    CONNECT_ATTEMPTS = 5
+
+    def __init__(self, _host:str='localhost', _port:int=10000, _connections:int=4, _on_message:callable=None) -> None:
+        self._address     = (_host, _port)
+        self._size        = max(1, _connections)
+        self._connections = list()
+        self.on_message   = _on_message
+
+
+    async def __aenter__(self) -> 'Async_Client':
+        return await self.connect()
+
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+
+    @property
+    def client_id(self) -> int | None:
+        return self._connections[0].client_id if self._connections else None
+
+
+    async def connect(self) -> 'Async_Client':
+        self._connections = list(await asyncio.gather(*(self.open_connection(index == 0) for index in range(self._size))))
+        return self
+
+
+    async def open_connection(self, _broadcasts:bool) -> Pooled_Connection:
+        # A refused connection is tried again after the delay the server asked for
+        for attempt in range(1, self.CONNECT_ATTEMPTS + 1):
+            try:    return await Pooled_Connection.open(self._address, self.on_message, _broadcasts)
+            except Server_Busy as busy:
+                if attempt == self.CONNECT_ATTEMPTS: raise
+                await asyncio.sleep(busy.retry_after)
+
+
+    async def close(self) -> None:
+        await asyncio.gather(*(connection.close() for connection in self._connections), return_exceptions=True)
+        self._connections = list()
+
+
+    async def request(self, _command:str) -> tuple[str | None, str]:
+        if not self._connections: raise ConnectionError('the client is not connected')
+        return split_reply(await min(self._connections, key=lambda connection: connection.in_flight).request(_command))
+
+
+    async def request_server_message(self, _command:str, _expected:str) -> str:
+        _key, _text = await self.request(_command)
+        if _expected not in _text: raise Request_Error(_text or f'no reply to {_command}')
+        return _text
+
+
+    async def list_files(self, _prefix:str='', _page:int=None) -> list[tuple[str, int]]:
+        # (name, size) pairs of one page, or of every page when no page is given
+        _files, _current = list(), _page or 1
+        while True:
+            _key, _text = await self.request(f'/files:{_prefix}||{_current}')
+            if _key != '<mult>': raise Request_Error(_text)
+            *_lines, _footer = _text.split('<<SEP>>')
+            for line in _lines:
+                _size, _, _name = line.partition(' - ')
+                _files.append((_name, int(_size)))
+            _last_page = int(_footer.split('/', 1)[1].split(' ', 1)[0])
+            if _page or _current >= _last_page: return _files
+            _current += 1
+
+
+    async def delete(self, _file_name:str) -> str:
+        return await self.request_server_message(f'/delf:{_file_name}', 'deleted')
+
+
+    async def watch(self, _prefix:str='') -> str:
+        # The subscription belongs to the first connection, which lives as long as the client; the
+        # events reach on_message('<watch>', text), see parse_watch_events()
+        if not self._connections: raise ConnectionError('the client is not connected')
+        return split_reply(await self._connections[0].request(f'/watch:{_prefix}'))[1]
+
+
+    async def unwatch(self) -> str:
+        if not self._connections: raise ConnectionError('the client is not connected')
+        return split_reply(await self._connections[0].request('/unwatch'))[1]
+
+
+    async def send_message(self, _client_id:int, _message:str) -> str | None:
+        # None when the message was delivered, the notice of the server otherwise (stored for later, ...)
+        _key, _text = await self.request(f'/msg:{_client_id}:{_message}')
+        if 'invalid' in _text or 'can not' in _text: raise Request_Error(_text)
+        return _text or None
+
+
+    async def broadcast(self, _message:str) -> str | None:
+        _key, _text = await self.request(f'/bmsg:{_message}')
+        return _text or None
+
+
+    async def open_data_channel(self, _ticket:str) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        _reader, _writer = await asyncio.open_connection(*self._address)
+        _writer.write(encode_command(f'<data>:{_ticket}'))
+        return (_reader, _writer)
+
+
+    async def upload(self, _path:str, _file_name:str=None, _codec:str=None, _level:int=None, progress:callable=None) -> str:
+        # Returns the summary of the server, like "file received (zlib 6: 11.6 MB -> 1.0 MB, ...)"
+        _file_name = _file_name or os.path.basename(_path)
+        _file_size = os.path.getsize(_path)
+        _checksum  = await asyncio.to_thread(self.get_file_checksum, _path)
+        _options   = ''.join(f'||{option}' for option in (_codec, _level) if option is not None)
+        _key, _text = await self.request(f'<file_inf>:{_file_name}||{_file_size}||{_checksum}{_options}')
+        if _key != '<send_file>': return self.check_upload_reply(_text)
+        _, _, _codec, _level, _ticket = _text.split('||')
+        _reader, _writer = await self.open_data_channel(_ticket)
+        try:
+            with open(_path, 'rb') as file:
+                await self.send_file(_writer, file, _file_size, _codec, int(_level), progress)
+            # Broadcasts sent before the server saw <data> may come first
+            _decoder = Frame_Decoder()
+            while (_frame := await receive_frame(_reader, _decoder)) is not None:
+                if _frame[1] == '<busy>': raise Server_Busy(float(_frame[2].decode().split('||')[0]))
+                if _frame[2].startswith(b'SERVER: '): return self.check_upload_reply(_frame[2].decode())
+            raise ConnectionResetError('connection closed during the upload')
+        finally:
+            _writer.close()
+
+
+    @staticmethod
+    def check_upload_reply(_text:str) -> str:
+        if 'file received' not in _text: raise Request_Error(_text)
+        return _text.removeprefix('SERVER: ')
+
+
+    @staticmethod
+    async def send_file(_writer:asyncio.StreamWriter, _file:object, _file_size:int, _codec:str, _level:int, _progress:callable) -> None:
+        if _codec != NONE:
+            _report = Transfer_Report(_codec, _level)
+            for data in iterate_compressed(_file, _file_size, _codec, _level, _report):
+                _writer.write(encode_data(data))
+                await _writer.drain()
+                if _progress: _progress(_report.raw_bytes, _file_size)
+            return
+        _sent_data = 0
+        while _sent_data < _file_size:
+            if not (_data := _file.read(min(DATA_CHUNK, _file_size - _sent_data))): raise ValueError('the file got shorter during the upload')
+            _writer.write(encode_data(_data))
+            await _writer.drain()
+            _sent_data += len(_data)
+            if _progress: _progress(_sent_data, _file_size)
+
+
+    async def download(self, _file_name:str, _path:str=None, _codec:str=None, _level:int=None, progress:callable=None) -> Transfer_Report:
+        # The file is written next to its final path and renamed when complete
+        _path    = _path or _file_name
+        _options = ''.join(f'||{option}' for option in (_codec, _level) if option is not None)
+        _key, _text = await self.request(f'/downl:{_file_name}{_options}')
+        if _key != '<confirm>': raise Request_Error(_text)
+        _, _file_size, _codec, _level, _ticket = _text.split('||')
+        _file_size, _report = int(_file_size), Transfer_Report(_codec, int(_level))
+        _reader, _writer = await self.open_data_channel(_ticket)
+        try:
+            with open(_path + '.part', 'wb') as file:
+                await self.write_file(_reader, file, _file_size, _report, progress)
+        except:
+            if os.path.exists(_path + '.part'): os.remove(_path + '.part')
+            raise
+        finally:
+            _writer.close()
+        os.replace(_path + '.part', _path)
+        return _report
+
+
+    @staticmethod
+    async def write_file(_reader:asyncio.StreamReader, _file:object, _file_size:int, _report:Transfer_Report, _progress:callable) -> None:
+        _decoder = Frame_Decoder()
+        _writer  = Decompressing_Writer(_file, _report.codec, _report, _file_size) if _report.codec != NONE else None
+        while _writer or _report.raw_bytes < _file_size:
+            if (_frame := await receive_frame(_reader, _decoder)) is None: raise ConnectionResetError('connection closed during the download')
+            _frame_type, _key, _payload = _frame
+            if _key == '<busy>': raise Server_Busy(float(_payload.decode().split('||')[0]))
+            if _frame_type != DATA: continue
+            if _writer:
+                if not _writer.write(_payload): return _writer.finish()
+            else:
+                _file.write(_payload)
+                _report.raw_bytes += len(_payload)
+            if _progress: _progress(_report.raw_bytes, _file_size)
+        _report.wire_bytes = _report.raw_bytes
+
+
+    @staticmethod
+    def get_file_checksum(_path:str) -> str:
+        # Lets a server with content-addressed storage skip content it already has
+        _hash = hashlib.sha256()
+        with open(_path, 'rb') as file:
+            while (_data := file.read(1024 * 1024)): _hash.update(_data)
+        return _hash.hexdigest()
+
+
+
+class Sync_Client:
+    # Blocking calls for scripts: the async client runs on an event loop in a background thread.
+    # Calls from several threads run in parallel over the pool.
+    __slots__ = ('_loop', '_thread', '_client')
+
+    def __init__(self, _host:str='localhost', _port:int=10000, _connections:int=4, _on_message:callable=None) -> None:
+        self._loop   = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._client = Async_Client(_host, _port, _connections, _on_message)
+        try:    self.call(self._client.connect())
+        except:
+            self.stop_loop()
+            raise
+
+
+    def __enter__(self) -> 'Sync_Client':
+        return self
+
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+    @property
+    def client_id(self) -> int | None:
+        return self._client.client_id
+
+
+    def call(self, _coroutine:object) -> object:
+        return asyncio.run_coroutine_threadsafe(_coroutine, self._loop).result()
+
+
+    def list_files(self, _prefix:str='', _page:int=None) -> list[tuple[str, int]]:
+        return self.call(self._client.list_files(_prefix, _page))
+
+
+    def delete(self, _file_name:str) -> str:
+        return self.call(self._client.delete(_file_name))
+
+
+    def watch(self, _prefix:str='') -> str:
+        return self.call(self._client.watch(_prefix))
+
+
+    def unwatch(self) -> str:
+        return self.call(self._client.unwatch())
+
+
+    def send_message(self, _client_id:int, _message:str) -> str | None:
+        return self.call(self._client.send_message(_client_id, _message))
+
+
+    def broadcast(self, _message:str) -> str | None:
+        return self.call(self._client.broadcast(_message))
+
+
+    def upload(self, _path:str, _file_name:str=None, _codec:str=None, _level:int=None, progress:callable=None) -> str:
+        return self.call(self._client.upload(_path, _file_name, _codec, _level, progress))
+
+
+    def download(self, _file_name:str, _path:str=None, _codec:str=None, _level:int=None, progress:callable=None) -> Transfer_Report:
+        return self.call(self._client.download(_file_name, _path, _codec, _level, progress))
+
+
+    def close(self) -> None:
+        try:     self.call(self._client.close())
+        finally: self.stop_loop()
+
+
+    def stop_loop(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
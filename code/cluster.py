@@ -0,0 +1,133 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import multiprocessing, threading, socket, signal, sys
+
+
+class Cluster_Link:
+    # Worker side of the cross-process channel. Local logins and logouts are published to the master,
+    # which tells every other worker, so each worker knows which client ids live elsewhere. Private
+    # messages for those ids and broadcasts go through the master as already encoded frames, and
+    # bandwidth changes made on one worker are applied by all of them. When a client asks for its
+    # offline messages, every worker sends the ones it stored to the worker the client is on.
+    __slots__ = ('worker_id', '_to_master', '_from_master', '_remote_clients', '_lock')
+
+    def __init__(self, _worker_id:int, _to_master:object, _from_master:object) -> None:
+        self.worker_id       = _worker_id
+        self._to_master      = _to_master
+        self._from_master    = _from_master
+        self._remote_clients = dict()
+        self._lock           = threading.Lock()
+
+
+    def start(self, _server:object) -> None:
+        threading.Thread(target=self.receive_from_master, args=(_server,), daemon=True).start()
+
+
+    def receive_from_master(self, _server:object) -> None:
+        while True:
+            _kind, *_arguments = self._from_master.get()
+            match _kind:
+                case 'join':
+                    with self._lock: self._remote_clients[_arguments[0]] = _arguments[1]
+                case 'leave':
+                    with self._lock: self._remote_clients.pop(_arguments[0], None)
+                case 'deliver':
+                    _server.deliver_from_cluster(*_arguments)
+                case 'broadcast':
+                    _server.deliver_from_cluster(None, *_arguments)
+                case 'bandwidth':
+                    _server.configure_bandwidth(*_arguments, True)
+                case 'inbox':
+                    _server.forward_offline_messages(*_arguments)
+                case 'reload':
+                    _server.reload_commands(True)
+
+
+    def publish(self, _kind:str, *_arguments) -> None:
+        self._to_master.put((_kind, self.worker_id, *_arguments))
+
+
+    def is_remote(self, _client_id:int) -> bool:
+        with self._lock:
+            return _client_id in self._remote_clients
+
+
+    def count_remote_clients(self) -> int:
+        with self._lock:
+            return len(self._remote_clients)
+
+
+
+def run_worker(_server_class:type, _worker_id:int, _settings:dict, _to_master:object, _from_master:object, _server_socket:object) -> None:
+    for name, value in _settings.items():
+        setattr(_server_class, name, value)
+    _server_class.WORKER_ID = _worker_id
+    _server = _server_class(_server_socket)
+    _server.join_cluster(Cluster_Link(_worker_id, _to_master, _from_master))
+    _server.receive_client()
+
+
+
+class Cluster:
+    # Runs N worker processes on the same port. With SO_REUSEPORT every worker binds its own socket and the
+    # kernel spreads connections; otherwise the master binds once and hands the socket to the workers.
+    # The master process only relays events between workers and keeps the client id -> worker directory.
+
+    def __init__(self, _server_class:type, _workers:int, _settings:dict) -> None:
+        self._server_class = _server_class
+        self._workers      = _workers
+        self._settings     = _settings
+        self._directory    = dict()
+        self._settings['WORKER_COUNT'] = _workers
+
+
+    def create_shared_socket(self) -> object | None:
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self._settings['REUSE_PORT'] = True
+            return None
+        return self._server_class.create_server_socket()
+
+
+    def run(self) -> None:
+        # Before any worker can start an upload
+        self._server_class.remove_partial_uploads()
+        _inbound   = multiprocessing.Queue()
+        _outbound  = [multiprocessing.Queue() for _ in range(self._workers)]
+        _socket    = self.create_shared_socket()
+        _processes = [multiprocessing.Process(target=run_worker, daemon=True,
+                                              args=(self._server_class, index, self._settings, _inbound, _outbound[index], _socket))
+                      for index in range(self._workers)]
+        for process in _processes: process.start()
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        print(f'CLUSTER RUNNING: {self._workers} workers')
+        try:
+            while True: self.relay(_outbound, *_inbound.get())
+        except KeyboardInterrupt:
+            print('Cluster stopped')
+        finally:
+            for process in _processes: process.terminate()
+
+
+    def relay(self, _outbound:list, _kind:str, _worker_id:int, *_arguments) -> None:
+        match _kind:
+            case 'join':
+                self._directory[_arguments[0]] = _worker_id
+                self.send_to_others(_outbound, _worker_id, ('join', _arguments[0], _worker_id))
+            case 'leave':
+                if self._directory.get(_arguments[0]) == _worker_id: del self._directory[_arguments[0]]
+                self.send_to_others(_outbound, _worker_id, ('leave', _arguments[0]))
+            case 'private':
+                _target_worker = self._directory.get(_arguments[0])
+                if _target_worker is not None: _outbound[_target_worker].put(('deliver', *_arguments))
+            case 'broadcast' | 'bandwidth' | 'inbox' | 'reload':
+                self.send_to_others(_outbound, _worker_id, (_kind, *_arguments))
+
+
+    @staticmethod
+    def send_to_others(_outbound:list, _worker_id:int, _message:tuple) -> None:
+        for index, queue in enumerate(_outbound):
+            if index != _worker_id: queue.put(_message)
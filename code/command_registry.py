@@ -0,0 +1,148 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import importlib.util, os, sys, threading
+from metrics import log
+
+PLUGIN_PACKAGE = 'simple_server_plugins'
+
+
+class Arguments:
+    # Declared argument format of a command: fields separated by '||', each converted by its type.
+    # Fields after the required ones may be left out and get their default. A ValueError becomes an
+    # "invalid arguments" reply instead of reaching the strategy.
+    __slots__ = ('_fields', '_required', 'usage')
+
+    def __init__(self, *_fields:tuple, _required:int=None, _usage:str='') -> None:
+        # _fields: (name, type) or (name, type, default)
+        self._fields   = _fields
+        self._required = len(_fields) if _required is None else _required
+        self.usage     = _usage or '||'.join(field[0] for field in _fields)
+
+
+    def parse(self, _arguments:str | None) -> tuple:
+        _values = _arguments.split('||', len(self._fields) - 1) if _arguments else []
+        if len(_values) < self._required: raise ValueError(f'expected {self.usage}')
+        _parsed = list()
+        for index, field in enumerate(self._fields):
+            if index >= len(_values):
+                _parsed.append(field[2] if len(field) > 2 else None)
+                continue
+            try:    _parsed.append(field[1](_values[index]))
+            except (TypeError, ValueError): raise ValueError(f'{field[0]} is not a valid {field[1].__name__}, expected {self.usage}')
+        return tuple(_parsed)
+
+
+
+class Route:
+    # What a command key compiles to: execute() runs the argument parser and the strategy, handle() also
+    # hands the result to the forwarder of the strategy's flag, bound once at compile time
+    __slots__ = ('key', 'strategy', 'execute', 'forward', 'handle')
+
+    def __init__(self, _key:str, _strategy:object, _forwarders:dict) -> None:
+        _parse    = _strategy.ARGUMENTS.parse if _strategy.ARGUMENTS else None
+        _run      = _strategy.execute
+        _flag     = _strategy.FLAG
+        _forward  = getattr(_strategy, 'forward', None) or _forwarders.get(_flag) or (lambda *_: None)
+        _fallback = lambda _server, _client_socket, _data, _flag: _forwarders.get(_flag, lambda *_: None)(_server, _client_socket, _data)
+
+        def execute(_server:object, _client_port:int, _arguments:str | None) -> tuple[str, object]:
+            if _parse:
+                try:    _arguments = _parse(_arguments)
+                except ValueError as error: return ('svc', f'<single>:SERVER: Invalid arguments for {_key}: {error}')
+            return _run(_server, _client_port, _arguments)
+
+        def handle(_server:object, _client_socket:object, _client_port:int, _arguments:str | None) -> tuple[str, object]:
+            _result_flag, _data = execute(_server, _client_port, _arguments)
+            if _result_flag == _flag: return (_flag, _forward(_server, _client_socket, _data))
+            return (_result_flag, _fallback(_server, _client_socket, _data, _result_flag))
+
+        self.key      = _key
+        self.strategy = _strategy
+        self.execute  = execute
+        self.forward  = _forward
+        self.handle   = handle
+
+
+
+class Command_Registry:
+    # Strategy subclasses with KEYS register themselves when their module is imported. Plugin modules
+    # (every .py file of the plugin directory) are imported again by reload_plugins(): the strategies
+    # of a module that fails to import stay as they were, those of a removed file go away. A plugin
+    # key overrides the built-in one of the same name. compile() builds the routes for a server,
+    # which swaps its table in one assignment, so requests already running finish on the old one.
+    __slots__ = ('_strategies', '_built_in', '_plugins', '_lock')
+
+    def __init__(self) -> None:
+        self._strategies = dict()
+        self._built_in   = dict()
+        self._plugins    = dict()
+        self._lock       = threading.RLock()
+
+
+    def register(self, _strategy_class:type) -> None:
+        with self._lock:
+            _strategy = _strategy_class()
+            for key in _strategy_class.KEYS:
+                if not self.is_plugin(_strategy): self._built_in[key] = _strategy
+                elif key in self._built_in: log.info(f'{key} replaced by {_strategy_class.__module__}')
+                self._strategies[key] = _strategy
+
+
+    @staticmethod
+    def is_plugin(_strategy:object) -> bool:
+        return type(_strategy).__module__.startswith(PLUGIN_PACKAGE + '.')
+
+
+    def compile(self, _forwarders:dict) -> dict:
+        with self._lock:
+            return {key: Route(key, strategy, _forwarders) for key, strategy in self._strategies.items()}
+
+
+    def reload_plugins(self, _directory:str) -> list:
+        # One line per plugin file: loaded, or the error that kept the previous version
+        if not os.path.isdir(_directory): return []
+        with self._lock:
+            _files  = sorted(name for name in os.listdir(_directory) if name.endswith('.py') and not name.startswith('_'))
+            _report = [self.load_plugin(os.path.join(_directory, name)) for name in _files]
+            for module in set(self._plugins) - {f'{PLUGIN_PACKAGE}.{name[:-3]}' for name in _files}:
+                self.unload_plugin_locked(module)
+                _report.append(f'{module.split(".")[-1]}: removed')
+            return _report
+
+
+    def load_plugin(self, _path:str) -> str:
+        _name     = f'{PLUGIN_PACKAGE}.{os.path.basename(_path)[:-3]}'
+        _modified = os.stat(_path).st_mtime_ns
+        if self._plugins.get(_name) == _modified: return f'{_name.split(".")[-1]}: unchanged'
+        _saved, _saved_plugins, _previous_module = dict(self._strategies), dict(self._plugins), sys.modules.get(_name)
+        self.unload_plugin_locked(_name)
+        try:
+            _specification = importlib.util.spec_from_file_location(_name, _path)
+            _module        = importlib.util.module_from_spec(_specification)
+            sys.modules[_name] = _module
+            _specification.loader.exec_module(_module)
+        except Exception as error:
+            self._strategies = _saved
+            if _previous_module: sys.modules[_name] = _previous_module
+            else:                sys.modules.pop(_name, None)
+            if _name in _saved_plugins: self._plugins[_name] = _saved_plugins[_name]
+            log.warning(f'Plugin {_path} not loaded: {error!r}')
+            return f'{_name.split(".")[-1]}: error, previous version kept ({error!r})'
+        self._plugins[_name] = _modified
+        _keys = sorted(key for key, strategy in self._strategies.items() if type(strategy).__module__ == _name)
+        return f'{_name.split(".")[-1]}: {", ".join(_keys) or "no commands"}'
+
+
+    def unload_plugin_locked(self, _name:str) -> None:
+        # Built-in strategies that a plugin had overridden come back
+        self._plugins.pop(_name, None)
+        for key in [key for key, strategy in self._strategies.items() if type(strategy).__module__ == _name]:
+            if key in self._built_in: self._strategies[key] = self._built_in[key]
+            else:                     del self._strategies[key]
+
+
+COMMANDS = Command_Registry()
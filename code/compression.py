@@ -0,0 +1,121 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import zlib, lzma, os, time
+
+# A compressed transfer is a sequence of DATA frames holding the compressed stream, closed by an empty DATA frame
+NONE   = 'none'
+LEVELS = {'zlib': range(1, 10), 'lzma': range(0, 10)}
+COMPRESSED_EXTENSIONS = {
+    '.gz', '.tgz', '.bz2', '.xz', '.lzma', '.zst', '.zip', '.7z', '.rar', '.jar', '.apk',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.ogg', '.flac', '.mp4', '.mkv', '.webm', '.pdf'
+}
+
+
+def negotiate_compression(_file_name:str, _codec:str=NONE, _level:str='6') -> tuple[str, int]:
+    if _codec not in LEVELS or os.path.splitext(_file_name)[1].lower() in COMPRESSED_EXTENSIONS: return (NONE, 0)
+    try:    _level = int(_level)
+    except: _level = 6
+    _levels = LEVELS[_codec]
+    return (_codec, min(max(_level, _levels.start), _levels.stop - 1))
+
+
+def create_compressor(_codec:str, _level:int) -> object:
+    if _codec == 'zlib': return zlib.compressobj(_level)
+    return lzma.LZMACompressor(preset=_level)
+
+
+def create_decompressor(_codec:str) -> object:
+    if _codec == 'zlib': return zlib.decompressobj()
+    return lzma.LZMADecompressor()
+
+
+class Transfer_Report:
+    __slots__ = ('codec', 'level', 'raw_bytes', 'wire_bytes', 'started_at')
+
+    def __init__(self, _codec:str=NONE, _level:int=0) -> None:
+        self.codec      = _codec
+        self.level      = _level
+        self.raw_bytes  = 0
+        self.wire_bytes = 0
+        self.started_at = time.perf_counter()
+
+
+    def describe(self) -> str:
+        _seconds = max(time.perf_counter() - self.started_at, 1e-9)
+        _ratio   = self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+        _codec   = f'{self.codec} {self.level}' if self.codec != NONE else NONE
+        return (f'{_codec}: {self.raw_bytes / 1048576:.1f} MB -> {self.wire_bytes / 1048576:.1f} MB, '
+                f'ratio {_ratio:.1f}x, {self.raw_bytes / 1048576 / _seconds:.1f} MB/s')
+
+
+def iterate_compressed(_file:object, _file_size:int, _codec:str, _level:int, _report:Transfer_Report, _chunk_size:int=1024 * 1024):
+    _compressor = create_compressor(_codec, _level)
+    while _report.raw_bytes < _file_size:
+        _data = _file.read(min(_chunk_size, _file_size - _report.raw_bytes))
+        if not _data: raise ConnectionResetError('file changed size during the transfer')
+        _report.raw_bytes += len(_data)
+        if (_output := _compressor.compress(_data)):
+            _report.wire_bytes += len(_output)
+            yield _output
+    if (_output := _compressor.flush()):
+        _report.wire_bytes += len(_output)
+        yield _output
+    yield b''
+
+
+
+class Decompressing_Writer:
+    # Output is produced at most CHUNK_SIZE bytes at a time and checked against the declared size, so a
+    # small frame of a highly compressed stream can neither fill the memory nor write past the file.
+    # write() takes a whole frame; the event loop feeds a frame and runs write_chunk() in a thread.
+    __slots__ = ('_file', '_decompressor', '_report', '_file_size', '_input', '_has_tail')
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, _file:object, _codec:str, _report:Transfer_Report, _file_size:int) -> None:
+        self._file         = _file
+        self._decompressor = create_decompressor(_codec)
+        self._report       = _report
+        self._file_size    = _file_size
+        self._input        = b''
+        self._has_tail     = hasattr(self._decompressor, 'unconsumed_tail')
+
+
+    def write(self, _data:bytes) -> bool:
+        if not self.feed(_data): return False
+        while self.write_chunk(): pass
+        return True
+
+
+    def feed(self, _data:bytes) -> bool:
+        # False at the empty frame that ends the stream
+        if not _data: return False
+        self._report.wire_bytes += len(_data)
+        self._input = _data
+        return True
+
+
+    def write_chunk(self) -> bool:
+        # True when a chunk was written and more may follow
+        if self._decompressor.eof: return False
+        if self._has_tail:
+            if not self._input: return False
+            _output     = self._decompressor.decompress(self._input, self.CHUNK_SIZE)
+            self._input = self._decompressor.unconsumed_tail
+        else:
+            if not self._input and self._decompressor.needs_input: return False
+            _output     = self._decompressor.decompress(self._input, self.CHUNK_SIZE)
+            self._input = b''
+        self._report.raw_bytes += len(_output)
+        if self._report.raw_bytes > self._file_size:
+            raise ValueError(f'compressed stream is larger than the declared {self._file_size} bytes')
+        if _output: self._file.write(_output)
+        return bool(_output) or bool(self._input)
+
+
+    def finish(self) -> None:
+        if not self._decompressor.eof or self._report.raw_bytes != self._file_size:
+            raise ValueError(f'compressed stream ended after {self._report.raw_bytes} of {self._file_size} bytes')
@@ -0,0 +1,105 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import os, threading
+from upload_pipeline import sync_directory
+
+
+class Content_Store:
+    # Deduplicating storage: each distinct content is kept once in .blobs/<hash[:2]>/<hash> and every
+    # file name in the storage directory is a hard link to its blob. The link count of a blob is its
+    # reference count, so deleting the last name that points to a blob deletes the blob too.
+    # With sync the directories are synced after every rename and new blob link.
+    __slots__ = ('_directory', '_blob_directory', '_blobs', '_lock', '_sync')
+    BLOB_DIRECTORY = '.blobs'
+
+    def __init__(self, _directory:str, _sync:bool=False) -> None:
+        self._directory      = _directory
+        self._blob_directory = os.path.join(_directory, self.BLOB_DIRECTORY)
+        self._blobs          = dict()
+        self._lock           = threading.Lock()
+        self._sync           = _sync
+
+
+    def load(self) -> None:
+        os.makedirs(self._blob_directory, exist_ok=True)
+        for root, _, files in os.walk(self._blob_directory):
+            for checksum in files:
+                _path = os.path.join(root, checksum)
+                _status = os.stat(_path)
+                if _status.st_nlink > 1: self._blobs[_status.st_ino] = checksum
+                else: os.remove(_path)
+
+
+    def get_blob_path(self, _checksum:str) -> str:
+        return os.path.join(self._blob_directory, _checksum[:2], _checksum)
+
+
+    def get_blob_size(self, _checksum:str) -> int | None:
+        try:    return os.path.getsize(self.get_blob_path(_checksum))
+        except OSError: return None
+
+
+    def link(self, _file_name:str, _checksum:str) -> bool:
+        with self._lock:
+            return self.link_locked(_file_name, _checksum)
+
+
+    def link_locked(self, _file_name:str, _checksum:str) -> bool:
+        _temporary_path = f'{self._directory}.{_file_name}.link'
+        try:    os.link(self.get_blob_path(_checksum), _temporary_path)
+        except FileNotFoundError: return False
+        self.replace_locked(_temporary_path, _file_name)
+        return True
+
+
+    def replace(self, _temporary_path:str, _file_name:str) -> None:
+        # The name moves to the new file in one rename, so it never disappears for a reader
+        with self._lock:
+            self.replace_locked(_temporary_path, _file_name)
+
+
+    def replace_locked(self, _temporary_path:str, _file_name:str) -> None:
+        try:    _status = os.stat(self._directory + _file_name)
+        except FileNotFoundError: _status = None
+        os.replace(_temporary_path, self._directory + _file_name)
+        if self._sync: sync_directory(self._directory)
+        if _status: self.forget_locked(_status.st_ino)
+
+
+    def absorb(self, _file_name:str, _checksum:str) -> None:
+        _path = self._directory + _file_name
+        with self._lock:
+            # Checked under the lock: an identical upload may have created the blob since the caller looked
+            if self.link_locked(_file_name, _checksum): return
+            _blob_path = self.get_blob_path(_checksum)
+            os.makedirs(os.path.dirname(_blob_path), exist_ok=True)
+            os.link(_path, _blob_path)
+            if self._sync: sync_directory(os.path.dirname(_blob_path))
+            self._blobs[os.stat(_blob_path).st_ino] = _checksum
+
+
+    def release(self, _file_name:str) -> bool:
+        with self._lock:
+            return self.release_locked(_file_name)
+
+
+    def release_locked(self, _file_name:str) -> bool:
+        _path = self._directory + _file_name
+        try:    _status = os.stat(_path)
+        except FileNotFoundError: return False
+        os.remove(_path)
+        self.forget_locked(_status.st_ino)
+        return True
+
+
+    def forget_locked(self, _inode:int) -> None:
+        # The blob goes with the last name that links it
+        _checksum = self._blobs.get(_inode)
+        if _checksum and os.stat(self.get_blob_path(_checksum)).st_nlink == 1:
+            os.remove(self.get_blob_path(_checksum))
+            del self._blobs[_inode]
+
@@ -0,0 +1,71 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import base64, hashlib, hmac, json, secrets, threading, time
+
+
+class Data_Channel_MixIn:
+    # File bytes travel on their own connection, so the control connection of a client keeps receiving
+    # messages and can start other transfers. /downl and /upl answer with a ticket; the client opens a
+    # new connection and sends <data>:ticket as its first command. The ticket is signed with a secret
+    # shared by the worker processes, so any worker can serve it. It names the client, the transfer and
+    # the file, expires after TICKET_SECONDS and is accepted once per process.
+    DATA_CHANNEL_SECRET = None
+    TICKET_SECONDS      = 30
+    REDEEMED_TICKETS    = dict()
+    TICKET_LOCK         = threading.Lock()
+
+    @classmethod
+    def get_data_channel_secret(cls) -> bytes:
+        if cls.DATA_CHANNEL_SECRET is None: Data_Channel_MixIn.DATA_CHANNEL_SECRET = secrets.token_bytes(32)
+        return cls.DATA_CHANNEL_SECRET
+
+
+    @classmethod
+    def sign_ticket(cls, _body:str) -> str:
+        return hmac.new(cls.get_data_channel_secret(), _body.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+    def issue_ticket(self, _kind:str, _client_port:int, _file_information:tuple) -> str:
+        # The data connection that redeems the ticket is admitted even when the connection limits are reached
+        _ticket = [_kind, _client_port, list(_file_information), time.time() + self.TICKET_SECONDS, secrets.token_hex(8)]
+        _body   = base64.urlsafe_b64encode(json.dumps(_ticket).encode()).decode()
+        if (_session := self._clients.get(_client_port)): self._admission.expect(_session.address[0], self.TICKET_SECONDS)
+        return f'{_body}.{self.sign_ticket(_body)}'
+
+
+    @classmethod
+    def check_ticket(cls, _ticket:str) -> tuple[str, int, tuple] | str:
+        _body, _, _signature = str(_ticket).partition('.')
+        if not hmac.compare_digest(cls.sign_ticket(_body), _signature): return 'invalid ticket'
+        _kind, _client_port, _file_information, _expires_at, _ = json.loads(base64.urlsafe_b64decode(_body))
+        _now = time.time()
+        if _now > _expires_at: return 'expired ticket'
+        with cls.TICKET_LOCK:
+            if _signature in cls.REDEEMED_TICKETS: return 'ticket already used'
+            for signature, expires_at in list(cls.REDEEMED_TICKETS.items()):
+                if expires_at < _now: del cls.REDEEMED_TICKETS[signature]
+            cls.REDEEMED_TICKETS[_signature] = _expires_at
+        return (_kind, _client_port, tuple(_file_information))
+
+
+    def open_data_channel(self, _client_port:int, _ticket:str) -> tuple[str, tuple] | str:
+        # The connection stops being a client (no messages, no /msg target) and draws from the bandwidth of its owner
+        try:    _result = self.check_ticket(_ticket)
+        except (ValueError, TypeError): _result = 'invalid ticket'
+        if isinstance(_result, str): return f'<single>:SERVER: Data channel refused: {_result}'
+        _kind, _owner, _file_information = _result
+        if (_session := self._clients.get(_client_port)):
+            self.remove_client_from_the_list(_session.address)
+            _session.socket.limiter = self._bandwidth.share_limiter(_owner)
+        return (_kind, _file_information)
+
+
+    def serve_data_channel(self, _client_socket:object, _transfer:tuple[str, tuple] | str) -> object:
+        if isinstance(_transfer, str): return self.send_message(_client_socket, _transfer)
+        _kind, _file_information = _transfer
+        if _kind == 'downl': return self.send_file_to_client(_client_socket, _file_information)
+        return self.receive_file_from_client(_client_socket, _file_information)
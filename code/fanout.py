@@ -0,0 +1,103 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import threading, socket
+from collections import deque
+
+DROP         = 'drop'
+DISCONNECT   = 'disconnect'
+BACKPRESSURE = 'backpressure'
+POLICIES     = (DROP, DISCONNECT, BACKPRESSURE)
+
+
+class Outbound_Queue:
+    # Bounded queue of encoded frames for one client, drained by its own writer thread, so a
+    # client that stops reading only fills its own queue. When the queue is full the policy decides:
+    # drop the frame, disconnect the client or make the producer wait (up to timeout seconds).
+    __slots__ = ('_socket', '_frames', '_condition', '_closed', 'max_bytes', 'policy', 'timeout',
+                 'depth', 'high_water', 'sent', 'sent_bytes', 'dropped')
+
+    def __init__(self, _socket:object, _max_bytes:int, _policy:str=DROP, _timeout:float=5.0) -> None:
+        self._socket    = _socket
+        self._frames    = deque()
+        self._condition = threading.Condition()
+        self._closed    = False
+        self.max_bytes  = _max_bytes
+        self.policy     = _policy
+        self.timeout    = _timeout
+        self.depth      = 0
+        self.high_water = 0
+        self.sent       = 0
+        self.sent_bytes = 0
+        self.dropped    = 0
+
+
+    @property
+    def congested(self) -> bool:
+        return self.depth >= self.max_bytes
+
+
+    def start(self) -> 'Outbound_Queue':
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+
+    def put(self, _frame:bytes, _always:bool=False) -> bool:
+        # _always: a small control frame the client must get (a summary), queued even over the limit
+        with self._condition:
+            if self._closed: return False
+            if not _always and self._frames and self.depth + len(_frame) > self.max_bytes and not self.wait_for_space(len(_frame)):
+                self.dropped += 1
+                return False
+            self._frames.append(_frame)
+            self.depth     += len(_frame)
+            self.high_water = max(self.high_water, self.depth)
+            self._condition.notify_all()
+            return True
+
+
+    def wait_for_space(self, _frame_size:int) -> bool:
+        match self.policy:
+            case 'backpressure':
+                _has_space = lambda: self._closed or not self._frames or self.depth + _frame_size <= self.max_bytes
+                return self._condition.wait_for(_has_space, self.timeout) and not self._closed
+            case 'disconnect':
+                self.disconnect()
+                return False
+            case _:
+                return False
+
+
+    def run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._frames or self._closed)
+                if self._closed: return
+                _frame = self._frames.popleft()
+            try:    self._socket.send_queued_frame(_frame)
+            except OSError: return self.close()
+            with self._condition:
+                if not self._closed: self.depth -= len(_frame)
+                self.sent       += 1
+                self.sent_bytes += len(_frame)
+                self._condition.notify_all()
+
+
+    def disconnect(self) -> None:
+        self._closed = True
+        self._frames.clear()
+        self.depth = 0
+        self._condition.notify_all()
+        try:    self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._frames.clear()
+            self.depth = 0
+            self._condition.notify_all()
@@ -0,0 +1,119 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import os, mmap, threading, contextlib
+from collections import OrderedDict
+
+
+class Mapped_Reader:
+    # read() over a memory map: slices of the shared mapping, no copy and no file position
+    __slots__ = ('_view', '_position')
+
+    def __init__(self, _view:memoryview, _offset:int=0) -> None:
+        self._view     = _view
+        self._position = _offset
+
+
+    def read(self, _size:int) -> memoryview:
+        _data = self._view[self._position:self._position + _size]
+        self._position += len(_data)
+        return _data
+
+
+
+class Cached_File:
+    __slots__ = ('file', 'identity', 'size', 'users', 'evicted', '_mapping')
+
+    def __init__(self, _path:str) -> None:
+        self.file     = open(_path, 'rb')
+        _status       = os.fstat(self.file.fileno())
+        self.identity = (_status.st_dev, _status.st_ino, _status.st_size, _status.st_mtime_ns)
+        self.size     = _status.st_size
+        self.users    = 0
+        self.evicted  = False
+        self._mapping = None
+
+
+    def get_reader(self, _offset:int=0) -> Mapped_Reader:
+        # Mapped on first use; an empty file can not be mapped
+        if self._mapping is None and self.size: self._mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return Mapped_Reader(memoryview(self._mapping) if self._mapping else memoryview(b''), _offset)
+
+
+    def close(self) -> None:
+        # A reader that is still alive keeps the mapping exported; it is closed when the last view goes away
+        try:
+            if self._mapping: self._mapping.close()
+        except BufferError: pass
+        self.file.close()
+
+
+
+class Open_File_Cache:
+    # LRU of open read-only handles and their memory maps, so concurrent downloads of a popular file share
+    # one handle and one mapping: sendfile reads the handle at explicit offsets and mapped readers use no
+    # file position. An entry is valid while the name still points to the same inode, size and mtime.
+    # Mappings rely on files being replaced and never truncated in place, which is how uploads store them.
+    __slots__ = ('_directory', '_capacity', '_entries', '_lock', 'hits', 'misses', 'evictions')
+
+    def __init__(self, _directory:str, _capacity:int=64) -> None:
+        self._directory = _directory
+        self._capacity  = _capacity
+        self._entries   = OrderedDict()
+        self._lock      = threading.Lock()
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+
+
+    @contextlib.contextmanager
+    def open_file(self, _file_name:str):
+        _entry = self.acquire(_file_name)
+        try:     yield _entry
+        finally: self.release(_entry)
+
+
+    def acquire(self, _file_name:str) -> Cached_File:
+        _status   = os.stat(self._directory + _file_name)
+        _identity = (_status.st_dev, _status.st_ino, _status.st_size, _status.st_mtime_ns)
+        with self._lock:
+            _entry = self._entries.get(_file_name)
+            if _entry is not None and _entry.identity != _identity:
+                self.evict_locked(_file_name)
+                _entry = None
+            if _entry is None:
+                self.misses += 1
+                _entry = self._entries[_file_name] = Cached_File(self._directory + _file_name)
+                while len(self._entries) > self._capacity: self.evict_locked(next(iter(self._entries)))
+            else:
+                self.hits += 1
+            self._entries.move_to_end(_file_name)
+            _entry.users += 1
+            return _entry
+
+
+    def release(self, _entry:Cached_File) -> None:
+        with self._lock:
+            _entry.users -= 1
+            if _entry.evicted and not _entry.users: _entry.close()
+
+
+    def invalidate(self, _file_name:str) -> None:
+        with self._lock:
+            if _file_name in self._entries: self.evict_locked(_file_name)
+
+
+    def evict_locked(self, _file_name:str) -> None:
+        _entry = self._entries.pop(_file_name)
+        _entry.evicted  = True
+        self.evictions += 1
+        if not _entry.users: _entry.close()
+
+
+    def describe(self) -> dict:
+        with self._lock:
+            return {'open': len(self._entries), 'capacity': self._capacity, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
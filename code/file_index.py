@@ -0,0 +1,124 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import os, threading, hashlib, bisect
+
+
+class File_Entry:
+    __slots__ = ('size', 'mtime', 'checksum')
+
+    def __init__(self, _size:int, _mtime:int, _checksum:str=None) -> None:
+        self.size     = _size
+        self.mtime    = _mtime
+        self.checksum = _checksum
+
+
+
+class File_Index:
+    # In-memory view of the storage directory: name -> size, mtime and (lazily) checksum, plus a sorted
+    # name list for prefix queries and pages. Upload and delete paths keep it current one file at a time;
+    # anything else that touches the directory changes its mtime, which triggers a full rescan.
+    # A listener, when set, is told every change as (name, old size, new size), None for no file.
+    __slots__ = ('_directory', '_entries', '_names', '_directory_mtime', '_ignored_suffixes', '_lock', '_listener')
+
+    def __init__(self, _directory:str, _ignored_suffixes:tuple=()) -> None:
+        self._directory        = _directory
+        self._entries          = dict()
+        self._names            = list()
+        self._directory_mtime  = None
+        self._ignored_suffixes = _ignored_suffixes
+        self._lock             = threading.RLock()
+        self._listener         = None
+
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+    def set_listener(self, _listener:callable) -> None:
+        self._listener = _listener
+
+
+    def is_indexed(self, _file_name:str) -> bool:
+        return not _file_name.startswith('.') and not _file_name.endswith(self._ignored_suffixes)
+
+
+    def build(self) -> None:
+        _entries = dict()
+        with os.scandir(self._directory) as directory:
+            for entry in directory:
+                if not self.is_indexed(entry.name) or not entry.is_file(): continue
+                _status = entry.stat()
+                _entries[entry.name] = File_Entry(_status.st_size, _status.st_mtime_ns)
+        with self._lock:
+            for name, entry in _entries.items():
+                _old_entry = self._entries.get(name)
+                if _old_entry and (_old_entry.size, _old_entry.mtime) == (entry.size, entry.mtime): entry.checksum = _old_entry.checksum
+                elif self._listener: self._listener(name, _old_entry.size if _old_entry else None, entry.size)
+            if self._listener:
+                for name in self._entries.keys() - _entries.keys(): self._listener(name, self._entries[name].size, None)
+            self._entries         = _entries
+            self._names           = sorted(_entries)
+            self._directory_mtime = self.get_directory_mtime()
+
+
+    def get_directory_mtime(self) -> int | None:
+        try:    return os.stat(self._directory).st_mtime_ns
+        except OSError: return None
+
+
+    def refresh_if_changed(self) -> None:
+        if self.get_directory_mtime() != self._directory_mtime: self.build()
+
+
+    def update(self, _file_name:str, _checksum:str=None) -> None:
+        # _checksum: sha256 of the new content when the caller already has it, so it is not read again
+        try:    _status = os.stat(self._directory + _file_name)
+        except OSError: return self.remove(_file_name)
+        if not self.is_indexed(_file_name): return
+        with self._lock:
+            _old_entry = self._entries.get(_file_name)
+            if _old_entry is None: bisect.insort(self._names, _file_name)
+            self._entries[_file_name] = File_Entry(_status.st_size, _status.st_mtime_ns, _checksum)
+            self._directory_mtime     = self.get_directory_mtime()
+            if self._listener and (_old_entry is None or (_old_entry.size, _old_entry.mtime) != (_status.st_size, _status.st_mtime_ns)):
+                self._listener(_file_name, _old_entry.size if _old_entry else None, _status.st_size)
+
+
+    def remove(self, _file_name:str) -> None:
+        with self._lock:
+            if (_old_entry := self._entries.pop(_file_name, None)) is not None:
+                del self._names[bisect.bisect_left(self._names, _file_name)]
+                if self._listener: self._listener(_file_name, _old_entry.size, None)
+            self._directory_mtime = self.get_directory_mtime()
+
+
+    def get(self, _file_name:str) -> File_Entry | None:
+        self.refresh_if_changed()
+        with self._lock:
+            return self._entries.get(_file_name)
+
+
+    def get_checksum(self, _file_name:str) -> str | None:
+        _entry = self.get(_file_name)
+        if _entry is None: return None
+        if _entry.checksum is None:
+            _hash = hashlib.sha256()
+            with open(self._directory + _file_name, 'rb') as file:
+                while (_data := file.read(1024 * 1024)): _hash.update(_data)
+            _entry.checksum = _hash.hexdigest()
+        return _entry.checksum
+
+
+    def list_page(self, _prefix:str='', _page:int=1, _page_size:int=100) -> tuple[list, int, int]:
+        self.refresh_if_changed()
+        with self._lock:
+            _start = bisect.bisect_left(self._names, _prefix)
+            _end   = bisect.bisect_left(self._names, _prefix + '\U0010ffff') if _prefix else len(self._names)
+            _total = _end - _start
+            _first = _start + (_page - 1) * _page_size
+            _names = self._names[_first:min(_first + _page_size, _end)]
+            return ([(name, self._entries[name].size) for name in _names], _total, max(1, -(-_total // _page_size)))
@@ -0,0 +1,121 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import threading, time
+from protocol import encode_command
+
+# Events of a <watch> frame, separated by <<SEP>>:
+#   added||name||size   removed||name   resized||name||size   changed||name||size (new content, same size)
+#   rescan||count       more than MAX_EVENTS changes for the subscriber, it should list the files again
+ADDED, REMOVED, RESIZED, CHANGED, RESCAN = 'added', 'removed', 'resized', 'changed', 'rescan'
+
+
+class File_Watcher:
+    # Pushes the changes of the file index to the clients that subscribed with /watch. The index reports
+    # every change (uploads, deletes and rescans after external changes); they are only recorded here,
+    # name -> (size before, size now), and a thread sends them every interval. A file written ten times
+    # in an interval is one event, one added and removed again is none. Each subscriber gets one frame
+    # per interval, and the frame of a prefix is encoded once for all the subscribers that share it.
+    # Without inotify in the standard library external changes are polled: the directory mtime every
+    # interval (files created, renamed or removed), a full rescan every poll seconds (files rewritten
+    # in place). With workers each one polls the shared directory and serves its own subscribers.
+    __slots__ = ('_index', '_deliver', '_subscribers', '_pending', '_condition', '_thread', 'interval',
+                 'poll', 'events', 'frames', 'rescans')
+    MAX_EVENTS = 256
+
+    def __init__(self, _index:object, _deliver:callable, _interval:float=0.5, _poll:float=5.0) -> None:
+        self._index       = _index
+        self._deliver     = _deliver
+        self._subscribers = dict()
+        self._pending     = dict()
+        self._condition   = threading.Condition()
+        self._thread      = None
+        self.interval     = _interval
+        self.poll         = _poll
+        self.events       = 0
+        self.frames       = 0
+        self.rescans      = 0
+        _index.set_listener(self.record)
+
+
+    def subscribe(self, _client_id:int, _prefix:str='') -> None:
+        with self._condition:
+            self._subscribers[_client_id] = _prefix
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+
+    def unsubscribe(self, _client_id:int) -> bool:
+        with self._condition:
+            return self._subscribers.pop(_client_id, None) is not None
+
+
+    def record(self, _file_name:str, _old_size:int | None, _new_size:int | None) -> None:
+        # Called by the index under its lock, so it only takes note
+        with self._condition:
+            if not self._subscribers: return
+            _before = self._pending[_file_name][0] if _file_name in self._pending else _old_size
+            self._pending[_file_name] = (_before, _new_size)
+
+
+    def run(self) -> None:
+        _rescanned_at = time.monotonic()
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._subscribers)
+            time.sleep(self.interval)
+            try:
+                if time.monotonic() - _rescanned_at >= self.poll:
+                    self._index.build()
+                    _rescanned_at = time.monotonic()
+                else:
+                    self._index.refresh_if_changed()
+            except OSError:
+                pass
+            self.flush()
+
+
+    def flush(self) -> None:
+        with self._condition:
+            _pending, self._pending = self._pending, dict()
+            _subscribers = list(self._subscribers.items())
+        _events = self.get_events(_pending)
+        if not _events or not _subscribers: return
+        _frames, _deliveries = dict(), list()
+        for client_id, prefix in _subscribers:
+            if prefix not in _frames: _frames[prefix] = self.encode_events(_events, prefix)
+            if _frames[prefix]: _deliveries.append((client_id, _frames[prefix]))
+        self.events += len(_events)
+        self.frames += len(_deliveries)
+        if _deliveries: self._deliver(_deliveries)
+
+
+    @staticmethod
+    def get_events(_pending:dict) -> list:
+        _events = list()
+        for name, (before, after) in sorted(_pending.items()):
+            if before is None and after is None: continue
+            if before is None:  _events.append((name, f'{ADDED}||{name}||{after}'))
+            elif after is None: _events.append((name, f'{REMOVED}||{name}'))
+            else:               _events.append((name, f'{RESIZED if before != after else CHANGED}||{name}||{after}'))
+        return _events
+
+
+    def encode_events(self, _events:list, _prefix:str) -> bytes | None:
+        _matching = [event for name, event in _events if name.startswith(_prefix)] if _prefix else [event for _, event in _events]
+        if not _matching: return None
+        if len(_matching) > self.MAX_EVENTS:
+            self.rescans += 1
+            _matching = [f'{RESCAN}||{len(_matching)}']
+        return encode_command(f'<watch>:{"<<SEP>>".join(_matching)}')
+
+
+    def describe(self) -> dict:
+        with self._condition:
+            return {'subscribers': len(self._subscribers), 'pending': len(self._pending), 'events': self.events,
+                    'frames': self.frames, 'rescans': self.rescans, 'interval': self.interval, 'poll': self.poll}
@@ -0,0 +1,457 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import asyncio, argparse, json, os, random, socket, subprocess, sys, time
+from protocol import Frame_Decoder, COMMAND, DATA, DATA_CHUNK, RECV_SIZE, encode_command, encode_data
+from client_api import Server_Busy
+try:    import resource
+except ImportError: resource = None
+
+# Weight of each command in the request mix of a scenario
+SCENARIOS = {
+    'chat':      {'/msg': 80, '/bmsg': 2, '/files': 18},
+    'listing':   {'/files': 100},
+    'transfers': {'/upl': 50, '/downl': 50},
+    'mixed':     {'/msg': 50, '/bmsg': 2, '/files': 20, '/upl': 14, '/downl': 14},
+    'batched':   {'<batch>': 100}
+}
+SEED_FILE = 'load_test_seed.bin'
+
+
+class Scenario_Result:
+    # Latencies are kept in seconds per command key; percentiles use the nearest rank
+    __slots__ = ('latencies', 'errors', 'connect_times', 'busy_replies', 'bytes_sent', 'bytes_received', 'finished')
+
+    def __init__(self) -> None:
+        self.latencies      = dict()
+        self.errors         = dict()
+        self.connect_times  = list()
+        self.busy_replies   = 0
+        self.bytes_sent     = 0
+        self.bytes_received = 0
+        self.finished       = 0
+
+
+    def record(self, _command:str, _seconds:float, _ok:bool) -> None:
+        if _ok: self.latencies.setdefault(_command, []).append(_seconds)
+        else:   self.errors[_command] = self.errors.get(_command, 0) + 1
+
+
+    @staticmethod
+    def get_percentiles(_samples:list) -> dict:
+        if not _samples: return {'count': 0}
+        _samples = sorted(_samples)
+        _pick    = lambda fraction: round(_samples[min(len(_samples) - 1, int(fraction * len(_samples)))] * 1000, 3)
+        return {'count': len(_samples), 'p50_ms': _pick(0.5), 'p99_ms': _pick(0.99), 'p999_ms': _pick(0.999),
+                'max_ms': round(_samples[-1] * 1000, 3)}
+
+
+    def summarize(self, _seconds:float) -> dict:
+        _samples  = [sample for samples in self.latencies.values() for sample in samples]
+        _commands = sorted(set(self.latencies) | set(self.errors))
+        return {
+            'seconds':             round(_seconds, 3),
+            'requests':            len(_samples),
+            'errors':              sum(self.errors.values()),
+            'requests_per_second': round(len(_samples) / _seconds, 1),
+            'sent_mb_per_second':  round(self.bytes_sent / 1048576 / _seconds, 2),
+            'recv_mb_per_second':  round(self.bytes_received / 1048576 / _seconds, 2),
+            'latency':             self.get_percentiles(_samples),
+            'connect':             self.get_percentiles(self.connect_times),
+            'busy_replies':        self.busy_replies,
+            'commands':            {command: {**self.get_percentiles(self.latencies.get(command, [])),
+                                              'errors': self.errors.get(command, 0)} for command in _commands}
+        }
+
+
+
+class Load_Client:
+    # Headless protocol client: one connection and one request in flight. Frames meant for other requests
+    # (broadcasts and messages from the other simulated clients) are read and skipped while waiting.
+    COMMANDS = {
+        '/msg':   lambda self: self.send_private_message(),
+        '/bmsg':  lambda self: self.send_broadcast_message(),
+        '/files': lambda self: self.list_files(),
+        '/upl':   lambda self: self.upload(f'load_test_{self.client_id}.bin'),
+        '/downl': lambda self: self.download(SEED_FILE),
+        '<batch>': lambda self: self.send_batch()
+    }
+    BATCH_SIZE = 100
+
+    __slots__ = ('_address', '_reader', '_writer', '_decoder', '_result', '_payload', '_sequence', 'client_id', 'uploaded')
+
+    def __init__(self, _result:Scenario_Result, _payload:bytes) -> None:
+        self._address  = None
+        self._reader   = None
+        self._writer   = None
+        self._decoder  = Frame_Decoder()
+        self._result   = _result
+        self._payload  = _payload
+        self._sequence = 0
+        self.client_id = None
+        self.uploaded  = False
+
+
+    async def connect(self, _address:tuple[str, int]) -> None:
+        # A connection counts as established once the server echoed a message back, because a connection
+        # that is still waiting in the listen backlog looks open on this side. A <busy> reply is retried
+        # after the delay the server asked for, and the wait is part of the connect time.
+        _start = time.perf_counter()
+        self._address = _address
+        while True:
+            self._reader, self._writer = await asyncio.open_connection(*_address)
+            self.client_id = self._writer.get_extra_info('sockname')[1]
+            try:
+                if not await self.send_private_message(): raise ConnectionRefusedError('no echo from the server')
+                break
+            except Server_Busy as busy:
+                self._writer.close()
+                self._result.busy_replies += 1
+                await asyncio.sleep(busy.retry_after)
+        self._result.connect_times.append(time.perf_counter() - _start)
+
+
+    async def send(self, _frame:bytes) -> None:
+        self._writer.write(_frame)
+        await self._writer.drain()
+
+
+    async def receive_frame(self, _reader:asyncio.StreamReader=None, _decoder:Frame_Decoder=None) -> tuple[int, str, bytes]:
+        _reader, _decoder = _reader or self._reader, _decoder or self._decoder
+        while (_frame := _decoder.next_frame()) is None:
+            _data = await _reader.read(RECV_SIZE)
+            if not _data: raise ConnectionResetError('connection closed by the server')
+            _decoder.feed(_data)
+        return _frame
+
+
+    async def open_data_channel(self, _ticket:str) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        # File bytes go through a connection of their own, opened with the ticket of the transfer
+        _reader, _writer = await asyncio.open_connection(*self._address)
+        _writer.write(encode_command(f'<data>:{_ticket}'))
+        return (_reader, _writer)
+
+
+    async def wait_for_reply(self, _is_reply:callable) -> tuple[str, str]:
+        while True:
+            _frame_type, _key, _payload = await self.receive_frame()
+            if _frame_type != COMMAND: continue
+            _text = _payload.decode(errors='replace')
+            if _key == '<busy>': raise Server_Busy(float(_text.split('||')[0]))
+            if _is_reply(_key, _text): return (_key, _text)
+
+
+    async def run(self, _commands:list, _stop:asyncio.Event, _total_clients:int) -> None:
+        try:
+            for command in _commands:
+                self._sequence += 1
+                _start = time.perf_counter()
+                _ok    = await self.COMMANDS[command](self)
+                self._result.record(command, time.perf_counter() - _start, _ok)
+        except (ConnectionError, OSError):
+            self._result.record('connection', 0.0, False)
+        self._result.finished += 1
+        if self._result.finished == _total_clients: _stop.set()
+        await self.drain(_stop)
+
+
+    async def drain(self, _stop:asyncio.Event) -> None:
+        # A client that is done keeps reading, so it is never the slow consumer of someone else's broadcast
+        while not _stop.is_set():
+            try:    await asyncio.wait_for(self.receive_frame(), 0.2)
+            except asyncio.TimeoutError: pass
+            except (ConnectionError, OSError): return
+
+
+    def create_token(self) -> str:
+        return f'[{self.client_id}:{self._sequence}]'
+
+
+    async def send_private_message(self) -> bool:
+        _token = self.create_token()
+        await self.send(encode_command(f'/msg:{self.client_id}:load test {_token}'))
+        _, _text = await self.wait_for_reply(lambda key, text: _token in text or text.startswith('SERVER:'))
+        return _token in _text
+
+
+    async def send_broadcast_message(self) -> bool:
+        _token = self.create_token()
+        await self.send(encode_command(f'/bmsg:load test {_token}'))
+        _, _text = await self.wait_for_reply(lambda key, text: _token in text or text.startswith('SERVER:'))
+        return _token in _text
+
+
+    async def list_files(self) -> bool:
+        await self.send(encode_command('/files'))
+        _key, _ = await self.wait_for_reply(lambda key, text: key == '<mult>' or text.startswith('SERVER:'))
+        return _key == '<mult>'
+
+
+    async def send_batch(self) -> bool:
+        # BATCH_SIZE lookups in one frame and one reply: /files with a prefix and /delf of a missing file
+        _batch = [(str(index), '/files:load_test' if index % 2 else '/delf:load_test_missing.bin') for index in range(self.BATCH_SIZE)]
+        await self.send(encode_command(f'<batch>:{json.dumps(_batch)}'))
+        _key, _text = await self.wait_for_reply(lambda key, text: key == '<batch_reply>' or text.startswith('SERVER:'))
+        return _key == '<batch_reply>' and len(json.loads(_text)) == self.BATCH_SIZE
+
+
+    async def upload(self, _file_name:str) -> bool:
+        await self.send(encode_command(f'<file_inf>:{_file_name}||{len(self._payload)}'))
+        _key, _text = await self.wait_for_reply(lambda key, text: key == '<send_file>' or text.startswith('SERVER:'))
+        if _key != '<send_file>': return False
+        self.uploaded = True
+        _reader, _writer = await self.open_data_channel(_text.split('||')[4])
+        try:
+            for offset in range(0, len(self._payload), DATA_CHUNK):
+                _writer.write(encode_data(self._payload[offset:offset + DATA_CHUNK]))
+                await _writer.drain()
+            self._result.bytes_sent += len(self._payload)
+            # Broadcasts sent before the server saw <data> may come first
+            _decoder = Frame_Decoder()
+            while not (_payload := (await self.receive_frame(_reader, _decoder))[2]).startswith(b'SERVER:'): pass
+            return _payload.startswith(b'SERVER: file received')
+        finally:
+            _writer.close()
+
+
+    async def download(self, _file_name:str) -> bool:
+        await self.send(encode_command(f'/downl:{_file_name}'))
+        _key, _text = await self.wait_for_reply(lambda key, text: key == '<confirm>' or text.startswith('SERVER:'))
+        if _key != '<confirm>': return False
+        _file_name, _file_size, _, _, _ticket = _text.split('||')
+        _reader, _writer  = await self.open_data_channel(_ticket)
+        _decoder, _received_data = Frame_Decoder(), 0
+        try:
+            while _received_data < int(_file_size):
+                _frame_type, _, _payload = await self.receive_frame(_reader, _decoder)
+                if _frame_type == DATA: _received_data += len(_payload)
+        finally:
+            _writer.close()
+        self._result.bytes_received += _received_data
+        return True
+
+
+    async def get_server_statistics(self) -> dict:
+        await self.send(encode_command('/stats:json'))
+        _, _text = await self.wait_for_reply(lambda key, text: key == '<single>' and text.startswith('{'))
+        return json.loads(_text)
+
+
+    async def delete(self, _file_name:str) -> None:
+        await self.send(encode_command(f'/delf:{_file_name}'))
+        await self.wait_for_reply(lambda key, text: text.startswith('SERVER:'))
+
+
+    def close(self) -> None:
+        if self._writer: self._writer.close()
+
+
+
+class Load_Test:
+    # Starts a fresh server process per scenario (server.py with the same options a user would pass),
+    # connects every simulated client, releases them together and measures until the last one finishes.
+
+    def __init__(self, _arguments:argparse.Namespace) -> None:
+        self._arguments = _arguments
+        self._payload   = os.urandom(_arguments.file_size)
+
+
+    @staticmethod
+    def raise_file_limit() -> None:
+        # Thousands of clients need thousands of descriptors; the server process inherits the new limit
+        if resource is None: return
+        _soft, _hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if _soft < _hard: resource.setrlimit(resource.RLIMIT_NOFILE, (_hard, _hard))
+
+
+    @staticmethod
+    def find_free_port() -> int:
+        with socket.create_server(('localhost', 0)) as _socket:
+            return _socket.getsockname()[1]
+
+
+    def start_server(self, _port:int) -> subprocess.Popen:
+        _command = [sys.executable, 'server.py', '--port', str(_port), '--mode', self._arguments.mode,
+                    '--workers', str(self._arguments.workers), *self._arguments.server_option]
+        return subprocess.Popen(_command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+    @staticmethod
+    def wait_for_server(_process:subprocess.Popen, _port:int, _timeout:float=10.0) -> None:
+        _deadline = time.monotonic() + _timeout
+        while time.monotonic() < _deadline:
+            if _process.poll() is not None: raise RuntimeError(f'server exited with code {_process.returncode}')
+            try:    socket.create_connection(('localhost', _port), 0.5).close()
+            except OSError: time.sleep(0.1)
+            else:   return
+        raise RuntimeError(f'server did not accept connections on port {_port}')
+
+
+    @staticmethod
+    def read_process_tree(_pid:int) -> list:
+        _pids = [_pid]
+        for pid in _pids:
+            try:
+                with open(f'/proc/{pid}/task/{pid}/children') as file: _pids += map(int, file.read().split())
+            except OSError: pass
+        return _pids
+
+
+    @staticmethod
+    def read_process_usage(_pid:int) -> dict | None:
+        # Linux only: CPU seconds and resident memory of the server and its worker processes, from /proc
+        _usage = {'cpu_seconds': 0.0, 'rss_mb': 0.0, 'peak_rss_mb': 0.0, 'processes': 0}
+        for pid in Load_Test.read_process_tree(_pid):
+            try:
+                with open(f'/proc/{pid}/stat') as file:   _fields = file.read().rsplit(')', 1)[1].split()
+                with open(f'/proc/{pid}/status') as file: _status = dict(line.split(':', 1) for line in file if ':' in line)
+            except OSError: continue
+            _usage['cpu_seconds'] += (int(_fields[11]) + int(_fields[12])) / os.sysconf('SC_CLK_TCK')
+            _usage['rss_mb']      += int(_status['VmRSS'].split()[0]) / 1024
+            _usage['peak_rss_mb'] += int(_status['VmHWM'].split()[0]) / 1024
+            _usage['processes']   += 1
+        return _usage if _usage['processes'] else None
+
+
+    @staticmethod
+    def get_own_cpu_seconds() -> float:
+        if resource is None: return time.process_time()
+        _usage = resource.getrusage(resource.RUSAGE_SELF)
+        return _usage.ru_utime + _usage.ru_stime
+
+
+    async def connect_clients(self, _result:Scenario_Result, _address:tuple[str, int]) -> list:
+        _limit = asyncio.Semaphore(self._arguments.connect_concurrency)
+        async def connect(client:Load_Client) -> Load_Client | None:
+            async with _limit:
+                try:    await client.connect(_address)
+                except OSError: return _result.record('connect', 0.0, False)
+            return client
+        _clients = [Load_Client(_result, self._payload) for _ in range(self._arguments.clients)]
+        return [client for client in await asyncio.gather(*map(connect, _clients)) if client]
+
+
+    def create_request_mix(self, _mix:dict, _index:int) -> list:
+        _random = random.Random(self._arguments.seed + _index)
+        return _random.choices(list(_mix), weights=list(_mix.values()), k=self._arguments.requests)
+
+
+    async def run_clients(self, _mix:dict, _address:tuple[str, int], _server_pid:int) -> dict:
+        _result  = Scenario_Result()
+        _clients = await self.connect_clients(_result, _address)
+        if not _clients: raise RuntimeError('no client could connect')
+        if '/downl' in _mix and not await _clients[0].upload(SEED_FILE): raise RuntimeError('could not upload the seed file')
+        _result.bytes_sent = 0
+        _stop         = asyncio.Event()
+        _server_usage = self.read_process_usage(_server_pid)
+        _own_cpu      = self.get_own_cpu_seconds()
+        _start        = time.perf_counter()
+        _runs         = [asyncio.create_task(client.run(self.create_request_mix(_mix, index), _stop, len(_clients)))
+                         for index, client in enumerate(_clients)]
+        await _stop.wait()
+        _seconds = time.perf_counter() - _start
+        _summary = _result.summarize(_seconds)
+        _summary['clients']   = len(_clients)
+        _summary['generator'] = {'cpu_seconds': round(self.get_own_cpu_seconds() - _own_cpu, 3)}
+        _summary['server']    = self.describe_server_usage(_server_usage, self.read_process_usage(_server_pid), _seconds)
+        await asyncio.gather(*_runs)
+        _summary['server_metrics'] = await self.finish_scenario(_clients, '/downl' in _mix, _address)
+        for client in _clients: client.close()
+        return _summary
+
+
+    @staticmethod
+    def describe_server_usage(_before:dict | None, _after:dict | None, _seconds:float) -> dict | None:
+        if not _before or not _after: return None
+        _cpu_seconds = _after['cpu_seconds'] - _before['cpu_seconds']
+        return {'cpu_seconds': round(_cpu_seconds, 3), 'cpu_percent': round(_cpu_seconds / _seconds * 100, 1),
+                'rss_mb': round(_after['rss_mb'], 1), 'peak_rss_mb': round(_after['peak_rss_mb'], 1),
+                'processes': _after['processes']}
+
+
+    @staticmethod
+    async def finish_scenario(_clients:list, _remove_seed:bool, _address:tuple[str, int]) -> dict:
+        # Through a new connection, the simulated ones may have been dropped by the server.
+        # The server's own per-command metrics are taken before the cleanup requests.
+        _cleaner = Load_Client(Scenario_Result(), b'')
+        await _cleaner.connect(_address)
+        _statistics = await _cleaner.get_server_statistics()
+        for client in _clients:
+            if client.uploaded: await _cleaner.delete(f'load_test_{client.client_id}.bin')
+        if _remove_seed: await _cleaner.delete(SEED_FILE)
+        _cleaner.close()
+        return _statistics
+
+
+    def run_scenario(self, _name:str) -> dict:
+        _port    = self.find_free_port()
+        _process = self.start_server(_port)
+        try:
+            self.wait_for_server(_process, _port)
+            return asyncio.run(self.run_clients(SCENARIOS[_name], ('localhost', _port), _process.pid))
+        finally:
+            _process.terminate()
+            try:    _process.wait(5)
+            except subprocess.TimeoutExpired: _process.kill()
+
+
+    def run(self) -> dict:
+        self.raise_file_limit()
+        _settings = {name: value for name, value in vars(self._arguments).items() if name not in ('output', 'compare')}
+        _results  = {'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'settings': _settings, 'scenarios': dict()}
+        for name in self._arguments.scenario:
+            print(f'Running {name}: {self._arguments.clients} clients x {self._arguments.requests} requests')
+            _results['scenarios'][name] = self.run_scenario(name)
+            print(self.describe_scenario(name, _results['scenarios'][name]))
+        return _results
+
+
+    @staticmethod
+    def describe_scenario(_name:str, _summary:dict) -> str:
+        _latency = _summary['latency']
+        _line    = (f'{_name:.<12} {_summary["requests_per_second"]:10.1f} req/s  p50 {_latency.get("p50_ms", 0):.2f} ms  '
+                    f'p99 {_latency.get("p99_ms", 0):.2f} ms  p999 {_latency.get("p999_ms", 0):.2f} ms  errors {_summary["errors"]}')
+        if _summary['server']:
+            _line += f'  server cpu {_summary["server"]["cpu_percent"]}%  rss {_summary["server"]["rss_mb"]} MB'
+        return _line
+
+
+    @staticmethod
+    def compare_results(_baseline:dict, _current:dict) -> list:
+        _change = lambda old, new: f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+        _lines  = list()
+        for name, summary in _current['scenarios'].items():
+            if (_old := _baseline.get('scenarios', {}).get(name)) is None: continue
+            _lines.append(f'{name:.<12} req/s {_change(_old["requests_per_second"], summary["requests_per_second"])}  '
+                          f'p99 {_change(_old["latency"].get("p99_ms", 0), summary["latency"].get("p99_ms", 0))}  '
+                          f'p999 {_change(_old["latency"].get("p999_ms", 0), summary["latency"].get("p999_ms", 0))}')
+        return _lines
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test: simulated protocol clients against a local server')
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=list(SCENARIOS), help='request mixes to run')
+    parser.add_argument('--clients', type=int, default=200, help='simulated clients, one connection each')
+    parser.add_argument('--requests', type=int, default=50, help='requests per client')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='bytes per /upl and of the /downl file')
+    parser.add_argument('--batch-size', type=int, default=Load_Client.BATCH_SIZE, help='commands per <batch> in the batched scenario')
+    parser.add_argument('--connect-concurrency', type=int, default=64, help='connections opened at the same time')
+    parser.add_argument('--mode', choices=('thread', 'async'), default='thread', help='server mode')
+    parser.add_argument('--workers', type=int, default=1, help='server worker processes')
+    parser.add_argument('--server-option', action='append', default=[], help='extra server.py option, e.g. --server-option=--dedup')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the request mixes')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    arguments = parser.parse_args()
+    Load_Client.BATCH_SIZE = arguments.batch_size
+    results = Load_Test(arguments).run()
+    if arguments.output:
+        with open(arguments.output, 'w') as file: json.dump(results, file, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as file: baseline = json.load(file)
+        for line in Load_Test.compare_results(baseline, results): print(line)
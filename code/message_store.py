@@ -0,0 +1,316 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import os, struct, threading, time, atexit, hashlib, hmac, secrets
+from collections import deque
+
+# Record: | payload size (uint32) | recipient (uint32) | kind (uint8) | sequence (uint64) | stored at (double) | payload |
+# A MESSAGE payload is the encoded frame to deliver. A DELIVERED record has no payload: every message
+# of the recipient up to its sequence number was delivered.
+RECORD    = struct.Struct('!IIBQd')
+MESSAGE   = 1
+DELIVERED = 2
+
+
+class Stored_Message:
+    __slots__ = ('sequence', 'segment', 'offset', 'size', 'stored_at')
+
+    def __init__(self, _sequence:int, _segment:int, _offset:int, _size:int, _stored_at:float) -> None:
+        self.sequence  = _sequence
+        self.segment   = _segment
+        self.offset    = _offset
+        self.size      = _size
+        self.stored_at = _stored_at
+
+
+
+class Message_Store:
+    # Private messages for clients that are not logged in. Writes only append to the active segment
+    # through a buffer that a background thread flushes and fsyncs every SYNC_SECONDS, so a burst of
+    # messages costs one disk sync per interval. The index (recipient -> pending messages) lives in
+    # memory and is rebuilt from the segments on start. When the active segment reaches SEGMENT_BYTES
+    # it is sealed, and once less than half of the sealed bytes are still pending, the pending messages
+    # are copied into one new segment and the old ones deleted. Sequence numbers make a copy that was
+    # interrupted by a crash harmless: a message read twice is kept once.
+    __slots__ = ('_directory', '_index', '_lock', '_file', '_segment', '_segment_size', '_segments', '_sequence',
+                 '_dirty', 'max_per_recipient', 'retention_seconds', 'stored', 'delivered', 'expired', 'dropped')
+    SEGMENT_BYTES = 16 * 1024 * 1024
+    SYNC_SECONDS  = 0.05
+
+    def __init__(self, _directory:str, _max_per_recipient:int=1000, _retention_seconds:float=7 * 86400) -> None:
+        self._directory        = _directory
+        self._index            = dict()
+        self._lock             = threading.Lock()
+        self._file             = None
+        self._segment          = 0
+        self._segment_size     = 0
+        self._segments         = dict()
+        self._sequence         = 0
+        self._dirty            = False
+        self.max_per_recipient = _max_per_recipient
+        self.retention_seconds = _retention_seconds
+        self.stored            = 0
+        self.delivered         = 0
+        self.expired           = 0
+        self.dropped           = 0
+
+
+    def open(self) -> 'Message_Store':
+        os.makedirs(self._directory, exist_ok=True)
+        _segments = sorted(int(name.split('.')[0]) for name in os.listdir(self._directory) if name.endswith('.log'))
+        for segment in _segments: self.replay_segment(segment)
+        # Appends continue in the last segment, cut back to its last complete record
+        if _segments and self._segments[_segments[-1]] < self.SEGMENT_BYTES: self.open_segment(_segments[-1], self._segments[_segments[-1]])
+        else: self.open_segment((_segments[-1] if _segments else 0) + 1)
+        threading.Thread(target=self.sync_periodically, daemon=True).start()
+        atexit.register(self.close)
+        return self
+
+
+    def get_segment_path(self, _segment:int) -> str:
+        return os.path.join(self._directory, f'{_segment:012d}.log')
+
+
+    def replay_segment(self, _segment:int) -> None:
+        # A record cut short by a crash ends the segment
+        with open(self.get_segment_path(_segment), 'rb') as file: _data = file.read()
+        _offset, _known = 0, {message.sequence for messages in self._index.values() for message in messages}
+        while _offset + RECORD.size <= len(_data):
+            _size, _recipient, _kind, _sequence, _stored_at = RECORD.unpack_from(_data, _offset)
+            if _offset + RECORD.size + _size > len(_data): break
+            self._sequence = max(self._sequence, _sequence)
+            if _kind == MESSAGE and _sequence not in _known:
+                _known.add(_sequence)
+                _messages = self._index.setdefault(_recipient, deque())
+                _messages.append(Stored_Message(_sequence, _segment, _offset + RECORD.size, _size, _stored_at))
+                if len(_messages) > self.max_per_recipient: _messages.popleft()
+            elif _kind == DELIVERED and _recipient in self._index:
+                _messages = self._index[_recipient]
+                while _messages and _messages[0].sequence <= _sequence: _messages.popleft()
+                if not _messages: del self._index[_recipient]
+            _offset += RECORD.size + _size
+        self._segments[_segment] = _offset
+
+
+    def open_segment(self, _segment:int, _size:int=0) -> None:
+        self._file         = open(self.get_segment_path(_segment), 'ab', buffering=1024 * 1024)
+        self._file.truncate(_size)
+        self._segment      = _segment
+        self._segment_size = _size
+        self._segments[_segment] = _size
+
+
+    def append_locked(self, _recipient:int, _kind:int, _sequence:int, _stored_at:float, _payload:bytes=b'') -> int:
+        _offset = self._segment_size + RECORD.size
+        self._file.write(RECORD.pack(len(_payload), _recipient, _kind, _sequence, _stored_at))
+        if _payload: self._file.write(_payload)
+        self._segment_size += RECORD.size + len(_payload)
+        self._segments[self._segment] = self._segment_size
+        self._dirty = True
+        return _offset
+
+
+    def put(self, _recipient:int, _frame:bytes) -> None:
+        # A full mailbox keeps the newest messages
+        with self._lock:
+            self._sequence += 1
+            _stored_at = time.time()
+            _offset    = self.append_locked(_recipient, MESSAGE, self._sequence, _stored_at, _frame)
+            _messages  = self._index.setdefault(_recipient, deque())
+            _messages.append(Stored_Message(self._sequence, self._segment, _offset, len(_frame), _stored_at))
+            if len(_messages) > self.max_per_recipient:
+                _messages.popleft()
+                self.dropped += 1
+            self.stored += 1
+            if self._segment_size >= self.SEGMENT_BYTES: self.seal_locked()
+
+
+    def take(self, _recipient:int, _since:float=0) -> list:
+        # Pending frames of the recipient, oldest first; they are marked delivered in the same step.
+        # Messages stored before _since are dropped with the expired ones.
+        with self._lock:
+            _messages = self._index.pop(_recipient, None)
+            if not _messages: return []
+            self._file.flush()
+            _oldest = max(time.time() - self.retention_seconds, _since)
+            _frames = self.read_locked([message for message in _messages if message.stored_at >= _oldest])
+            self.expired   += len(_messages) - len(_frames)
+            self.delivered += len(_frames)
+            self.append_locked(_recipient, DELIVERED, _messages[-1].sequence, time.time())
+            return _frames
+
+
+    def peek(self, _recipient:int, _since:float=0) -> list:
+        # Pending (sequence, frame) pairs of the recipient stored since _since, oldest first; they stay
+        # pending until acknowledged
+        with self._lock:
+            _messages = self._index.get(_recipient)
+            if not _messages: return []
+            self._file.flush()
+            _oldest = max(time.time() - self.retention_seconds, _since)
+            _live   = [message for message in _messages if message.stored_at >= _oldest]
+            return list(zip((message.sequence for message in _live), self.read_locked(_live)))
+
+
+    def acknowledge(self, _recipient:int, _sequence:int) -> None:
+        # The messages of the recipient up to _sequence were delivered
+        with self._lock:
+            _messages = self._index.get(_recipient)
+            if not _messages or _messages[0].sequence > _sequence: return
+            _oldest = time.time() - self.retention_seconds
+            while _messages and _messages[0].sequence <= _sequence:
+                if _messages.popleft().stored_at < _oldest: self.expired += 1
+                else: self.delivered += 1
+            if not _messages: del self._index[_recipient]
+            self.append_locked(_recipient, DELIVERED, _sequence, time.time())
+
+
+    def read_locked(self, _messages:list) -> list:
+        _descriptors = dict()
+        try:
+            for message in _messages:
+                if message.segment not in _descriptors: _descriptors[message.segment] = os.open(self.get_segment_path(message.segment), os.O_RDONLY)
+            return [os.pread(_descriptors[message.segment], message.size, message.offset) for message in _messages]
+        finally:
+            for descriptor in _descriptors.values(): os.close(descriptor)
+
+
+    def count_pending_bytes_locked(self) -> int:
+        return sum(message.size + RECORD.size for messages in self._index.values() for message in messages if message.segment != self._segment)
+
+
+    def seal_locked(self) -> None:
+        self.sync_locked()
+        self._file.close()
+        _sealed = list(self._segments)
+        self.open_segment(self._segment + 1)
+        if self.count_pending_bytes_locked() * 2 < sum(self._segments[segment] for segment in _sealed): self.compact_locked(_sealed)
+
+
+    def compact_locked(self, _sealed:list) -> None:
+        # The pending messages of the sealed segments are copied, in sequence order, into the active
+        # segment; the copy is synced before the old segments are deleted
+        _oldest   = time.time() - self.retention_seconds
+        _pending  = sorted(((recipient, message) for recipient, messages in self._index.items() for message in messages),
+                           key=lambda item: item[1].sequence)
+        for recipient, message in [item for item in _pending if item[1].stored_at < _oldest]:
+            self._index[recipient].remove(message)
+            self.expired += 1
+        _pending = [item for item in _pending if item[1].stored_at >= _oldest]
+        for (recipient, message), frame in zip(_pending, self.read_locked([message for _, message in _pending])):
+            _offset = self.append_locked(recipient, MESSAGE, message.sequence, message.stored_at, frame)
+            message.segment, message.offset = self._segment, _offset
+        for recipient in [recipient for recipient, messages in self._index.items() if not messages]: del self._index[recipient]
+        self.sync_locked()
+        for segment in _sealed:
+            os.remove(self.get_segment_path(segment))
+            del self._segments[segment]
+
+
+    def sync_locked(self) -> None:
+        if not self._dirty: return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._dirty = False
+
+
+    def close(self) -> None:
+        with self._lock: self.sync_locked()
+
+
+    def sync_periodically(self) -> None:
+        # The buffer is handed to the kernel under the lock; the fsync runs on a duplicate descriptor
+        # outside it, so writers only wait for the copy and not for the disk
+        while True:
+            time.sleep(self.SYNC_SECONDS)
+            with self._lock:
+                if not self._dirty: continue
+                self._file.flush()
+                self._dirty = False
+                _descriptor = os.dup(self._file.fileno())
+            try:     os.fsync(_descriptor)
+            finally: os.close(_descriptor)
+
+
+    def describe(self) -> dict:
+        with self._lock:
+            return {'recipients': len(self._index), 'pending': sum(map(len, self._index.values())),
+                    'stored': self.stored, 'delivered': self.delivered, 'expired': self.expired,
+                    'dropped': self.dropped, 'segments': len(self._segments), 'bytes': sum(self._segments.values())}
+
+
+
+class Mailbox_Keys:
+    # Who may read a mailbox: client id -> SHA-256 of the secret issued when the id was claimed with
+    # /login, and the time of the claim. One file per id in a directory the workers share; it is created
+    # with O_EXCL, so of two clients claiming an id at once only one gets a secret. The file mtime is the
+    # last login: a claim without one for retention seconds lapses and the id can be claimed again.
+    # Messages stored before the claim (for the previous owner) are never delivered to the new one.
+    __slots__ = ('_directory', '_claims', 'retention_seconds')
+
+    def __init__(self, _directory:str, _retention_seconds:float=7 * 86400) -> None:
+        self._directory        = _directory
+        self._claims           = dict()
+        self.retention_seconds = _retention_seconds
+        os.makedirs(_directory, exist_ok=True)
+
+
+    def get_path(self, _client_id:int) -> str:
+        return os.path.join(self._directory, str(_client_id))
+
+
+    def get_claim(self, _client_id:int) -> tuple[str, float] | None:
+        # (digest, claimed at) of a claim in force; the cache follows the inode, as other workers may claim
+        try:    _status = os.stat(self.get_path(_client_id))
+        except FileNotFoundError: return None
+        if _status.st_mtime + self.retention_seconds < time.time(): return None
+        _claim = self._claims.get(_client_id)
+        if _claim is None or _claim[0] != _status.st_ino:
+            try:
+                with open(self.get_path(_client_id)) as file: _digest, _claimed_at = file.read().split()
+                _claim = self._claims[_client_id] = (_status.st_ino, _digest, float(_claimed_at))
+            except (FileNotFoundError, ValueError):
+                return None
+        return _claim[1:]
+
+
+    def is_claimed(self, _client_id:int) -> bool:
+        return self.get_claim(_client_id) is not None
+
+
+    def get_claimed_at(self, _client_id:int) -> float:
+        _claim = self.get_claim(_client_id)
+        return _claim[1] if _claim else time.time()
+
+
+    def claim(self, _client_id:int) -> str | None:
+        # The secret of the new mailbox, None while the id has a claim in force
+        if self.is_claimed(_client_id): return None
+        self.remove_lapsed(_client_id)
+        _secret = secrets.token_hex(16)
+        try:    _descriptor = os.open(self.get_path(_client_id), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError: return None
+        try:
+            os.write(_descriptor, f'{hashlib.sha256(_secret.encode()).hexdigest()} {time.time()}'.encode())
+            os.fsync(_descriptor)
+        finally:
+            os.close(_descriptor)
+        return _secret
+
+
+    def remove_lapsed(self, _client_id:int) -> None:
+        try:
+            if os.stat(self.get_path(_client_id)).st_mtime + self.retention_seconds < time.time(): os.remove(self.get_path(_client_id))
+        except FileNotFoundError:
+            pass
+
+
+    def verify(self, _client_id:int, _secret:str) -> bool:
+        # A login keeps the claim in force for another retention period
+        _claim = self.get_claim(_client_id)
+        if _claim is None or not hmac.compare_digest(_claim[0], hashlib.sha256(_secret.encode()).hexdigest()): return False
+        os.utime(self.get_path(_client_id))
+        return True
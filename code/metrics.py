@@ -0,0 +1,109 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import bisect, logging, logging.handlers, os, queue, sys, threading, time, atexit
+
+# Upper bounds of the latency histogram buckets: 50 us doubling up to ~52 s, plus one overflow bucket
+LATENCY_BOUNDS = tuple(0.00005 * 2 ** exponent for exponent in range(21))
+log            = logging.getLogger('simple_server')
+_log_state     = {'pid': None, 'listener': None}
+
+
+def start_logging(_level:str='INFO') -> None:
+    # Handlers only put records on a queue; a listener thread formats and writes them, so a slow
+    # terminal never stalls a client thread or the event loop. Called again after a fork it starts
+    # a new listener, since the thread of the parent does not exist in the child.
+    if _log_state['pid'] == os.getpid(): return log.setLevel(_level.upper())
+    _records = queue.SimpleQueue()
+    _output  = logging.StreamHandler(sys.stdout)
+    _output.setFormatter(logging.Formatter('%(message)s'))
+    _listener = logging.handlers.QueueListener(_records, _output)
+    _listener.start()
+    atexit.register(_listener.stop)
+    for handler in list(log.handlers): log.removeHandler(handler)
+    log.addHandler(logging.handlers.QueueHandler(_records))
+    log.setLevel(_level.upper())
+    log.propagate = False
+    _log_state.update(pid=os.getpid(), listener=_listener)
+
+
+
+class Command_Metrics:
+    __slots__ = ('requests', 'errors', 'bytes_in', 'bytes_out', 'seconds', 'histogram')
+
+    def __init__(self) -> None:
+        self.requests  = 0
+        self.errors    = 0
+        self.bytes_in  = 0
+        self.bytes_out = 0
+        self.seconds   = 0.0
+        self.histogram = [0] * (len(LATENCY_BOUNDS) + 1)
+
+
+    def observe(self, _seconds:float, _bytes_in:int, _bytes_out:int, _ok:bool) -> None:
+        self.requests  += 1
+        self.errors    += not _ok
+        self.bytes_in  += _bytes_in
+        self.bytes_out += _bytes_out
+        self.seconds   += _seconds
+        self.histogram[bisect.bisect_left(LATENCY_BOUNDS, _seconds)] += 1
+
+
+    def get_percentile(self, _fraction:float) -> float:
+        # Upper bound of the bucket holding the percentile, so the value is never an underestimate
+        _rank, _count = max(1, _fraction * self.requests), 0
+        for index, bucket in enumerate(self.histogram):
+            _count += bucket
+            if _count >= _rank: return LATENCY_BOUNDS[index] if index < len(LATENCY_BOUNDS) else float('inf')
+        return 0.0
+
+
+    def describe(self) -> dict:
+        return {
+            'requests':  self.requests,
+            'errors':    self.errors,
+            'bytes_in':  self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'mean_ms':   round(self.seconds / self.requests * 1000, 3) if self.requests else 0.0,
+            'p50_ms':    round(self.get_percentile(0.5) * 1000, 3),
+            'p99_ms':    round(self.get_percentile(0.99) * 1000, 3),
+            'p999_ms':   round(self.get_percentile(0.999) * 1000, 3),
+            'mb_per_s':  round((self.bytes_in + self.bytes_out) / 1048576 / self.seconds, 1) if self.seconds else 0.0
+        }
+
+
+
+class Server_Metrics:
+    # Per command key: request count, errors, bytes in (request frames and uploaded data), bytes out
+    # (replies and downloaded data on the requester's own socket), handler time and its histogram.
+    # Frames that other clients fan out to a client are counted by its outbound queue instead.
+    __slots__ = ('_commands', '_lock', 'started_at')
+
+    def __init__(self) -> None:
+        self._commands  = dict()
+        self._lock      = threading.Lock()
+        self.started_at = time.time()
+
+
+    @staticmethod
+    def start_request(_client_socket:object) -> tuple[float, int, int]:
+        return (time.perf_counter(), _client_socket.bytes_received, _client_socket.bytes_sent)
+
+
+    def finish_request(self, _method_key:str, _start:tuple[float, int, int], _client_socket:object, _request_size:int, _ok:bool=True) -> None:
+        _started_at, _bytes_received, _bytes_sent = _start
+        _seconds   = time.perf_counter() - _started_at
+        _bytes_in  = _request_size + _client_socket.bytes_received - _bytes_received
+        _bytes_out = _client_socket.bytes_sent - _bytes_sent
+        with self._lock:
+            if (_command := self._commands.get(_method_key)) is None:
+                _command = self._commands[_method_key] = Command_Metrics()
+            _command.observe(_seconds, _bytes_in, _bytes_out, _ok)
+
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {key: command.describe() for key, command in sorted(self._commands.items())}
@@ -0,0 +1,250 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import struct, threading, os, stat, time
+from collections import deque
+
+# Wire format: | body size (uint32) | frame type (uint8) | key size (uint16) | key | payload |
+# The body size covers the key and the payload. Commands carry the method key ("/msg", "<conf>", ...)
+# in the key field, so nothing has to be split on ':' to route them. File bytes travel in DATA frames.
+HEADER         = struct.Struct('!IBH')
+COMMAND        = 1
+DATA           = 2
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+DATA_CHUNK     = 64 * 1024
+RECV_SIZE      = 64 * 1024
+
+
+class Protocol_Error(ValueError):
+    pass
+
+
+def encode_frame(_frame_type:int, _key:bytes=b'', _payload:bytes=b'') -> bytes:
+    _body_size = len(_key) + len(_payload)
+    if _body_size > MAX_FRAME_SIZE: raise Protocol_Error(f'Frame too large: {_body_size} bytes')
+    return HEADER.pack(_body_size, _frame_type, len(_key)) + _key + _payload
+
+
+def encode_command(_message:str) -> bytes:
+    _key, _, _arguments = _message.partition(':')
+    return encode_frame(COMMAND, _key.encode(), _arguments.encode())
+
+
+def encode_data(_data:bytes) -> bytes:
+    return encode_frame(DATA, b'', _data)
+
+
+def encode_data_header(_data_size:int) -> bytes:
+    return HEADER.pack(_data_size, DATA, 0)
+
+
+def is_regular_file(_file:object) -> bool:
+    try:    return stat.S_ISREG(os.fstat(_file.fileno()).st_mode)
+    except: return False
+
+
+class Frame_Decoder:
+    # Streaming decoder: feed it whatever recv() returned, take out as many complete frames as there are.
+    # COMMAND frames that arrive while a transfer is waiting for DATA are kept in order for later.
+    __slots__ = ('_buffer', '_offset', '_pending')
+
+    def __init__(self) -> None:
+        self._buffer  = bytearray()
+        self._offset  = 0
+        self._pending = deque()
+
+
+    def feed(self, _data:bytes) -> None:
+        if self._offset and self._offset == len(self._buffer):
+            self._buffer.clear()
+            self._offset = 0
+        elif self._offset > RECV_SIZE:
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer += _data
+
+
+    def parse_frame(self) -> tuple[int, str, bytes] | None:
+        if len(self._buffer) - self._offset < HEADER.size: return None
+        _body_size, _frame_type, _key_size = HEADER.unpack_from(self._buffer, self._offset)
+        if _body_size > MAX_FRAME_SIZE or _key_size > _body_size:
+            raise Protocol_Error(f'Invalid frame header: body={_body_size} key={_key_size}')
+        _start = self._offset + HEADER.size
+        _end   = _start + _body_size
+        if len(self._buffer) < _end: return None
+        _key          = self._buffer[_start:_start + _key_size].decode()
+        _payload      = bytes(self._buffer[_start + _key_size:_end])
+        self._offset  = _end
+        return (_frame_type, _key, _payload)
+
+
+    def next_frame(self) -> tuple[int, str, bytes] | None:
+        if self._pending: return self._pending.popleft()
+        return self.parse_frame()
+
+
+    def next_data(self) -> bytes | None:
+        while (_frame := self.parse_frame()) is not None:
+            if _frame[0] == DATA: return _frame[2]
+            self._pending.append(_frame)
+        return None
+
+
+    def take_data_header(self) -> int | None:
+        # Consumes only the header of the next DATA frame and returns its size; the payload is read with take_buffered()
+        while len(self._buffer) - self._offset >= HEADER.size:
+            _body_size, _frame_type, _key_size = HEADER.unpack_from(self._buffer, self._offset)
+            if _frame_type == DATA and not _key_size and _body_size <= MAX_FRAME_SIZE:
+                self._offset += HEADER.size
+                return _body_size
+            if (_frame := self.parse_frame()) is None: return None
+            self._pending.append(_frame)
+        return None
+
+
+    def get_missing_size(self) -> int:
+        # Bytes still needed to complete the next header, or the next frame once its header is complete
+        _buffered = len(self._buffer) - self._offset
+        if _buffered < HEADER.size: return HEADER.size - _buffered
+        return max(HEADER.size + HEADER.unpack_from(self._buffer, self._offset)[0] - _buffered, 1)
+
+
+    def take_buffered(self, _view:memoryview) -> int:
+        _size = min(len(_view), len(self._buffer) - self._offset)
+        _view[:_size] = self._buffer[self._offset:self._offset + _size]
+        self._offset += _size
+        return _size
+
+
+    @staticmethod
+    def get_arguments(_payload:bytes) -> str | None:
+        return _payload.decode() if _payload else None
+
+
+
+class Framed_Socket:
+    # Blocking socket wrapper used by the threaded server and by the client. bytes_sent and
+    # bytes_received count what the owner of the socket wrote and the DATA it read, for the metrics.
+    # With a limiter, DATA frames wait for bandwidth outside the send lock, so replies and messages
+    # can go out between two slices of a file.
+    __slots__ = ('_socket', '_decoder', '_send_lock', '_data_left', 'bytes_sent', 'bytes_received', 'limiter')
+
+    def __init__(self, _socket:object) -> None:
+        self._socket        = _socket
+        self._decoder       = Frame_Decoder()
+        self._send_lock     = threading.Lock()
+        self._data_left     = 0
+        self.bytes_sent     = 0
+        self.bytes_received = 0
+        self.limiter        = None
+
+
+    def wait_for_bandwidth(self, _size:int) -> None:
+        if self.limiter and (_delay := self.limiter.reserve(_size)): time.sleep(_delay)
+
+
+    def get_slice_size(self, _chunk_size:int) -> int:
+        return self.limiter.get_slice_size(_chunk_size) if self.limiter else _chunk_size
+
+
+    def sendall(self, _frame:bytes) -> None:
+        with self._send_lock:
+            self._socket.sendall(_frame)
+            self.bytes_sent += len(_frame)
+
+
+    def send_queued_frame(self, _frame:bytes) -> None:
+        # Frames fanned out by other clients, counted by the outbound queue and not as a reply
+        with self._send_lock:
+            self._socket.sendall(_frame)
+
+
+    def send_command(self, _message:str) -> None:
+        self.sendall(encode_command(_message))
+
+
+    def send_data(self, _data:bytes) -> None:
+        self.wait_for_bandwidth(len(_data))
+        self.sendall(encode_data(_data))
+
+
+    def send_file(self, _file:object, _offset:int, _count:int, _chunk_size:int) -> int:
+        # Regular files go through sendfile(2): one DATA header per chunk, the body never enters Python
+        _chunk_size = self.get_slice_size(_chunk_size)
+        if not is_regular_file(_file): return self.send_file_buffered(_file, _offset, _count, _chunk_size)
+        _sent_data = 0
+        while _sent_data < _count:
+            _size = min(_chunk_size, _count - _sent_data)
+            self.wait_for_bandwidth(_size)
+            with self._send_lock:
+                self._socket.sendall(encode_data_header(_size))
+                _written = self._socket.sendfile(_file, _offset + _sent_data, _size)
+                self.bytes_sent += HEADER.size + _written
+            if _written != _size: raise ConnectionResetError('file changed size during the transfer')
+            _sent_data += _size
+        return _sent_data
+
+
+    def send_file_buffered(self, _file:object, _offset:int, _count:int, _chunk_size:int) -> int:
+        if _offset: _file.seek(_offset)
+        _buffer    = bytearray(min(_chunk_size, _count) or 1)
+        _view      = memoryview(_buffer)
+        _sent_data = 0
+        while _sent_data < _count:
+            _size = _file.readinto(_view[:min(len(_buffer), _count - _sent_data)])
+            if not _size: raise ConnectionResetError('file changed size during the transfer')
+            self.wait_for_bandwidth(_size)
+            with self._send_lock:
+                self._socket.sendall(encode_data_header(_size))
+                self._socket.sendall(_view[:_size])
+                self.bytes_sent += HEADER.size + _size
+            _sent_data += _size
+        return _sent_data
+
+
+    def fill_buffer(self, _size:int=RECV_SIZE) -> bool:
+        _data = self._socket.recv(_size)
+        if not _data: return False
+        self._decoder.feed(_data)
+        return True
+
+
+    def receive_frame(self) -> tuple[int, str, bytes] | None:
+        while (_frame := self._decoder.next_frame()) is None:
+            if not self.fill_buffer(): return None
+        return _frame
+
+
+    def receive_data(self) -> bytes:
+        while (_data := self._decoder.next_data()) is None:
+            if not self.fill_buffer(): raise ConnectionResetError('connection closed during the transfer')
+        self.bytes_received += len(_data)
+        self.wait_for_bandwidth(len(_data))
+        return _data
+
+
+    def receive_data_into(self, _view:memoryview) -> int:
+        # Payload of DATA frames written straight into _view: between frames only the missing header
+        # bytes (or the rest of a command) are read, so the payload is received into _view and not
+        # copied out of the decoder. Only what it already held before the transfer is copied once.
+        while not self._data_left:
+            if (_size := self._decoder.take_data_header()) is not None: self._data_left = _size
+            elif not self.fill_buffer(min(self._decoder.get_missing_size(), RECV_SIZE)): raise ConnectionResetError('connection closed during the transfer')
+        _view = _view[:self.get_slice_size(min(len(_view), self._data_left))]
+        if not (_size := self._decoder.take_buffered(_view)):
+            if not (_size := self._socket.recv_into(_view)): raise ConnectionResetError('connection closed during the transfer')
+        self._data_left     -= _size
+        self.bytes_received += _size
+        self.wait_for_bandwidth(_size)
+        return _size
+
+
+    def shutdown(self, _how:int) -> None:
+        self._socket.shutdown(_how)
+
+
+    def close(self) -> None:
+        self._socket.close()
@@ -0,0 +1,68 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import threading, time
+
+
+class Client_Session:
+    # logged_in: the session proved with /login that it owns the mailbox of its client id
+    __slots__ = ('client_id', 'socket', 'address', 'send_queue', 'connected_at', 'last_active', 'requests', 'logged_in')
+
+    def __init__(self, _client_id:int, _socket:object, _address:tuple[str, int], _send_queue:object) -> None:
+        self.client_id    = _client_id
+        self.socket       = _socket
+        self.address      = _address
+        self.send_queue   = _send_queue
+        self.connected_at = time.monotonic()
+        self.last_active  = self.connected_at
+        self.requests     = 0
+        self.logged_in    = False
+
+
+
+class Client_Registry:
+    # Sessions indexed by client id (the client port, which is what users type after /msg).
+    # Every lookup is a dict access under a lock; iteration works on a snapshot so that
+    # no one holds the lock while talking to a socket.
+    __slots__ = ('_sessions', '_lock')
+
+    def __init__(self) -> None:
+        self._sessions = dict()
+        self._lock     = threading.Lock()
+
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+    def __contains__(self, _client_id:int) -> bool:
+        return _client_id in self._sessions
+
+
+    def add(self, _session:Client_Session) -> bool:
+        # False when the id is taken: the same port from another address is another client, and
+        # replacing its session would leave its send queue running with nobody to close it
+        with self._lock:
+            if _session.client_id in self._sessions: return False
+            self._sessions[_session.client_id] = _session
+            return True
+
+
+    def get(self, _client_id:int) -> Client_Session | None:
+        with self._lock:
+            return self._sessions.get(_client_id)
+
+
+    def discard(self, _client_id:int, _address:tuple[str, int]=None) -> Client_Session | None:
+        with self._lock:
+            _session = self._sessions.get(_client_id)
+            if _session is None or (_address is not None and _session.address != _address): return None
+            return self._sessions.pop(_client_id)
+
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return list(self._sessions.values())
@@ -4,130 +4,289 @@
 # Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
 
 
-import socket, threading
+import socket, threading, argparse, json, time, secrets, os
 from strategy import *
 from storage import *
-
-
-class Server(Storage_MixIn):
-    STRATEGY_DICTIONARY = {
-        "/?":         Command_List_Strategy(),
-        "/files":     File_List_On_The_Server_Strategy(),
-        "/delf":      Delete_File_Strategy(),
-        "/downl":     Send_File_Name_And_Size_Strategy(),
-        "/upl":       Receive_File_From_Client_Strategy(),
-        "/msg":       Private_Message_Strategy(),
-        "/bmsg":      Broadcast_Message_Strategy(),
-        "<conf>":     Send_File_To_Client_Strategy(),
-        "<file_inf>": Receive_File_From_Client_Strategy()
-    }
-
+from chunked_transfer import Chunked_Transfer_MixIn
+from batch import Batch_MixIn
+from data_channel import Data_Channel_MixIn
+from registry import Client_Registry, Client_Session
+from fanout import Outbound_Queue, POLICIES
+from compression import NONE, Transfer_Report, Decompressing_Writer, negotiate_compression, iterate_compressed
+from metrics import Server_Metrics, log, start_logging
+from bandwidth import Bandwidth_Scheduler, parse_rate, format_rate
+from message_store import Message_Store, Mailbox_Keys
+from upload_pipeline import SYNC_POLICIES
+from admission import Admission_Control, enable_keepalive
+from command_registry import COMMANDS, Route
+from file_watch import File_Watcher
+from protocol import Framed_Socket, Frame_Decoder, HEADER, COMMAND, encode_command
+
+
+class Server(Storage_MixIn, Chunked_Transfer_MixIn, Batch_MixIn, Data_Channel_MixIn):
     FORWARDING_DICTIONARY = {
         "svc":       lambda self, *args: self.send_message(*args) if args else '',
         "pvt":       lambda self, *args: self.check_if_there_is_message(*args) if args else '',
         "bdc":       lambda self, *args: self.check_if_there_are_more_than_one_client(*args) if args else '',
         "sfl":       lambda self, *args: self.send_file_to_client(*args) if args else '',
-        "recv_file": lambda self, *args: self.receive_file_from_client(*args) if args else ''
+        "dch":       lambda self, *args: self.serve_data_channel(*args) if args else '',
+        "inb":       lambda self, *args: self.deliver_offline_messages(*args) if args else '',
+        "srg":       lambda self, *args: self.send_file_range(*args) if args else '',
+        "sbr":       lambda self, *args: self.send_byte_range(*args) if args else '',
+        "rrg":       lambda self, *args: self.receive_file_range(*args) if args else '',
+        "bat":       lambda self, *args: self.execute_batch(*args) if args else '',
+        "blk":       lambda self, *args: self.send_blocking_reply(*args) if args else '',
+        "/exit":     lambda self, *args: None
     }
 
-
-    def __init__(self) -> None:
-        self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._server_socket.bind(('localhost', 10000))
-        self._server_socket.listen(4)
-        self._clients_list = dict()
-        self._lock = threading.Lock()
+    HOST                 = 'localhost'
+    PORT                 = 10000
+    REUSE_PORT           = False
+    SEND_CHUNK_SIZE      = 4 * 1024 * 1024
+    SEND_QUEUE_BYTES     = 1024 * 1024
+    SLOW_CONSUMER_POLICY = 'drop'
+    BACKPRESSURE_TIMEOUT = 5.0
+    LOG_LEVEL            = 'INFO'
+    GLOBAL_RATE          = 0
+    CLIENT_RATE          = 0
+    ADMIN_ADDRESSES      = ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+    WORKER_COUNT         = 1
+    WORKER_ID            = 0
+    MAILBOX_SIZE         = 1000
+    MAILBOX_DAYS         = 7.0
+    LISTEN_BACKLOG       = 1024
+    MAX_CLIENTS          = 4096
+    MAX_CLIENTS_PER_IP   = 0
+    IDLE_TIMEOUT         = 0
+    RETRY_AFTER          = 5.0
+    WATCH_INTERVAL       = 0.5
+    WATCH_POLL           = 5.0
+    PLUGIN_DIRECTORY     = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plugins')
+    UNKNOWN_COMMAND      = Route('?', Command_Not_Found_Strategy(), FORWARDING_DICTIONARY)
+
+
+    def __init__(self, _server_socket:object=None) -> None:
+        start_logging(self.LOG_LEVEL)
+        self._server_socket = _server_socket or self.create_server_socket()
+        self._clients = Client_Registry()
+        self._cluster = None
+        self._metrics = Server_Metrics()
+        self._bandwidth = Bandwidth_Scheduler(self.GLOBAL_RATE // self.WORKER_COUNT, self.CLIENT_RATE)
+        self._admission = Admission_Control(self.get_worker_share(self.MAX_CLIENTS), self.get_worker_share(self.MAX_CLIENTS_PER_IP), self.RETRY_AFTER)
         self.create_directory(Storage_MixIn.get_directory())
-        print(f'THE SERVER IS RUNNING: {self._server_socket.getsockname()}\n')
+        self.get_file_index()
+        if self.CONTENT_ADDRESSED: self.get_content_store()
+        if self.WORKER_COUNT == 1: self.remove_partial_uploads()
+        self._messages = self.open_message_store()
+        self._mailboxes = Mailbox_Keys(os.path.join(self.get_directory(), '.messages', 'keys'), self.MAILBOX_DAYS * 86400)
+        self._routes = self.compile_commands()
+        self._watcher = File_Watcher(self.get_file_index(), self.deliver_to_watchers, self.WATCH_INTERVAL, self.WATCH_POLL)
+        if self.IDLE_TIMEOUT: threading.Thread(target=self.reap_idle_sessions, daemon=True).start()
+        log.info(f'THE SERVER IS RUNNING: {self._server_socket.getsockname()}\n')
+
+
+    @classmethod
+    def create_server_socket(cls) -> object:
+        _server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        _server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if cls.REUSE_PORT: _server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        _server_socket.bind((cls.HOST, cls.PORT))
+        _server_socket.listen(cls.LISTEN_BACKLOG)
+        return _server_socket
+
+
+    @classmethod
+    def get_worker_share(cls, _limit:int) -> int:
+        # Limits are for the whole server: with SO_REUSEPORT each worker process enforces its part
+        return -(-_limit // cls.WORKER_COUNT)
+
+
+    @classmethod
+    def open_message_store(cls) -> Message_Store:
+        # One store per worker process, so appends never need a lock shared between processes
+        _directory = os.path.join(cls.get_directory(), '.messages', str(cls.WORKER_ID))
+        return Message_Store(_directory, cls.MAILBOX_SIZE, cls.MAILBOX_DAYS * 86400).open()
+
+
+    def join_cluster(self, _cluster_link:object) -> None:
+        self._cluster = _cluster_link
+        self._cluster.start(self)
+
+
+    def deliver_from_cluster(self, _client_id:int | None, _frame:bytes) -> None:
+        if _client_id is None:
+            for session in self._clients.snapshot(): session.send_queue.put(_frame)
+            return
+        # Without the recipient, or with its queue full, a claimed mailbox keeps the message
+        _session = self._clients.get(_client_id)
+        if (not _session or not _session.send_queue.put(_frame)) and self._mailboxes.is_claimed(_client_id):
+            self._messages.put(_client_id, _frame)
+
+
+    def deliver_to_watchers(self, _deliveries:list) -> None:
+        # Called from the watcher thread with (client id, encoded <watch> frame) pairs
+        for client_id, frame in _deliveries:
+            if (_session := self._clients.get(client_id)): _session.send_queue.put(frame)
+
+
+    def count_logged_clients(self) -> int:
+        return len(self._clients) + (self._cluster.count_remote_clients() if self._cluster else 0)
 
 
     def receive_client(self) -> None:
         while True:
             _client_socket, _client_address = self._server_socket.accept()
-            self.add_client_to_the_list(_client_socket, _client_address)
-            print(f'New log in: {_client_address}')
-            threading.Thread(target=self.handle_client, args=(_client_address, _client_socket,)).start()
+            if (_reason := self._admission.admit(_client_address[0])):
+                self.refuse_connection(_client_socket, _reason)
+                continue
+            enable_keepalive(_client_socket)
+            _framed_socket = Framed_Socket(_client_socket)
+            if not self.add_client_to_the_list(_framed_socket, _client_address):
+                self.refuse_connection(_client_socket, f'client id {_client_address[1]} is in use')
+                self._admission.release(_client_address[0])
+                continue
+            log.info(f'New log in: {_client_address}')
+            threading.Thread(target=self.handle_client, args=(_client_address, _framed_socket,)).start()
+
+
+    def refuse_connection(self, _client_socket:socket.socket, _reason:str) -> None:
+        try:     _client_socket.sendall(self.get_refusal(_reason))
+        except OSError: pass
+        finally: _client_socket.close()
+
+
+    def get_refusal(self, _reason:str) -> bytes:
+        _retry_after = self._admission.get_retry_after()
+        log.debug(f'Connection refused: {_reason}')
+        return encode_command(f'<busy>:{_retry_after}||SERVER: {_reason}, retry after {_retry_after} s')
+
 
+    def add_client_to_the_list(self, _client_socket:object, _client_address:tuple[str, int]) -> bool:
+        _send_queue = self.create_send_queue(_client_socket)
+        if not self._clients.add(Client_Session(_client_address[1], _client_socket, _client_address, _send_queue)):
+            _send_queue.close()
+            return False
+        _client_socket.limiter = self._bandwidth.get_limiter(_client_address[1])
+        if self._cluster: self._cluster.publish('join', _client_address[1])
+        return True
 
-    def add_client_to_the_list(self, _client_socket:object, _client_address:tuple[str, int]) -> None:
-        with self._lock:
-            self._clients_list[_client_address] = _client_socket
+
+    def create_send_queue(self, _client_socket:object) -> Outbound_Queue:
+        return Outbound_Queue(_client_socket, self.SEND_QUEUE_BYTES, self.SLOW_CONSUMER_POLICY, self.BACKPRESSURE_TIMEOUT).start()
 
 
     def remove_client_from_the_list(self, _client_address:tuple[str, int]) -> None:
-        with self._lock:
-            if _client_address in self._clients_list:
-                del self._clients_list[_client_address]
+        _session = self._clients.discard(_client_address[1], _client_address)
+        if not _session: return
+        _session.send_queue.close()
+        self._bandwidth.discard(_client_address[1])
+        self._watcher.unsubscribe(_client_address[1])
+        if self._cluster: self._cluster.publish('leave', _client_address[1])
 
 
     def close_connection(self, _client_port:int) -> None:
         _client_address, _client_socket = self.get_client_address_and_socket(_client_port)
-        if _client_socket:
-            self.send_message(_client_socket, '<close>')
-            _client_socket.close()
+        if not _client_socket: return
+        self.send_message(_client_socket, '<close>')
+        _client_socket.close()
         self.remove_client_from_the_list(_client_address)
-        print(f'Connection with {_client_address} closed.')
+        log.info(f'Connection with {_client_address} closed.')
 
     
-    def get_client_address_and_socket(self, _client_port:int) -> tuple[str, int]:
-        with self._lock:
-            for client_address, client_socket in self._clients_list.items():
-                if client_address[1] == _client_port:
-                    return (client_address, client_socket)
+    def get_client_address_and_socket(self, _client_port:int) -> tuple[tuple[str, int], object]:
+        _session = self._clients.get(_client_port)
+        if _session is None: return (None, None)
+        return (_session.address, _session.socket)
 
 
     def handle_client(self, _client_address:tuple[str, int], _client_socket:object) -> None:
         try:   
             self.loop_to_receive_data_from_clients(_client_address, _client_socket)
         except (ConnectionResetError, OSError): 
-            print(f'Client {_client_address[1]} disconnected abruptly.')
+            log.info(f'Client {_client_address[1]} disconnected abruptly.')
         except Exception as error:
-            print(f'Error with client {_client_address}: {error}')
+            log.warning(f'Error with client {_client_address}: {error}')
             self.send_message(_client_socket, '<single>:SERVER: There is something wrong in your request')
         finally:
             self.remove_client_from_the_list(_client_address)
+            self._admission.release(_client_address[0])
             try:   _client_socket.close()
-            except OSError: print(f'Error closing socket for {_client_address}')
+            except OSError: log.warning(f'Error closing socket for {_client_address}')
 
 
-    def loop_to_receive_data_from_clients(self, _client_address:tuple[str, int], _client_socket:object) -> None:
+    def reap_idle_sessions(self) -> None:
+        # Sessions without a request for IDLE_TIMEOUT seconds are disconnected; their handler cleans up as usual
         while True:
-            _received_data          = _client_socket.recv(1024).decode()
-            _method_key, _arguments = self.separate_function_from_arguments(_received_data)
-            _forward_flag, _data    = self.check_if_the_method_exists(_client_address[1], _method_key, _arguments)
-            if _forward_flag == '/exit': break
-            print(f'{_client_address[1]}> {_method_key}')
-            self.get_forward_dictionary().get(_forward_flag, lambda *args: None)(self, _client_socket, _data)
+            time.sleep(max(1.0, self.IDLE_TIMEOUT / 4))
+            _oldest = time.monotonic() - self.IDLE_TIMEOUT
+            for session in self._clients.snapshot():
+                if session.last_active < _oldest: self.reap_session(session)
 
 
-    @staticmethod
-    def separate_function_from_arguments(_string:str) -> tuple[str, str]:
-        _method_key, _args = (_string.split(':', 1) + [None])[:2]
-        return (_method_key, _args)
+    def reap_session(self, _session:Client_Session) -> None:
+        log.info(f'Client {_session.client_id} idle for more than {self.IDLE_TIMEOUT} s, disconnected')
+        self._admission.reaped += 1
+        self.abort_connection(_session.socket)
+
+
+    def abort_connection(self, _client_socket:object) -> None:
+        try:    _client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+
+    def loop_to_receive_data_from_clients(self, _client_address:tuple[str, int], _client_socket:object) -> None:
+        while (_frame := _client_socket.receive_frame()) is not None:
+            _frame_type, _method_key, _payload = _frame
+            if _frame_type != COMMAND: continue
+            _start = self._metrics.start_request(_client_socket)
+            try:
+                _forward_flag, _ = self.dispatch_request(_client_address, _client_socket, _method_key, Frame_Decoder.get_arguments(_payload))
+            except Exception:
+                self.record_request(_method_key, _payload, _start, _client_socket, False)
+                raise
+            self.record_request(_method_key, _payload, _start, _client_socket)
+            if _forward_flag in ('/exit', 'dch'): break
+
+
+    def record_request(self, _method_key:str, _payload:bytes, _start:tuple, _client_socket:object, _ok:bool=True) -> None:
+        # Unknown keys share one entry, so a client sending random keys can not grow the table
+        _request_size = HEADER.size + len(_method_key) + len(_payload)
+        if _method_key not in self._routes: _method_key = '?'
+        self._metrics.finish_request(_method_key, _start, _client_socket, _request_size, _ok)
+
+
+    def dispatch_request(self, _client_address:tuple[str, int], _client_socket:object, _method_key:str, _arguments:str) -> tuple[str, object]:
+        _route = self._routes.get(_method_key, self.UNKNOWN_COMMAND)
+        if (_session := self._clients.get(_client_address[1])):
+            _session.requests   += 1
+            _session.last_active = time.monotonic()
+        log.debug(f'{_client_address[1]}> {_method_key}')
+        return _route.handle(self, _client_socket, _client_address[1], _arguments)
 
 
     def check_if_the_method_exists(self, _client_port:int, _method_key:str, _arguments:str) -> tuple[str, str]:
-        if _method_key == '/exit' or _method_key in self.get_strategy_dictionary():
-            _forward_flag, _data = self.get_result(_client_port, _method_key, _arguments)
-        else:
-            _forward_flag, _data = 'svc', '<single>:SERVER: Command not found'
-        return (_forward_flag, _data)
-
-
-    def get_result(self, _client_port:int, _method_key:str, _arguments:str) -> tuple[str, str]:
-        match _method_key:
-            case '/exit':
-                self.close_connection(_client_port)
-                _forward_flag, _data = _method_key, None
-            case _:
-                _strategy = self.get_strategy_dictionary().get(_method_key)
-                _forward_flag, _data = _strategy.execute(self, _client_port, _arguments)
-        return (_forward_flag, _data)
+        return self._routes.get(_method_key, self.UNKNOWN_COMMAND).execute(self, _client_port, _arguments)
 
 
-    @classmethod
-    def get_strategy_dictionary(cls) -> dict:
-        return cls.STRATEGY_DICTIONARY
+    def compile_commands(self) -> dict:
+        # Plugins are imported before the first compile, so every worker starts with the same commands
+        for line in COMMANDS.reload_plugins(self.PLUGIN_DIRECTORY): log.info(f'Plugin {line}')
+        return COMMANDS.compile(self.get_forward_dictionary())
+
+
+    def reload_commands(self, _from_cluster:bool=False) -> str:
+        # The table is swapped in one assignment: requests already dispatched finish on the old routes,
+        # connected clients keep their sessions and get the new commands on their next request
+        _report  = COMMANDS.reload_plugins(self.PLUGIN_DIRECTORY)
+        self._routes = COMMANDS.compile(self.get_forward_dictionary())
+        if self._cluster and not _from_cluster: self._cluster.publish('reload')
+        log.info(f'Commands reloaded: {len(self._routes)} routes')
+        return f'<mult>:{self.convert_to_string([f"{len(self._routes)} commands"] + _report)}'
+
+
+    def get_command_list(self) -> str:
+        _plugins = [route.strategy.HELP for route in self._routes.values() if route.strategy.HELP and COMMANDS.is_plugin(route.strategy)]
+        return '<<SEP>>'.join([Storage_MixIn.get_command_list()] + _plugins)
 
 
     @classmethod
@@ -137,7 +296,12 @@ class Server(Storage_MixIn):
 
     @staticmethod
     def send_message(_client_socket:object, _data:str) -> None:
-        _client_socket.sendall(_data.encode())
+        _client_socket.sendall(encode_command(_data))
+
+
+    def send_blocking_reply(self, _client_socket:object, _job:callable) -> None:
+        # _job builds the reply with disk work (hashing a file); the event loop runs it in a thread
+        self.send_message(_client_socket, _job())
 
 
     def prepare_private_message(self, _client_port:int, _message:str='') ->str:
@@ -151,19 +315,73 @@ class Server(Storage_MixIn):
     def check_if_there_is_message(self, _client_socket:object, _client_and_message:str) -> None:
          _client_port, _message = _client_and_message.split(':', 1)
          if not _message: self.send_message(_client_socket, '<single>:SERVER: Empty messages can not be sent')
-         else: self.check_if_the_client_id_is_valid(_client_socket, _client_port, _message)
+         else: return self.check_if_the_client_id_is_valid(_client_socket, _client_port, _message)
 
 
     def check_if_the_client_id_is_valid(self, _client_socket:object, _client_port:str, _message:str) -> None:
         try:    _client_port = int(_client_port)
         except: self.send_message(_client_socket, '<single>:SERVER: User ID invalid')
-        else:   self.check_if_the_client_is_logged_now(_client_socket, _client_port, _message)
+        else:   return self.check_if_the_client_is_logged_now(_client_socket, _client_port, _message)
 
 
     def check_if_the_client_is_logged_now(self, _client_socket:object, _target_client_id:int, _message:str) -> None:
-        _target_client_socket  = next((client_socket for (ip, port), client_socket in self._clients_list.items() if port == _target_client_id), None)
-        if not _target_client_socket: _target_client_socket, _message = _client_socket, '<single>:SERVER: The client is not logged now'
-        self.send_message(_target_client_socket, _message)
+        # A live session with the id gets the message; the mailbox is only for ids nobody holds now
+        _target_session = self._clients.get(_target_client_id)
+        if not _target_session and self._cluster and self._cluster.is_remote(_target_client_id):
+            return self._cluster.publish('private', _target_client_id, encode_command(_message))
+        if not _target_session: return self.store_offline_message(_client_socket, _target_client_id, _message)
+        _target_session.send_queue.put(encode_command(_message))
+        return self.wait_for_slow_consumers([_target_session.send_queue])
+
+
+    def store_offline_message(self, _client_socket:object, _target_client_id:int, _message:str) -> None:
+        if not 0 < _target_client_id < 65536: return self.send_message(_client_socket, '<single>:SERVER: User ID invalid')
+        if not self._mailboxes.is_claimed(_target_client_id):
+            return self.send_message(_client_socket, f'<single>:SERVER: Client {_target_client_id} is not logged in and has no mailbox')
+        self._messages.put(_target_client_id, encode_command(_message))
+        self.send_message(_client_socket, '<single>:SERVER: The client is not logged now, the message will be delivered when it logs in')
+
+
+    def log_in(self, _client_port:int, _secret:str=None) -> tuple[str, object]:
+        # /login claims the mailbox of the client id and returns its secret; /login:secret opens it later
+        _session = self._clients.get(_client_port)
+        if not _session: return ('svc', '<single>:SERVER: Not connected')
+        if not _secret:
+            if (_secret := self._mailboxes.claim(_client_port)) is None:
+                return ('svc', f'<single>:SERVER: Client {_client_port} already has a mailbox, log in with its secret')
+            _session.logged_in = True
+            return ('svc', f'<login>:{_client_port}||{_secret}')
+        if not self._mailboxes.verify(_client_port, _secret): return ('svc', f'<single>:SERVER: Wrong secret for client {_client_port}')
+        _session.logged_in = True
+        return ('inb', _client_port)
+
+
+    def open_mailbox(self, _client_port:int) -> tuple[str, object]:
+        if not ((_session := self._clients.get(_client_port)) and _session.logged_in):
+            return ('svc', '<single>:SERVER: Log in first with /login')
+        return ('inb', _client_port)
+
+
+    def deliver_offline_messages(self, _client_socket:object, _client_port:int) -> object:
+        # One frame per message, in order; only those the send queue accepted are marked delivered, the
+        # rest stay in the mailbox for the next /inbox. The summary is queued even over the limit.
+        if not (_session := self._clients.get(_client_port)): return self.send_message(_client_socket, '<single>:SERVER: Not connected')
+        if self._cluster: self._cluster.publish('inbox', _client_port)
+        _pending, _delivered = self._messages.peek(_client_port, self._mailboxes.get_claimed_at(_client_port)), 0
+        for _, frame in _pending:
+            if not _session.send_queue.put(frame): break
+            _delivered += 1
+        if _delivered: self._messages.acknowledge(_client_port, _pending[_delivered - 1][0])
+        _summary = f'<single>:SERVER: {_delivered} offline messages'
+        if _delivered < len(_pending): _summary += f', {len(_pending) - _delivered} still waiting, get them with /inbox'
+        if self._cluster: _summary += ' (more may come from other workers)'
+        _session.send_queue.put(encode_command(_summary), True)
+        return self.wait_for_slow_consumers([_session.send_queue])
+
+
+    def forward_offline_messages(self, _client_port:int) -> None:
+        # Another worker has the client: the messages stored here go to it through the master
+        for frame in self._messages.take(_client_port, self._mailboxes.get_claimed_at(_client_port)): self._cluster.publish('private', _client_port, frame)
 
     
     def prepare_broadcast_message(self, _client_port:int, _message:str) -> str:
@@ -172,53 +390,265 @@ class Server(Storage_MixIn):
 
 
     def check_if_there_are_more_than_one_client(self, _client_socket:object, _message:str) -> None:
-        if len(self._clients_list) > 1: self.send_broadcast_message(_message)
+        if self.count_logged_clients() > 1: return self.send_broadcast_message(_message)
         else: self.send_message(_client_socket, '<single>:SERVER: You are the only one logged now')
 
 
     def send_broadcast_message(self, _message:str) -> None:
-        with self._lock:
-            for client_socket in self._clients_list.values():
-                self.send_message(client_socket, _message)
+        _frame  = encode_command(_message)
+        _queues = [session.send_queue for session in self._clients.snapshot()]
+        for queue in _queues:
+            queue.put(_frame)
+        if self._cluster: self._cluster.publish('broadcast', _frame)
+        return self.wait_for_slow_consumers(_queues)
+
+
+    def wait_for_slow_consumers(self, _queues:list) -> None:
+        # Threaded queues already block the producer inside put() under the backpressure policy
+        return None
+
+
+    def collect_queue_statistics(self) -> dict:
+        _queues = [session.send_queue for session in self._clients.snapshot()]
+        return {
+            'clients':        len(_queues),
+            'queued_bytes':   sum(queue.depth for queue in _queues),
+            'deepest_queue':  max((queue.depth for queue in _queues), default=0),
+            'high_water':     max((queue.high_water for queue in _queues), default=0),
+            'frames_sent':    sum(queue.sent for queue in _queues),
+            'bytes_sent':     sum(queue.sent_bytes for queue in _queues),
+            'frames_dropped': sum(queue.dropped for queue in _queues)
+        }
+
+
+    def get_queue_statistics(self) -> str:
+        _queues = self.collect_queue_statistics()
+        _statistics = (
+            f'Policy.........: {self.SLOW_CONSUMER_POLICY} ({self.SEND_QUEUE_BYTES} bytes per client)',
+            f'Clients........: {_queues["clients"]}',
+            f'Queued bytes...: {_queues["queued_bytes"]}',
+            f'Deepest queue..: {_queues["deepest_queue"]}',
+            f'High water.....: {_queues["high_water"]}',
+            f'Frames sent....: {_queues["frames_sent"]} ({_queues["bytes_sent"]} bytes)',
+            f'Frames dropped.: {_queues["frames_dropped"]}'
+        )
+        return f'<mult>:{self.convert_to_string(_statistics)}'
+
+
+    def watch_files(self, _client_port:int, _prefix:str='') -> str:
+        self._watcher.subscribe(_client_port, _prefix)
+        _files = f"files starting with '{_prefix}'" if _prefix else 'all files'
+        return f'<single>:SERVER: Watching {_files}, changes are sent every {self._watcher.interval} s'
+
+
+    def unwatch_files(self, _client_port:int) -> str:
+        if not self._watcher.unsubscribe(_client_port): return '<single>:SERVER: You are not watching files'
+        return '<single>:SERVER: No longer watching files'
+
+
+    def configure_bandwidth(self, _arguments:str=None, _from_cluster:bool=False, _client_port:int=None) -> str:
+        # With workers the global rate is split evenly between them, each one enforces its share.
+        # Anyone may read the limits, only admin sessions change them.
+        if not _arguments: return self.get_bandwidth_limits()
+        try:
+            _scope, _rate = _arguments.split('||')
+            _rate = parse_rate(_rate)
+        except (ValueError, IndexError):
+            return '<single>:SERVER: Use /bandwidth:global||rate, /bandwidth:clients||rate or /bandwidth:<client>||rate (rates like 512K, 10M or 0)'
+        if not _from_cluster and not self.is_admin(_client_port):
+            return '<single>:SERVER: Only an admin session can change the bandwidth limits'
+        match _scope:
+            case 'global':  self._bandwidth.set_global_rate(_rate // self.WORKER_COUNT)
+            case 'clients': self._bandwidth.set_client_rate(_rate)
+            case _ if _scope.isdigit():
+                _found = self._bandwidth.set_client_rate(_rate, int(_scope))
+                if not _found and not _from_cluster and not (self._cluster and self._cluster.is_remote(int(_scope))):
+                    return '<single>:SERVER: Client not found'
+            case _:
+                return '<single>:SERVER: The scope must be global, clients or a client number'
+        if self._cluster and not _from_cluster: self._cluster.publish('bandwidth', _arguments)
+        return f'<single>:SERVER: Bandwidth of {_scope} set to {format_rate(_rate)}'
+
+
+    def is_admin(self, _client_port:int) -> bool:
+        # Sessions connected from ADMIN_ADDRESSES (the local host by default)
+        _session = self._clients.get(_client_port)
+        return _session is not None and _session.address[0] in self.ADMIN_ADDRESSES
+
+
+    def get_bandwidth_limits(self) -> str:
+        _limits = self._bandwidth.describe()
+        _lines  = [f'Global.........: {format_rate(_limits["global_rate"] * self.WORKER_COUNT)}',
+                   f'Per client.....: {format_rate(_limits["client_rate"])}',
+                   f'Throttled......: {_limits["throttled_seconds"]} s of waiting']
+        _lines += [f'Client {client_id}...: {format_rate(rate)}' for client_id, rate in _limits['overrides'].items()]
+        return f'<mult>:{self.convert_to_string(_lines)}'
+
+
+    def get_server_statistics(self, _arguments:str=None) -> str:
+        _statistics = {
+            'uptime_seconds': round(time.time() - self._metrics.started_at, 1),
+            'active_clients': len(self._clients),
+            'remote_clients': self._cluster.count_remote_clients() if self._cluster else 0,
+            'queues':         self.collect_queue_statistics(),
+            'admission':      self._admission.describe(),
+            'open_files':     self.get_open_file_cache().describe(),
+            'uploads':        dict(self.get_upload_buffers().describe(), fsync=self.UPLOAD_SYNC),
+            'bandwidth':      self._bandwidth.describe(),
+            'offline':        self._messages.describe(),
+            'watch':          self._watcher.describe(),
+            'commands':       self._metrics.snapshot()
+        }
+        if _arguments == 'json': return f'<single>:{json.dumps(_statistics)}'
+        _queues = _statistics['queues']
+        _lines  = [f'Uptime.........: {_statistics["uptime_seconds"]} s',
+                   f'Clients........: {_statistics["active_clients"]} here, {_statistics["remote_clients"]} on other workers',
+                   f'Fan-out........: {_queues["frames_sent"]} frames, {_queues["frames_dropped"]} dropped, {_queues["queued_bytes"]} bytes queued',
+                   'Connections....: {connections} open, {peak} peak, {accepted} accepted, {refused_full} refused (full), {refused_address} refused (per IP), {reaped} idle reaped'.format(**_statistics['admission']),
+                   'Open files.....: {open}/{capacity} cached, {hits} hits, {misses} misses, {evictions} evictions'.format(**_statistics['open_files']),
+                   'Uploads........: {allocated} buffers of {buffer_size} bytes, {idle} idle, fsync {fsync}'.format(**_statistics['uploads']),
+                   'Offline msgs...: {pending} pending for {recipients} clients, {stored} stored, {delivered} delivered, {expired} expired, {dropped} dropped'.format(**_statistics['offline']),
+                   'File watch.....: {subscribers} subscribers, {events} events in {frames} frames, {rescans} rescans, poll {poll} s'.format(**_statistics['watch'])]
+        for key, command in _statistics['commands'].items():
+            _lines.append(f'{key:.<12} {command["requests"]} req, {command["errors"]} err, p50 {command["p50_ms"]} ms, '
+                          f'p99 {command["p99_ms"]} ms, p999 {command["p999_ms"]} ms, in {command["bytes_in"]} B, '
+                          f'out {command["bytes_out"]} B, {command["mb_per_s"]} MB/s')
+        return f'<mult>:{self.convert_to_string(_lines)}'
 
 
     @staticmethod 
-    def separete_file_infomation(_file_name_and_size:str) -> tuple[str, int]:
-        _file_name, _file_size = (_file_name_and_size.split('||'))
+    def separete_file_infomation(_file_name_and_size:str) -> tuple:
+        _file_name, _file_size, *_checksum = (_file_name_and_size.split('||'))
         _file_size = int(_file_size)
-        return (_file_name, _file_size)
+        return (_file_name, _file_size, *_checksum)
+
+
+    def check_file_to_send(self, _arguments:str) -> tuple | str:
+        # <conf> repeats the name and size of a <confirm>; both come from the client, so they are checked again
+        _file_name, _file_size, *_options = self.separete_file_infomation(_arguments)
+        _entry = self.get_file_index().get(_file_name)
+        if not _entry: return '<single>:SERVER: file not found'
+        if _entry.size != _file_size: return f'<single>:SERVER: {_file_name} changed, download it again'
+        return (_file_name, _file_size, *_options)
+
 
+    def send_file_to_client(self, _client_socket:object, _file_information:tuple | str) -> None:
+        if isinstance(_file_information, str): return self.send_message(_client_socket, _file_information)
+        _file_name, _file_size, *_options = _file_information
+        _codec, _level = negotiate_compression(_file_name, *_options[:2])
+        with self.get_open_file_cache().open_file(_file_name) as cached:
+            if _codec == NONE: return _client_socket.send_file(cached.file, 0, _file_size, self.SEND_CHUNK_SIZE)
+            for data in iterate_compressed(cached.get_reader(), _file_size, _codec, _level, Transfer_Report(_codec, _level)):
+                _client_socket.send_data(data)
 
-    def send_file_to_client(self, _client_socket:object, _file_name_and_size:tuple[str, int]) -> None:
-        _file_name, _file_size = _file_name_and_size
-        with open(self.get_directory() + _file_name, 'rb') as file:
-            _sent_data = 0
-            while _sent_data < _file_size:
-                _data = file.read(1024)
-                _client_socket.send(_data)
-                _sent_data += len(_data)
 
+    def offer_upload(self, _client_port:int, _file_information:tuple) -> str:
+        _file_name, _file_size, *_options = _file_information
+        if _options and self.store_known_content(_file_name, _file_size, _options[0]):
+            return '<single>:SERVER: file received (content already stored, upload skipped)'
+        _codec, _level = negotiate_compression(_file_name, *_options[1:3])
+        _ticket = self.issue_ticket('upl', _client_port, (_file_name, _file_size, _codec, _level))
+        return f'<send_file>:{_file_name}||{_file_size}||{_codec}||{_level}||{_ticket}'
 
-    def receive_file_from_client(self, _client_socket:object, _file_name_and_size:tuple[str, int]) -> None:
-        _file_name, _file_size = _file_name_and_size
-        _result = '<single>:SERVER: File received'
-        self.send_message(_client_socket, f'<send_file>:{_file_name}||{_file_size}')
-        try:    self.write_file(_client_socket, _file_name, _file_size)
+
+    def prepare_to_receive_file(self, _file_information:tuple) -> Transfer_Report:
+        _file_name, _file_size, _codec, _level = _file_information
+        return Transfer_Report(_codec, _level)
+
+
+    def receive_file_from_client(self, _client_socket:object, _file_information:tuple) -> None:
+        _file_name, _file_size, *_ = _file_information
+        _report = self.prepare_to_receive_file(_file_information)
+        try:    self.write_file(_client_socket, _file_name, _file_size, _report)
         except: _result = '<single>:SERVER: error while receiving the file'
-        else:   _result = '<single>:SERVER: file received'
+        else:   _result = f'<single>:SERVER: file received ({_report.describe()})'
         self.send_message(_client_socket, _result)
 
 
-    def write_file(self, _client_socket:object, _file_name:str, _file_size:int) -> None:
-        with open(self.get_directory() + _file_name, 'wb') as file:
-            _received_data = 0
-            while _received_data < _file_size:
-                _data = _client_socket.recv(1024)
-                file.write(_data)
-                _received_data += len(_data)
+    def write_file(self, _client_socket:object, _file_name:str, _file_size:int, _report:Transfer_Report) -> None:
+        # The socket is read into pool buffers while the writer stage writes the previous ones to a
+        # temporary file; the stored name switches to it only when the upload is complete
+        _upload = self.open_upload(_file_name)
+        try:
+            if _report.codec != NONE:
+                _writer = Decompressing_Writer(_upload, _report.codec, _report, _file_size)
+                while _writer.write(_client_socket.receive_data()): pass
+                _writer.finish()
+            else:
+                self.receive_into_buffers(_client_socket, _upload, _file_size, _report)
+            _temporary_path = _upload.finish()
+        except:
+            _upload.abort()
+            raise
+        self.install_file(_temporary_path, _file_name, _upload.checksum)
 
 
+    @staticmethod
+    def receive_into_buffers(_client_socket:object, _upload:object, _file_size:int, _report:Transfer_Report) -> None:
+        while _report.raw_bytes < _file_size:
+            _buffer = _upload.get_buffer()
+            _view   = memoryview(_buffer)
+            _limit  = min(len(_buffer), _file_size - _report.raw_bytes)
+            _filled = 0
+            while _filled < _limit: _filled += _client_socket.receive_data_into(_view[_filled:_limit])
+            _upload.write(_view[:_filled], _buffer)
+            _report.raw_bytes += _filled
+        _report.wire_bytes = _report.raw_bytes
+
 
 if __name__ == '__main__':
-    server = Server()
-    server.receive_client()
+    parser = argparse.ArgumentParser(description='simple_server')
+    parser.add_argument('--mode', choices=('thread', 'async'), default='thread', help='thread per client or a single event loop')
+    parser.add_argument('--port', type=int, default=Server.PORT, help='TCP port to listen on')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes sharing the port')
+    parser.add_argument('--chunk-size', type=int, default=Server.SEND_CHUNK_SIZE, help='bytes per DATA frame on downloads')
+    parser.add_argument('--send-queue', type=int, default=Server.SEND_QUEUE_BYTES, help='outbound queue limit per client, in bytes')
+    parser.add_argument('--backlog', type=int, default=Server.LISTEN_BACKLOG, help='connections the kernel queues before accept()')
+    parser.add_argument('--max-clients', type=int, default=Server.MAX_CLIENTS, help='connections served at once, 0 for no limit')
+    parser.add_argument('--max-clients-per-ip', type=int, default=Server.MAX_CLIENTS_PER_IP, help='connections served at once per IP address, 0 for no limit')
+    parser.add_argument('--idle-timeout', type=float, default=Server.IDLE_TIMEOUT, help='seconds without a request before a client is disconnected, 0 to keep it')
+    parser.add_argument('--retry-after', type=float, default=Server.RETRY_AFTER, help='seconds a refused client is told to wait, spread up to twice that')
+    parser.add_argument('--global-rate', type=parse_rate, default=0, help='bandwidth of all file transfers together, like 50M (bytes/s)')
+    parser.add_argument('--client-rate', type=parse_rate, default=0, help='bandwidth of the file transfers of each client, like 5M (bytes/s)')
+    parser.add_argument('--mailbox-size', type=int, default=Server.MAILBOX_SIZE, help='offline messages kept per client, the oldest are dropped')
+    parser.add_argument('--mailbox-days', type=float, default=Server.MAILBOX_DAYS, help='days an offline message is kept, and a mailbox without a login')
+    parser.add_argument('--open-files', type=int, default=Server.OPEN_FILE_LIMIT, help='open file handles kept for downloads')
+    parser.add_argument('--fsync', choices=SYNC_POLICIES, default=Server.UPLOAD_SYNC, help='when uploaded files are synced to disk')
+    parser.add_argument('--dedup', action='store_true', help='content-addressed storage, identical uploads are stored once')
+    parser.add_argument('--watch-poll', type=float, default=Server.WATCH_POLL, help='seconds between full rescans for /watch, which catch files rewritten in place')
+    parser.add_argument('--admin-address', action='append', help='address whose sessions may change server-wide settings such as /bandwidth:global (repeatable, default: the local host)')
+    parser.add_argument('--plugins', default=Server.PLUGIN_DIRECTORY, help='directory of command plugins, reloaded with /reload')
+    parser.add_argument('--slow-consumer', choices=POLICIES, default=Server.SLOW_CONSUMER_POLICY, help='what to do when a client queue is full')
+    parser.add_argument('--log-level', choices=('debug', 'info', 'warning'), default='info', help='debug also logs every request')
+    arguments = parser.parse_args()
+    if arguments.mode == 'async': from async_server import Async_Server as Server
+    settings = {
+        'PORT':                 arguments.port,
+        'SEND_CHUNK_SIZE':      arguments.chunk_size,
+        'SEND_QUEUE_BYTES':     arguments.send_queue,
+        'LISTEN_BACKLOG':       arguments.backlog,
+        'MAX_CLIENTS':          arguments.max_clients,
+        'MAX_CLIENTS_PER_IP':   arguments.max_clients_per_ip,
+        'IDLE_TIMEOUT':         arguments.idle_timeout,
+        'RETRY_AFTER':          arguments.retry_after,
+        'SLOW_CONSUMER_POLICY': arguments.slow_consumer,
+        'CONTENT_ADDRESSED':    arguments.dedup,
+        'OPEN_FILE_LIMIT':      arguments.open_files,
+        'UPLOAD_SYNC':          arguments.fsync,
+        'MAILBOX_SIZE':         arguments.mailbox_size,
+        'MAILBOX_DAYS':         arguments.mailbox_days,
+        'GLOBAL_RATE':          arguments.global_rate,
+        'CLIENT_RATE':          arguments.client_rate,
+        'LOG_LEVEL':            arguments.log_level,
+        'PLUGIN_DIRECTORY':     arguments.plugins,
+        'WATCH_POLL':           arguments.watch_poll,
+        'ADMIN_ADDRESSES':      tuple(arguments.admin_address or Server.ADMIN_ADDRESSES),
+        'DATA_CHANNEL_SECRET':  secrets.token_bytes(32)
+    }
+    for name, value in settings.items(): setattr(Server, name, value)
+    if arguments.workers > 1:
+        from cluster import Cluster
+        Cluster(Server, arguments.workers, settings).run()
+    else:
+        server = Server()
+        server.receive_client()
@@ -5,11 +5,27 @@
 
 
 import platform, os
+from file_index import File_Index
+from content_store import Content_Store
+from file_cache import Open_File_Cache
+from compression import negotiate_compression
+from upload_pipeline import Buffer_Pool, Upload_Writer, UPLOAD_SUFFIX, sync_directory
 
 class Storage_MixIn:
     DIRECTORY = os.path.dirname(os.path.abspath(__file__))
     if platform.system() == 'Windows': DIRECTORY += '\\server_folder\\'
     elif platform.system() == 'Linux': DIRECTORY += '/server_folder/'
+    HIDDEN_SUFFIXES   = ('.part',)
+    PAGE_SIZE         = 100
+    FILE_INDEX        = None
+    CONTENT_STORE     = None
+    CONTENT_ADDRESSED = False
+    OPEN_FILES        = None
+    OPEN_FILE_LIMIT   = 64
+    UPLOAD_BUFFERS    = None
+    UPLOAD_BUFFER     = 1024 * 1024
+    UPLOAD_SYNC       = 'close'
+    UPLOAD_DIRECTORY  = '.uploads'
    
 
     @classmethod
@@ -17,6 +33,80 @@ class Storage_MixIn:
         return cls.DIRECTORY
 
 
+    @classmethod
+    def get_file_index(cls) -> File_Index:
+        if Storage_MixIn.FILE_INDEX is None:
+            Storage_MixIn.FILE_INDEX = File_Index(cls.get_directory(), cls.HIDDEN_SUFFIXES)
+            Storage_MixIn.FILE_INDEX.build()
+        return Storage_MixIn.FILE_INDEX
+
+
+    @classmethod
+    def get_content_store(cls) -> Content_Store:
+        if Storage_MixIn.CONTENT_STORE is None:
+            Storage_MixIn.CONTENT_STORE = Content_Store(cls.get_directory(), cls.UPLOAD_SYNC != 'none')
+            Storage_MixIn.CONTENT_STORE.load()
+        return Storage_MixIn.CONTENT_STORE
+
+
+    @classmethod
+    def get_open_file_cache(cls) -> Open_File_Cache:
+        if Storage_MixIn.OPEN_FILES is None:
+            Storage_MixIn.OPEN_FILES = Open_File_Cache(cls.get_directory(), cls.OPEN_FILE_LIMIT)
+        return Storage_MixIn.OPEN_FILES
+
+
+    @classmethod
+    def get_upload_buffers(cls) -> Buffer_Pool:
+        if Storage_MixIn.UPLOAD_BUFFERS is None:
+            Storage_MixIn.UPLOAD_BUFFERS = Buffer_Pool(cls.UPLOAD_BUFFER, 16)
+        return Storage_MixIn.UPLOAD_BUFFERS
+
+
+    @classmethod
+    def open_upload(cls, _file_name:str, _blocking:bool=True) -> Upload_Writer:
+        return Upload_Writer(cls.get_directory() + _file_name, cls.UPLOAD_SYNC, cls.get_upload_buffers(), _blocking,
+                             cls.CONTENT_ADDRESSED, cls.get_directory() + cls.UPLOAD_DIRECTORY)
+
+
+    @classmethod
+    def install_file(cls, _temporary_path:str, _file_name:str, _checksum:str=None) -> None:
+        # One rename puts the new content in place: downloads that opened the old file keep reading it
+        if cls.CONTENT_ADDRESSED: cls.get_content_store().replace(_temporary_path, _file_name)
+        else:
+            os.replace(_temporary_path, cls.get_directory() + _file_name)
+            if cls.UPLOAD_SYNC != 'none': sync_directory(cls.get_directory())
+        cls.get_open_file_cache().invalidate(_file_name)
+        cls.store_received_file(_file_name, _checksum)
+
+
+    @classmethod
+    def remove_partial_uploads(cls) -> None:
+        # Temporary files of uploads that were running when the server stopped. They are kept in their own
+        # directory, on the same file system for the rename, so writing them does not change the mtime
+        # of the storage directory, which would make the file index rebuild itself.
+        _directory = os.path.join(cls.get_directory(), cls.UPLOAD_DIRECTORY)
+        os.makedirs(_directory, exist_ok=True)
+        for name in os.listdir(_directory):
+            if name.endswith(UPLOAD_SUFFIX): os.remove(os.path.join(_directory, name))
+
+
+    @classmethod
+    def store_received_file(cls, _file_name:str, _checksum:str=None) -> None:
+        cls.get_file_index().update(_file_name, _checksum)
+        if cls.CONTENT_ADDRESSED and cls.get_file_index().get(_file_name):
+            cls.get_content_store().absorb(_file_name, cls.get_file_index().get_checksum(_file_name))
+
+
+    @classmethod
+    def store_known_content(cls, _file_name:str, _file_size:int, _checksum:str) -> bool:
+        # Lets an upload be skipped when the content is already stored under another name
+        if not cls.CONTENT_ADDRESSED or cls.get_content_store().get_blob_size(_checksum) != _file_size: return False
+        if not cls.get_content_store().link(_file_name, _checksum): return False
+        cls.get_file_index().update(_file_name, _checksum)
+        return True
+
+
     @staticmethod
     def create_directory(_directory:str) -> None:
         try:   os.mkdir(_directory)
@@ -35,10 +125,21 @@ class Storage_MixIn:
         commands = (
             '/msg....: Private message',
             '/bmsg...: Broadcast message',
-            '/files..: Files on the server',
+            '/login..: Claim a mailbox for this client id (/login:secret opens it, client.py --id does both)',
+            '/inbox..: Private messages sent while you were logged out',
+            '/queues.: Outbound queue statistics',
+            '/stats..: Requests, latency and bytes per command (/stats:json for JSON)',
+            '/bandwidth: Transfer limits (admins: /bandwidth:global, clients or a client||rate like 10M, 0 for none)',
+            '/reload.: Load the command plugins again, clients stay connected (admins only)',
+            '/files..: Files on the server (/files:prefix||page)',
             '/delf...: Delete a file on the server',
-            '/downl..: Download from the server',
-            '/upl....: Upload to the server',
+            '/watch..: Be told when files are added, removed or resized (/watch:prefix, /unwatch to stop)',
+            '/downl..: Download from the server (/downl:name||zlib or lzma||level)',
+            '/pdownl.: Resumable download in parallel ranges',
+            '/rdownl.: Download bytes of a file (/rdownl:name||offset||length), written at that offset',
+            '/upl....: Upload to the server (/upl:name||zlib or lzma||level)',
+            '/pupl...: Resumable upload in parallel ranges',
+            '/batch..: Send the commands of a local file, one per line, in a single request (/batch:file)',
             '/exit...: Log out'
         )
         return f'<mult>:{Storage_MixIn.convert_to_string(commands)}'
@@ -58,59 +159,49 @@ class Storage_MixIn:
         return _file_size
 
 
-    @staticmethod
-    def check_if_the_file_exists(_file_name:str) -> tuple[bool, str]:
-        try: 
-            _path_to_file = Storage_MixIn.get_directory() + _file_name
-            _confimation  = Storage_MixIn.check_if_the_file_exists(_path_to_file)
-        except:
-            _confimation  = False
-            _path_to_file = None
-        return (_confimation, _path_to_file)
-
-
-    @staticmethod
-    def get_file_information(_file_name:str) -> str:
-        _file_existence, _path_to_file = Storage_MixIn.check_if_the_file_exists(_file_name)
+    def get_file_information(self, _client_port:int, _arguments:str) -> str:
+        _file_name, *_options = str(_arguments).split('||')
+        _entry  = Storage_MixIn.get_file_index().get(_file_name)
         _result = '<single>:SERVER: file not found'
-        if _file_existence:
-            _file_size = Storage_MixIn.get_file_size(_path_to_file)
-            _result = f'<confirm>:{_file_name}||{_file_size}'
+        if _entry:
+            _codec, _level = negotiate_compression(_file_name, *_options[:2])
+            _ticket = self.issue_ticket('downl', _client_port, (_file_name, _entry.size, _codec, _level))
+            _result = f'<confirm>:{_file_name}||{_entry.size}||{_codec}||{_level}||{_ticket}'
         return _result
 
 
     @staticmethod
-    def get_file_list_on_the_server() -> str:
-        _file_list       = os.listdir(Storage_MixIn.get_directory())
-        _files_and_sizes = Storage_MixIn.process_large_file_list(_file_list)
-        _result          = f'<mult>:{Storage_MixIn.convert_to_string(_files_and_sizes)}' 
-        return _result
+    def separate_listing_arguments(_arguments:str) -> tuple[str, int]:
+        _prefix, _page = ((_arguments or '').split('||', 1) + ['1'])[:2]
+        try:    _page = max(1, int(_page))
+        except: _page = 1
+        return (_prefix, _page)
 
 
     @staticmethod
-    def process_large_file_list(_file_names:list, _block_size=10) -> list:
-        _file_and_size = list()
-        for index in range(0, len(_file_names), _block_size):
-            _block = _file_names[index:index + _block_size]
-            _file_and_size.extend(Storage_MixIn.process_file_block(_block))
-        return _file_and_size
-    
-
-    @staticmethod
-    def process_file_block(_file_names:list) -> list:
-        _file_info = list()
-        for file in _file_names:
-            try: _file_info.append(f'{os.path.getsize(Storage_MixIn.get_directory() + file)} - {file}')
-            except: continue
-        return _file_info
+    def get_file_list_on_the_server(_arguments:str=None) -> str:
+        _prefix, _page = Storage_MixIn.separate_listing_arguments(_arguments)
+        _files, _total, _pages = Storage_MixIn.get_file_index().list_page(_prefix, _page, Storage_MixIn.PAGE_SIZE)
+        _lines  = [f'{size} - {name}' for name, size in _files]
+        _lines.append(f'Page {_page}/{_pages} ({_total} files)')
+        _result = f'<mult>:{Storage_MixIn.convert_to_string(_lines)}'
+        return _result
 
 
-    @staticmethod
-    def delete_file(_file_name:str) -> str:
-        try:    os.remove(Storage_MixIn.get_directory() + _file_name)
-        except  FileNotFoundError: _result = 'File not found'
+    @classmethod
+    def delete_file(cls, _file_name:str) -> str:
+        try:    cls.remove_stored_file(_file_name)
+        except  FileNotFoundError: _result = '<single>:SERVER: File not found'
         except: _result = '<single>:SERVER: Error when trying to delete the file'
-        else:   _result = f'File {_file_name} deleted'
+        else:   _result = f'<single>:SERVER: File {_file_name} deleted'
+        cls.get_file_index().remove(str(_file_name))
         return  _result
+
+
+    @classmethod
+    def remove_stored_file(cls, _file_name:str) -> None:
+        cls.get_open_file_cache().invalidate(_file_name)
+        if not cls.CONTENT_ADDRESSED: return os.remove(cls.get_directory() + _file_name)
+        if not cls.get_content_store().release(_file_name): raise FileNotFoundError(_file_name)
     
 
@@ -5,56 +5,231 @@
 
 
 from abc import ABC, abstractmethod
+from command_registry import COMMANDS, Arguments
 
 class Strategy(ABC):
+    # KEYS: command keys served by the strategy; a subclass with keys registers itself on import
+    # FLAG: forwarder its result goes to; a strategy may define forward(server, socket, data) instead
+    # ARGUMENTS: an Arguments parser, execute() then gets the parsed tuple instead of the raw string
+    # HELP: line of the /? list, for plugin commands
+    KEYS      = ()
+    FLAG      = 'svc'
+    ARGUMENTS = None
+    HELP      = ''
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        if cls.KEYS: COMMANDS.register(cls)
+
+
     @abstractmethod
     def execute(self, server, arguments=None):
         pass
 
 
+class Command_Not_Found_Strategy(Strategy):
+    def execute(self, _server, _client_port:int, _arguments:str):
+        return ('svc', '<single>:SERVER: Command not found')
+
+
 class Command_List_Strategy(Strategy):
+    KEYS = ("/?",)
+
     def execute(self, _server, _client_port:int, _arguments:str):
         _result = _server.get_command_list()
         return ('svc', _result)
 
 
 class Private_Message_Strategy(Strategy):
+    KEYS = ("/msg",)
+    FLAG = 'pvt'
+
     def execute(self, _server, _client_port:int, _arguments:str):
         _result = _server.prepare_private_message(_client_port, _arguments)
         return ('pvt', _result)
     
 
 class Broadcast_Message_Strategy(Strategy):
+    KEYS = ("/bmsg",)
+    FLAG = 'bdc'
+
     def execute(self, _server, _client_port:int, _arguments:str):
         _result = _server.prepare_broadcast_message(_client_port, _arguments)
         return ('bdc', _result)
 
 
+class Queue_Statistics_Strategy(Strategy):
+    KEYS = ("/queues",)
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        _result = _server.get_queue_statistics()
+        return ('svc', _result)
+
+
+class Offline_Messages_Strategy(Strategy):
+    KEYS = ("/inbox",)
+    FLAG = 'inb'
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        return _server.open_mailbox(_client_port)
+
+
+class Login_Strategy(Strategy):
+    KEYS = ("/login",)
+    FLAG = 'inb'
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        return _server.log_in(_client_port, _arguments)
+
+
+class Server_Statistics_Strategy(Strategy):
+    KEYS = ("/stats",)
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        _result = _server.get_server_statistics(_arguments)
+        return ('svc', _result)
+
+
+class Bandwidth_Strategy(Strategy):
+    KEYS = ("/bandwidth",)
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        _result = _server.configure_bandwidth(_arguments, _client_port=_client_port)
+        return ('svc', _result)
+
+
+class Batch_Strategy(Strategy):
+    KEYS = ("<batch>",)
+    FLAG = 'bat'
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        _result = _server.prepare_batch(_client_port, _arguments)
+        return ('bat', _result)
+
+
 class File_List_On_The_Server_Strategy(Strategy):
+    KEYS = ("/files",)
+
     def execute(self, _server, _client_port:int, _arguments:str):
-        _result = _server.get_file_list_on_the_server()
+        _result = _server.get_file_list_on_the_server(_arguments)
         return ('svc', _result)
 
 
 class Delete_File_Strategy(Strategy):
+    KEYS = ("/delf",)
+
     def execute(self, _server, _client_port:int, _arguments:str):
         _result = _server.delete_file(_arguments)
         return ('svc', _result)
 
 
 class Send_File_Name_And_Size_Strategy(Strategy):
+    KEYS = ("/downl",)
+
     def execute(self, _server, _client_port:int, _arguments:str):
-        _result = _server.get_file_information(_arguments)
+        _result = _server.get_file_information(_client_port, _arguments)
         return ('svc', _result)
 
 
 class Send_File_To_Client_Strategy(Strategy):
+    KEYS = ("<conf>",)
+    FLAG = 'sfl'
+
     def execute(self, _server, _client_port:int, _arguments:str):
-        _result = _server.separete_file_infomation(_arguments)
+        _result = _server.check_file_to_send(_arguments)
         return ('sfl', _result)
     
 
 class Receive_File_From_Client_Strategy(Strategy):
+    KEYS = ("/upl", "<file_inf>")
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        _result = _server.offer_upload(_client_port, _server.separete_file_infomation(_arguments))
+        return ('svc', _result)
+
+
+class Data_Channel_Strategy(Strategy):
+    KEYS = ("<data>",)
+    FLAG = 'dch'
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        _result = _server.open_data_channel(_client_port, _arguments)
+        return ('dch', _result)
+
+
+class Send_File_Manifest_Strategy(Strategy):
+    KEYS = ("/pdownl",)
+    FLAG = 'blk'
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        return ('blk', lambda: _server.get_file_manifest(_arguments))
+
+
+class Send_File_Range_Strategy(Strategy):
+    KEYS = ("<get_range>",)
+    FLAG = 'srg'
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        _result = _server.separate_range_request(_arguments)
+        return ('srg', _result)
+
+
+class Send_Byte_Range_Strategy(Strategy):
+    KEYS = ("/rdownl",)
+    FLAG = 'sbr'
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        _result = _server.separate_byte_range(_arguments)
+        return ('sbr', _result)
+
+
+class Chunked_Upload_Plan_Strategy(Strategy):
+    KEYS = ("<upl_chunks>",)
+    FLAG = 'blk'
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        return ('blk', lambda: _server.plan_chunked_upload(_arguments))
+
+
+class Receive_File_Range_Strategy(Strategy):
+    KEYS = ("<put_range>",)
+    FLAG = 'rrg'
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        _result = _server.separate_range_request(_arguments)
+        return ('rrg', _result)
+
+
+class Watch_Files_Strategy(Strategy):
+    KEYS      = ("/watch",)
+    ARGUMENTS = Arguments(("prefix", str, ''), _required=0)
+
+    def execute(self, _server, _client_port:int, _arguments:tuple):
+        _result = _server.watch_files(_client_port, *_arguments)
+        return ('svc', _result)
+
+
+class Unwatch_Files_Strategy(Strategy):
+    KEYS = ("/unwatch",)
+
     def execute(self, _server, _client_port:int, _arguments:str):
-        _result = _server.separete_file_infomation(_arguments)
-        return ('recv_file', _result)
+        _result = _server.unwatch_files(_client_port)
+        return ('svc', _result)
+
+
+class Exit_Strategy(Strategy):
+    KEYS = ("/exit",)
+    FLAG = '/exit'
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        _server.close_connection(_client_port)
+        return ('/exit', None)
+
+
+class Reload_Commands_Strategy(Strategy):
+    KEYS = ("/reload",)
+
+    def execute(self, _server, _client_port:int, _arguments:str):
+        if not _server.is_admin(_client_port): return ('svc', '<single>:SERVER: Only an admin session can reload the commands')
+        _result = _server.reload_commands()
+        return ('svc', _result)
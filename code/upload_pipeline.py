@@ -0,0 +1,167 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import hashlib, os, secrets, threading
+from collections import deque
+
+# When the bytes of an upload reach the disk:
+#   none     - the kernel writes them back on its own; a crash may leave the new name with missing data
+#   close    - the temporary file is synced before the rename and the directory after it
+#   periodic - like close, and the file is also synced every SYNC_BYTES, so write-back does not pile up
+SYNC_POLICIES = ('none', 'close', 'periodic')
+UPLOAD_SUFFIX = '.upload'
+
+
+def sync_directory(_directory:str) -> None:
+    # Makes a rename or a new link in the directory durable
+    _descriptor = os.open(_directory or '.', os.O_RDONLY)
+    try:     os.fsync(_descriptor)
+    finally: os.close(_descriptor)
+
+
+class Buffer_Pool:
+    # Receive buffers shared by the uploads of the process; idle ones are kept for the next upload
+    __slots__ = ('_size', '_limit', '_idle', '_lock', 'allocated')
+
+    def __init__(self, _size:int, _limit:int) -> None:
+        self._size     = _size
+        self._limit    = _limit
+        self._idle     = list()
+        self._lock     = threading.Lock()
+        self.allocated = 0
+
+
+    def get(self) -> bytearray:
+        with self._lock:
+            if self._idle: return self._idle.pop()
+            self.allocated += 1
+        return bytearray(self._size)
+
+
+    def put(self, _buffer:bytearray) -> None:
+        with self._lock:
+            if len(self._idle) < self._limit: self._idle.append(_buffer)
+
+
+    def describe(self) -> dict:
+        with self._lock:
+            return {'buffer_size': self._size, 'idle': len(self._idle), 'allocated': self.allocated}
+
+
+
+class Upload_Writer:
+    # Writer stage of an upload: the receiving side queues chunks and goes back to the socket while a
+    # thread writes them to a hidden temporary file in _temporary_directory (the directory of the
+    # destination by default; it must be on the same file system). finish() waits for the queue, syncs
+    # according to the policy and returns the temporary path, which the caller renames over the
+    # destination, so readers see the old file or the new one and never a partial upload.
+    # A blocking writer makes write() wait while QUEUE_BYTES are queued; the event loop uses a
+    # non-blocking one and waits for room in an executor. With _checksum the thread also hashes what it
+    # writes, and checksum holds the sha256 after finish(), so storing the file does not read it again.
+    __slots__ = ('path', 'temporary_path', 'written', 'checksum', '_file', '_chunks', '_condition', '_queued',
+                 '_closed', '_error', '_sync', '_unsynced', '_pool', '_blocking', '_hash', '_thread')
+    QUEUE_BYTES = 8 * 1024 * 1024
+    SYNC_BYTES  = 32 * 1024 * 1024
+
+    def __init__(self, _path:str, _sync:str='close', _pool:Buffer_Pool=None, _blocking:bool=True, _checksum:bool=False,
+                 _temporary_directory:str=None) -> None:
+        _directory, _name   = os.path.split(_path)
+        self.path           = _path
+        self.temporary_path = os.path.join(_temporary_directory or _directory, f'.{_name}.{secrets.token_hex(4)}{UPLOAD_SUFFIX}')
+        self.written        = 0
+        self.checksum       = None
+        self._file          = open(self.temporary_path, 'wb', buffering=0)
+        self._chunks        = deque()
+        self._condition     = threading.Condition()
+        self._queued        = 0
+        self._closed        = False
+        self._error         = None
+        self._sync          = _sync
+        self._unsynced      = 0
+        self._pool          = _pool
+        self._blocking      = _blocking
+        self._hash          = hashlib.sha256() if _checksum else None
+        self._thread        = threading.Thread(target=self.write_queued, daemon=True)
+        self._thread.start()
+
+
+    def get_buffer(self) -> bytearray:
+        return self._pool.get()
+
+
+    def write(self, _data:bytes | memoryview, _buffer:bytearray=None) -> None:
+        # _buffer is the pool buffer behind _data; it goes back to the pool once written
+        with self._condition:
+            if self._error: raise self._error
+            while self._blocking and self._queued >= self.QUEUE_BYTES and not self._error: self._condition.wait()
+            self._chunks.append((_data, _buffer))
+            self._queued += len(_data)
+            self._condition.notify_all()
+
+
+    def is_full(self) -> bool:
+        return self._queued >= self.QUEUE_BYTES
+
+
+    def wait_for_room(self) -> None:
+        with self._condition:
+            while self._queued >= self.QUEUE_BYTES and not self._error: self._condition.wait()
+
+
+    def write_queued(self) -> None:
+        while True:
+            with self._condition:
+                while not self._chunks and not self._closed: self._condition.wait()
+                if not self._chunks: return
+                _data, _buffer = self._chunks.popleft()
+            try:
+                if not self._error: self.write_chunk(_data)
+            except OSError as error:
+                self._error = error
+            finally:
+                if _buffer is not None: self._pool.put(_buffer)
+                with self._condition:
+                    self._queued -= len(_data)
+                    self._condition.notify_all()
+
+
+    def write_chunk(self, _data:bytes | memoryview) -> None:
+        _view = memoryview(_data)
+        while _view:
+            _view = _view[self._file.write(_view):]
+        if self._hash: self._hash.update(_data)
+        self.written   += len(_data)
+        self._unsynced += len(_data)
+        if self._sync == 'periodic' and self._unsynced >= self.SYNC_BYTES:
+            os.fdatasync(self._file.fileno())
+            self._unsynced = 0
+
+
+    def stop(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+
+    def finish(self) -> str:
+        self.stop()
+        try:
+            if self._error: raise self._error
+            if self._sync != 'none': os.fsync(self._file.fileno())
+            if self._hash: self.checksum = self._hash.hexdigest()
+        except:
+            self.abort()
+            raise
+        self._file.close()
+        return self.temporary_path
+
+
+    def abort(self) -> None:
+        self.stop()
+        self._file.close()
+        try:    os.remove(self.temporary_path)
+        except FileNotFoundError: pass
@@ -0,0 +1,123 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import os, shutil, time
+from message_store import Message_Store, Mailbox_Keys, RECORD
+
+
+def reopen(_store:Message_Store, _directory:str) -> Message_Store:
+    # What a restart sees: the segments on disk, without the in-memory index
+    _store.close()
+    return Message_Store(_directory).open()
+
+
+def get_segments(_directory:str) -> list:
+    return sorted(name for name in os.listdir(_directory) if name.endswith('.log'))
+
+
+def test_pending_messages_are_replayed_after_a_restart(tmp_path):
+    _store = Message_Store(str(tmp_path)).open()
+    _store.put(1, b'a1')
+    _store.put(2, b'b1')
+    _store.put(1, b'a2')
+    _store = reopen(_store, str(tmp_path))
+    assert _store.take(1) == [b'a1', b'a2']
+    assert _store.take(2) == [b'b1']
+    assert _store.take(1) == []
+
+
+def test_delivered_messages_do_not_come_back(tmp_path):
+    _store = Message_Store(str(tmp_path)).open()
+    _store.put(1, b'old')
+    assert _store.take(1) == [b'old']
+    _store.put(1, b'new')
+    _store = reopen(_store, str(tmp_path))
+    assert _store.take(1) == [b'new']
+
+
+def test_only_acknowledged_messages_are_delivered(tmp_path):
+    _store = Message_Store(str(tmp_path)).open()
+    for frame in (b'a', b'b', b'c'): _store.put(1, frame)
+    _pending = _store.peek(1)
+    assert [frame for _, frame in _pending] == [b'a', b'b', b'c']
+    _store.acknowledge(1, _pending[1][0])
+    _store = reopen(_store, str(tmp_path))
+    assert [frame for _, frame in _store.peek(1)] == [b'c']
+    assert _store.take(1) == [b'c']
+
+
+def test_record_cut_by_a_crash_ends_the_segment(tmp_path):
+    _store = Message_Store(str(tmp_path)).open()
+    _store.put(1, b'complete')
+    _store.close()
+    with open(os.path.join(str(tmp_path), get_segments(str(tmp_path))[-1]), 'ab') as file:
+        file.write(RECORD.pack(100, 1, 1, 99, 0.0) + b'cut short')
+    _store = Message_Store(str(tmp_path)).open()
+    _store.put(1, b'after')
+    _store = reopen(_store, str(tmp_path))
+    assert _store.take(1) == [b'complete', b'after']
+
+
+def test_full_mailbox_keeps_the_newest_messages(tmp_path):
+    _store = Message_Store(str(tmp_path), _max_per_recipient=2).open()
+    for index in range(4): _store.put(1, b'%d' % index)
+    assert _store.describe()['dropped'] == 2
+    _store.close()
+    _store = Message_Store(str(tmp_path), _max_per_recipient=2).open()
+    assert _store.take(1) == [b'2', b'3']
+
+
+def test_compaction_keeps_pending_messages_and_removes_sealed_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(Message_Store, 'SEGMENT_BYTES', 4096)
+    _store = Message_Store(str(tmp_path)).open()
+    _store.put(2, b'kept')
+    for index in range(200): _store.put(1, b'x' * 64)
+    _store.take(1)
+    for index in range(200): _store.put(1, b'y' * 64)
+    assert _store.take(1) == [b'y' * 64] * 200
+    assert get_segments(str(tmp_path))[0] > f'{1:012d}.log'
+    _store = reopen(_store, str(tmp_path))
+    assert _store.take(2) == [b'kept']
+    assert _store.take(1) == []
+
+
+def test_compaction_interrupted_before_the_old_segments_were_deleted(tmp_path):
+    # The copy is a later segment holding the same sequence numbers: each message is kept once
+    _store = Message_Store(str(tmp_path)).open()
+    _store.put(1, b'a')
+    _store.put(1, b'b')
+    _store.close()
+    _first = get_segments(str(tmp_path))[-1]
+    shutil.copy(os.path.join(str(tmp_path), _first), os.path.join(str(tmp_path), f'{int(_first[:-4]) + 1:012d}.log'))
+    _store = Message_Store(str(tmp_path)).open()
+    assert _store.take(1) == [b'a', b'b']
+    _store = reopen(_store, str(tmp_path))
+    assert _store.take(1) == []
+
+
+def test_mailbox_is_claimed_once_and_verified_by_its_secret(tmp_path):
+    _keys   = Mailbox_Keys(str(tmp_path))
+    _secret = _keys.claim(40001)
+    assert _secret and _keys.is_claimed(40001)
+    assert _keys.claim(40001) is None
+    assert _keys.verify(40001, _secret)
+    assert not _keys.verify(40001, 'wrong')
+    assert not _keys.verify(40002, _secret)
+    assert Mailbox_Keys(str(tmp_path)).verify(40001, _secret)
+
+
+def test_lapsed_claim_can_be_claimed_again_without_the_old_messages(tmp_path):
+    _keys  = Mailbox_Keys(str(tmp_path / 'keys'), _retention_seconds=60)
+    _store = Message_Store(str(tmp_path / 'messages')).open()
+    _old   = _keys.claim(40001)
+    _store.put(40001, b'for the first owner')
+    os.utime(_keys.get_path(40001), (0, 0))
+    assert not _keys.is_claimed(40001) and not _keys.verify(40001, _old)
+    time.sleep(0.01)
+    _new = _keys.claim(40001)
+    assert _new and _keys.verify(40001, _new) and not _keys.verify(40001, _old)
+    _store.put(40001, b'for the second owner')
+    assert [frame for _, frame in _store.peek(40001, _keys.get_claimed_at(40001))] == [b'for the second owner']
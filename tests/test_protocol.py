@@ -0,0 +1,72 @@
+# MIT License
+# Copyright (c) 2024 Oliver Ribeiro Calazans Jeronimo
+# Repository: https://github.com/olivercalazans/simple_server
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software...
+
+
+import pytest
+from protocol import Frame_Decoder, Protocol_Error, HEADER, COMMAND, DATA, MAX_FRAME_SIZE, encode_command, encode_data
+
+
+def test_frame_split_across_reads_is_returned_once_complete():
+    _frame   = encode_command('/msg:40001:hello')
+    _decoder = Frame_Decoder()
+    for index in range(len(_frame) - 1):
+        _decoder.feed(_frame[index:index + 1])
+        assert _decoder.next_frame() is None
+    _decoder.feed(_frame[-1:])
+    assert _decoder.next_frame() == (COMMAND, '/msg', b'40001:hello')
+    assert _decoder.next_frame() is None
+
+
+def test_coalesced_frames_come_out_in_order():
+    _decoder = Frame_Decoder()
+    _decoder.feed(encode_command('/files') + encode_data(b'abc') + encode_command('/downl:a.txt'))
+    assert _decoder.next_frame() == (COMMAND, '/files', b'')
+    assert _decoder.next_frame() == (DATA, '', b'abc')
+    assert _decoder.next_frame() == (COMMAND, '/downl', b'a.txt')
+    assert _decoder.next_frame() is None
+
+
+def test_commands_received_while_waiting_for_data_are_kept_for_later():
+    _decoder = Frame_Decoder()
+    _decoder.feed(encode_command('/msg:1:first') + encode_command('/files') + encode_data(b'payload'))
+    assert _decoder.next_data() == b'payload'
+    assert _decoder.next_data() is None
+    assert _decoder.next_frame() == (COMMAND, '/msg', b'1:first')
+    assert _decoder.next_frame() == (COMMAND, '/files', b'')
+    assert _decoder.next_frame() is None
+
+
+def test_data_header_is_taken_alone_and_payload_copied_into_a_view():
+    _decoder = Frame_Decoder()
+    _decoder.feed(encode_command('/files') + encode_data(b'0123456789'))
+    assert _decoder.take_data_header() == 10
+    _buffer = bytearray(4)
+    assert _decoder.take_buffered(memoryview(_buffer)) == 4
+    assert _buffer == b'0123'
+    assert _decoder.next_frame() == (COMMAND, '/files', b'')
+
+
+def test_missing_size_covers_the_header_then_the_rest_of_the_frame():
+    _frame   = encode_command('/msg:1:hello')
+    _decoder = Frame_Decoder()
+    assert _decoder.get_missing_size() == HEADER.size
+    _decoder.feed(_frame[:3])
+    assert _decoder.get_missing_size() == HEADER.size - 3
+    _decoder.feed(_frame[3:HEADER.size + 2])
+    assert _decoder.get_missing_size() == len(_frame) - HEADER.size - 2
+
+
+def test_invalid_header_is_refused():
+    _decoder = Frame_Decoder()
+    _decoder.feed(HEADER.pack(MAX_FRAME_SIZE + 1, COMMAND, 0))
+    with pytest.raises(Protocol_Error): _decoder.next_frame()
+    _decoder = Frame_Decoder()
+    _decoder.feed(HEADER.pack(2, COMMAND, 3) + b'ab')
+    with pytest.raises(Protocol_Error): _decoder.next_frame()
+
+
+def test_arguments_of_an_empty_payload_are_none():
+    assert Frame_Decoder.get_arguments(b'') is None
+    assert Frame_Decoder.get_arguments(b'a||b') == 'a||b'